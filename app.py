@@ -1,14 +1,44 @@
 """The app"""
+import asyncio
 import json
 import configparser as cp
-from os.path import exists
 from dataclasses import dataclass, field
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import plotly
-import plotly.express as px
+import os
+from os.path import exists, join
+import numpy as np
 import pandas as pd
+import columns
+from chartcache import ChartCache, fingerprint
+from gaps import GapIndex, load_attempts, save_attempts
+from households import Households
+from metrics import CHART_REQUESTS, CHART_SECONDS, UPDATE_SECONDS, UPDATE_STAGE_SECONDS
 from octopus import OctopusEnergy
+from rollups import Rollups
+from seasons import season_histograms
+from store import TARIFF_PREFIX, ParquetStore
+from timeseries import MIN_CAPACITY, TimeSeries
+
+# The single parquet files used before the partitioned store
+LEGACY_FILES = {
+    "agile_tariff": "./agile_tariff.parquet",
+    "electricity": "./e_consumption.parquet",
+    "gas": "./g_consumption.parquet",
+}
+# How much Agile tariff history to hold in memory
+AGILE_HISTORY = "31 D"
+# The charts, and what else is served without the frames, saved after every
+# update so that a restart can serve them straight away, see restore()
+SNAPSHOT_FILE = "snapshot.json"
+SNAPSHOT_SERIES_FILE = "snapshot_series.npz"
+# compact, memory mapped, copies of the datasets, see load_series
+SERIES_DIR = "series"
+CHARTS = [
+    "electricity_daily_chart",
+    "electricity_rolling_chart",
+    "gas_consumption_binned_chart",
+    "gas_daily_chart",
+    "gas_rolling_chart",
+]
 
 
 def line_plot(plot_data, plot_title):
@@ -18,6 +48,10 @@ def line_plot(plot_data, plot_title):
     An alternative would be to send the raw data to the front end (probaby
     still JSON encoded) and build the chart there, using a suitalbe package.
     """
+    # plotly is slow to import, and only needed once a chart has to be built
+    import plotly
+    import plotly.express as px
+
     fig = px.line(
         plot_data,
         range_y=[0, plot_data.max() * 1.1],
@@ -27,9 +61,15 @@ def line_plot(plot_data, plot_title):
 
 
 def histogram_plot(plotData, plotTitle):
-    fig = px.histogram(
-        plotData, x="consumption", nbins=40, range_x=[0, 20]
-    ).update_layout(showlegend=False, title=plotTitle)
+    """A histogram from (left edges of the bins, counts)"""
+    import plotly
+    import plotly.express as px
+
+    edges, counts = plotData
+    width = edges[1] - edges[0]
+    fig = px.bar(x=edges + width / 2, y=counts, range_x=[0, 20]).update_layout(
+        showlegend=False, title=plotTitle, bargap=0
+    )
     json_plot = plotly.io.to_json(fig)
     return json_plot
 
@@ -38,152 +78,512 @@ def histogram_plot(plotData, plotTitle):
 class OctopusData:
     """Class for keeping track of an item in inventory."""
 
-    agile_tariff: pd.DataFrame = field(default_factory=pd.DataFrame)
-    electricity_consumption: pd.DataFrame = field(default_factory=pd.DataFrame)
-    gas_consumption: pd.DataFrame = field(default_factory=pd.DataFrame)
-    missing_gas: pd.DataFrame = field(default_factory=pd.DataFrame)
-    missing_electric: pd.DataFrame = field(default_factory=pd.DataFrame)
+    # sorted by timestamp, one row each, see timeseries.py
+    agile_tariff: TimeSeries = field(default_factory=TimeSeries)
+    electricity_consumption: TimeSeries = field(default_factory=TimeSeries)
+    gas_consumption: TimeSeries = field(default_factory=TimeSeries)
+    # the rates of TARIFFS in config.ini, by tariff code
+    tariffs: dict = field(default_factory=dict)
+    # gaps in the readings by fuel, see gaps.py
+    gaps: dict = field(default_factory=dict)
     electricity_daily_chart: json = None
     electricity_rolling_chart: json = None
     gas_consumption_binned_chart: json = None
-    gas_consumption_2022_binned_chart: json = None
-    gas_consumption_2023_binned_chart: json = None
-    gas_consumption_2024_binned_chart: json = None
+    # by heating season, see seasons.py
+    gas_season_charts: dict = field(default_factory=dict)
     gas_daily_chart: json = None
     gas_rolling_chart: json = None
+    store: ParquetStore = field(default_factory=ParquetStore)
+    loaded: bool = False
+    rollups: Rollups = None
+    # the rates held are every stored one from here on, see load
+    rates_since: pd.Timestamp = None
+    # chart data as (x, y) numpy columns, see columns.py
+    series: dict = field(default_factory=dict)
+    # fingerprints of the data behind each chart, see chartcache.py
+    fingerprints: dict = field(default_factory=dict)
+    # what /startpage shows, empty until there is some data to show
+    summary: dict = field(default_factory=dict)
 
-    def update(self, octopus_client):
+    def load(self):
+        """
+        Load the stored history. The original, unpartitioned, parquet files
+        are imported into the store the first time round. Anything not yet
+        stored is fetched by the first update.
+        """
         # error loading because...
         # https://stackoverflow.com/questions/68625748/attributeerror-cant-get-attribute-new-block-on-module-pandas-core-internal
+        for dataset, legacy_file in LEGACY_FILES.items():
+            self.store.import_file(dataset, legacy_file)
+
+        # Only recent rates are needed for start times
+        recent = pd.Timestamp.now(tz="UTC") - pd.Timedelta(AGILE_HISTORY)
+        self.rates_since = recent
+        self.agile_tariff = self.load_series("agile_tariff", start=recent)
+        self.tariffs = {
+            dataset[len(TARIFF_PREFIX) :]: self.load_series(dataset, start=recent)
+            for dataset in self.store.manifest
+            if dataset.startswith(TARIFF_PREFIX)
+        }
+        self.electricity_consumption = self.load_series("electricity")
+        self.gas_consumption = self.load_series("gas")
+        self.rollups = Rollups.load(
+            self.store,
+            {"electricity": self.electricity_consumption, "gas": self.gas_consumption},
+        )
+        attempts = load_attempts(join(self.store.root, "gaps.json"))
+        self.gaps = {
+            "electricity": GapIndex.from_index(
+                self.electricity_consumption.index, attempts.get("electricity")
+            ),
+            "gas": GapIndex.from_index(self.gas_consumption.index, attempts.get("gas")),
+        }
+        self.loaded = True
+
+    def prepare(self):
+        """
+        Load the stored history, without going to the network. Charts are
+        only built if they weren't restored, and there is something to chart.
+        """
+        with UPDATE_STAGE_SECONDS.time(stage="load"):
+            self.load()
+        if self.summary or (
+            self.electricity_consumption.empty and self.gas_consumption.empty
+        ):
+            return
+        with UPDATE_STAGE_SECONDS.time(stage="charts"):
+            self.electricity_charts()
+            self.gas_charts()
+        self.summarise()
+        if not self.store.read_only:
+            self.save_snapshot()
 
-        if exists("./agile_tariff.parquet"):
-            self.agile_tariff = pd.read_parquet("./agile_tariff.parquet")
-        else:
-            self.agile_tariff = octopus_client.get_agile_tarriff_rates()
-        if exists("./e_consumption.parquet"):
-            self.electricity_consumption = pd.read_parquet("./e_consumption.parquet")
-        else:
-            self.electricity_consumption = octopus_client.consumption(
-                OctopusEnergy.FuelType.ELECTRIC, page_size=25000
+    def summarise(self):
+        """What /startpage shows"""
+        self.summary = {
+            "missing_electric": self.gaps["electricity"].missing(),
+            "missing_gas": self.gaps["gas"].missing(),
+            "gaps_electric": len(self.gaps["electricity"]),
+            "gaps_gas": len(self.gaps["gas"]),
+            "recent_gas": self.gas_consumption.max().isoformat(),
+            "recent_electric": self.electricity_consumption.max().isoformat(),
+        }
+
+    def save_snapshot(self, refreshed_at=None):
+        """
+        Save the charts, series, fingerprints and summary, each file
+        replaced atomically, for restore()
+        """
+        if refreshed_at is None:
+            refreshed_at = pd.Timestamp.now(tz="UTC")
+        os.makedirs(self.store.root, exist_ok=True)
+        path = join(self.store.root, SNAPSHOT_SERIES_FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                **{
+                    "%s/%s" % (name, column): values
+                    for name, columns in self.series.items()
+                    for column, values in zip("xy", columns)
+                },
             )
-        if exists("./g_consumption.parquet"):
-            self.gas_consumption = pd.read_parquet("./g_consumption.parquet")
-        else:
-            self.gas_consumption = octopus_client.consumption(
-                OctopusEnergy.FuelType.GAS, page_size=25000
+        os.replace(path + ".tmp", path)
+        path = join(self.store.root, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "refreshed_at": refreshed_at.isoformat(),
+                    "charts": {chart: getattr(self, chart) for chart in CHARTS},
+                    "gas_season_charts": self.gas_season_charts,
+                    "fingerprints": self.fingerprints,
+                    "summary": self.summary,
+                },
+                f,
             )
+        os.replace(path + ".tmp", path)
 
-        self.agile_tariff = octopus_client.get_agile_tarriff_rates(self.agile_tariff)
-        self.electricity_consumption = octopus_client.update_consumption(
-            OctopusEnergy.FuelType.ELECTRIC, self.electricity_consumption
-        )
-        self.gas_consumption = octopus_client.update_consumption(
-            OctopusEnergy.FuelType.GAS, self.gas_consumption
+    def snapshot_version(self):
+        """
+        Which save_snapshot() is on disk, changing each time it is saved,
+        None if there isn't one
+        """
+        try:
+            saved = os.stat(join(self.store.root, SNAPSHOT_FILE))
+        except FileNotFoundError:
+            return None
+        return saved.st_ino, saved.st_mtime_ns
+
+    def restore(self):
+        """
+        The charts, series and summary saved by the last update, without
+        loading any of the history behind them; that is left to prepare().
+        Returns when they were refreshed, None if nothing has been saved.
+        """
+        path = join(self.store.root, SNAPSHOT_FILE)
+        series_path = join(self.store.root, SNAPSHOT_SERIES_FILE)
+        if not exists(path) or not exists(series_path):
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        for chart, value in saved["charts"].items():
+            setattr(self, chart, value)
+        self.gas_season_charts = {
+            int(season): chart for season, chart in saved["gas_season_charts"].items()
+        }
+        self.fingerprints = saved["fingerprints"]
+        self.summary = saved["summary"]
+        with np.load(series_path) as columns:
+            names = {key.rsplit("/", 1)[0] for key in columns.files}
+            self.series = {
+                name: (columns[name + "/x"], columns[name + "/y"]) for name in names
+            }
+        return pd.Timestamp(saved["refreshed_at"])
+
+    def memory_usage(self):
+        """Roughly how many bytes the frames, totals, series and charts take"""
+        frames = []
+        if self.rollups is not None:
+            frames.extend(self.rollups.tables.values())
+        charts = [getattr(self, chart) for chart in CHARTS]
+        charts.extend(self.gas_season_charts.values())
+        return (
+            self.agile_tariff.nbytes
+            + self.electricity_consumption.nbytes
+            + self.gas_consumption.nbytes
+            + sum(rates.nbytes for rates in self.tariffs.values())
+            + sum(int(frame.memory_usage(deep=True).sum()) for frame in frames)
+            + sum(x.nbytes + y.nbytes for x, y in self.series.values())
+            + sum(len(chart) for chart in charts if chart is not None)
         )
 
-        self.missing_gas = OctopusEnergy.missing(self.gas_consumption)
-        self.missing_electric = OctopusEnergy.missing(self.electricity_consumption)
-        self.electricity_charts()
-        self.gas_charts()
+    def update(self, octopus_client):
+        """
+        Fetch what's new, then update totals, gaps and charts and save it.
+        Each stage is timed, see metrics.py.
+        """
+        with UPDATE_SECONDS.time(client="sync"):
+            # Only go to disk on the first update, after that the frames in
+            # memory are at least as recent as the store.
+            if not self.loaded:
+                with UPDATE_STAGE_SECONDS.time(stage="load"):
+                    self.load()
+
+            previous = (
+                self.agile_tariff,
+                self.electricity_consumption,
+                self.gas_consumption,
+                self.tariffs,
+            )
+            refetched = self.refetchable_gaps(octopus_client)
 
-        self.agile_tariff.to_parquet("./agile_tariff.parquet")
-        self.electricity_consumption.to_parquet("./e_consumption.parquet")
-        self.gas_consumption.to_parquet("./g_consumption.parquet")
+            with UPDATE_STAGE_SECONDS.time(stage="agile"):
+                self.agile_tariff = octopus_client.get_agile_tarriff_rates(
+                    self.agile_tariff
+                )
+                self.tariffs = octopus_client.compared_tariff_rates(self.tariffs)
+            with UPDATE_STAGE_SECONDS.time(stage="electricity"):
+                self.electricity_consumption = octopus_client.merge_consumption(
+                    octopus_client.update_consumption(
+                        OctopusEnergy.FuelType.ELECTRIC, self.electricity_consumption
+                    ),
+                    octopus_client.gap_results(
+                        OctopusEnergy.FuelType.ELECTRIC, refetched["electricity"]
+                    ),
+                )
+            with UPDATE_STAGE_SECONDS.time(stage="gas"):
+                self.gas_consumption = octopus_client.merge_consumption(
+                    octopus_client.update_consumption(
+                        OctopusEnergy.FuelType.GAS, self.gas_consumption
+                    ),
+                    octopus_client.gap_results(
+                        OctopusEnergy.FuelType.GAS, refetched["gas"]
+                    ),
+                )
+
+            self.finish_update(*previous, refetched)
+
+    async def update_async(self, octopus_client):
+        """
+        As update, using an AsyncOctopusEnergy client. The downloads run at
+        the same time; loading, charts and saving run in a worker thread so
+        they don't hold up the event loop.
+        """
+        with UPDATE_SECONDS.time(client="async"):
+            if not self.loaded:
+                with UPDATE_STAGE_SECONDS.time(stage="load"):
+                    await asyncio.to_thread(self.load)
+
+            previous = (
+                self.agile_tariff,
+                self.electricity_consumption,
+                self.gas_consumption,
+                self.tariffs,
+            )
+            refetched = self.refetchable_gaps(octopus_client)
+
+            # the downloads overlap, so they are timed together
+            with UPDATE_STAGE_SECONDS.time(stage="download"):
+                (
+                    self.agile_tariff,
+                    self.tariffs,
+                    electricity_consumption,
+                    gas_consumption,
+                    electricity_gaps,
+                    gas_gaps,
+                ) = await asyncio.gather(
+                    octopus_client.get_agile_tarriff_rates(self.agile_tariff),
+                    octopus_client.compared_tariff_rates(self.tariffs),
+                    octopus_client.update_consumption(
+                        OctopusEnergy.FuelType.ELECTRIC, self.electricity_consumption
+                    ),
+                    octopus_client.update_consumption(
+                        OctopusEnergy.FuelType.GAS, self.gas_consumption
+                    ),
+                    octopus_client.gap_results(
+                        OctopusEnergy.FuelType.ELECTRIC, refetched["electricity"]
+                    ),
+                    octopus_client.gap_results(
+                        OctopusEnergy.FuelType.GAS, refetched["gas"]
+                    ),
+                )
+            with UPDATE_STAGE_SECONDS.time(stage="merge"):
+                self.electricity_consumption = octopus_client.merge_consumption(
+                    electricity_consumption, electricity_gaps
+                )
+                self.gas_consumption = octopus_client.merge_consumption(
+                    gas_consumption, gas_gaps
+                )
+
+            await asyncio.to_thread(self.finish_update, *previous, refetched)
+
+    def refetchable_gaps(self, octopus_client):
+        """Gaps, by fuel, to ask the API for again"""
+        max_attempts = octopus_client.cfg["octopus"].getint("GAP_ATTEMPTS", 3)
+        return {
+            fuel: self.gaps[fuel].refetchable(max_attempts)
+            for fuel in ("electricity", "gas")
+        }
+
+    def finish_update(
+        self, agile_tariff, electricity_consumption, gas_consumption, tariffs, refetched
+    ):
+        """Totals, gaps, charts and saving, once the new data has arrived"""
+        with UPDATE_STAGE_SECONDS.time(stage="new_rows"):
+            new_agile_tariff = self.agile_tariff.difference(agile_tariff)
+            new_tariffs = {
+                tariff_code: rates.difference(tariffs.get(tariff_code, TimeSeries()))
+                for tariff_code, rates in self.tariffs.items()
+            }
+            # new readings and corrected ones, and the readings they replace
+            electricity = self.electricity_consumption.changes(electricity_consumption)
+            gas = self.gas_consumption.changes(gas_consumption)
+            new_electricity, new_gas = electricity.frame(), gas.frame()
+            replaced_electricity = electricity_consumption.intersection(electricity)
+            replaced_gas = gas_consumption.intersection(gas)
+
+        with UPDATE_STAGE_SECONDS.time(stage="readings"):
+            # what the compact copies were saved from, see save_series
+            saved = {fuel: self.store.version(fuel) for fuel in ("electricity", "gas")}
+            # saved before the totals that count them, see rollups.py
+            self.store.write("electricity", new_electricity)
+            self.store.write("gas", new_gas)
+        with UPDATE_STAGE_SECONDS.time(stage="rollups"):
+            self.rollups = self.rollups.add(
+                "electricity", new_electricity, replaced_electricity.frame()
+            ).add("gas", new_gas, replaced_gas.frame())
+        with UPDATE_STAGE_SECONDS.time(stage="gaps"):
+            self.gaps = {
+                "electricity": self.gaps["electricity"].update(
+                    new_electricity.index, refetched["electricity"]
+                ),
+                "gas": self.gaps["gas"].update(new_gas.index, refetched["gas"]),
+            }
+        with UPDATE_STAGE_SECONDS.time(stage="charts"):
+            self.electricity_charts()
+            self.gas_charts()
+        self.summarise()
+
+        with UPDATE_STAGE_SECONDS.time(stage="save"):
+            self.save(
+                new_agile_tariff,
+                new_tariffs,
+                {
+                    "electricity": (electricity, saved["electricity"]),
+                    "gas": (gas, saved["gas"]),
+                },
+            )
+            self.save_snapshot()
+
+    def save(self, new_agile_tariff, new_tariffs=None, readings=None):
+        """
+        Write only the rates that weren't there before, and the gaps. The
+        readings are written before the totals, in finish_update; their
+        compact copies are added to, see save_series, with `readings`, the
+        (new rows, version of the store they were added to) by fuel.
+        """
+        self.store.write("agile_tariff", new_agile_tariff.frame())
+        save_attempts(join(self.store.root, "gaps.json"), self.gaps)
+        for tariff_code, rates in (new_tariffs or {}).items():
+            self.store.write(TARIFF_PREFIX + tariff_code, rates.frame())
+            self.save_series(
+                TARIFF_PREFIX + tariff_code,
+                self.tariffs[tariff_code],
+                start=self.rates_since,
+            )
+        self.save_series("agile_tariff", self.agile_tariff, start=self.rates_since)
+        for fuel, (rows, saved) in (readings or {}).items():
+            series = getattr(self, fuel + "_consumption")
+            self.save_series(fuel, series, appended=rows, saved=saved)
+
+    def series_path(self, dataset):
+        return join(self.store.root, SERIES_DIR, dataset + ".series")
+
+    def save_series(self, dataset, series, start=None, appended=None, saved=None):
+        """
+        The compact copy of a dataset, from `start` on or all of it, marked
+        with the store's version of it and that start, so load_series can
+        tell whether it is still current. If the copy is of version `saved`
+        of the whole dataset, and `series` is it with the `appended` rows
+        after its last, they are added to it in place, O(new), rather than
+        it being written again.
+        """
+        os.makedirs(join(self.store.root, SERIES_DIR), exist_ok=True)
+        path = self.series_path(dataset)
+        meta = {
+            "version": self.store.version(dataset),
+            "start": None if start is None else start.isoformat(),
+        }
+        if (
+            appended is not None
+            and start is None
+            and exists(path)
+            and TimeSeries.append_saved(
+                path, appended, meta, {"version": saved, "start": None}
+            )
+        ):
+            return
+        # room to grow, so that appending is O(new), amortised
+        series.save(path, meta, spare=max(len(series), MIN_CAPACITY))
+
+    def load_series(self, dataset, start=None):
+        """
+        A dataset, from `start`, memory mapped from its compact copy if the
+        store hasn't changed since it was saved and it goes back that far,
+        otherwise read from the store and saved compactly for next time
+        """
+        path = self.series_path(dataset)
+        if exists(path):
+            try:
+                series, meta = TimeSeries.load(path)
+            except ValueError:
+                # not a TimeSeries, or a header left half written
+                meta = None
+            if (
+                isinstance(meta, dict)
+                and meta.get("version") == self.store.version(dataset)
+                and (
+                    meta["start"] is None
+                    or start is not None
+                    and pd.Timestamp(meta["start"]) <= start
+                )
+            ):
+                return series if start is None else series.since(start)
+        series = TimeSeries.from_frame(self.store.read(dataset, start=start))
+        if not self.store.read_only:
+            self.save_series(dataset, series, start=start)
+        return series
+
+    def chart(self, name, plot, plot_data, plot_title):
+        """
+        The chart from the cache if the same data has been plotted before.
+        The fingerprint is kept, by name, for the ETags.
+        """
+        key = fingerprint(plot_data, plot.__name__, plot_title)
+        self.fingerprints = {**self.fingerprints, name: key}
+        cache = "hit"
+
+        def build():
+            nonlocal cache
+            cache = "miss"
+            with CHART_SECONDS.time(chart=name):
+                return plot(plot_data, plot_title)
+
+        chart = chart_cache.get(key, build)
+        CHART_REQUESTS.inc(cache=cache)
+        return chart
 
     def electricity_charts(self):
         """A series of electricity charts based on consumption data"""
-        electricity_consumption_daily = self.electricity_consumption.resample("D").sum(
-            numeric_only=True
-        )
+        electricity_consumption_daily = self.rollups.get("electricity", "daily")[
+            ["consumption"]
+        ]
         electricity_consumption_rolling = (
-            self.electricity_consumption["consumption"]
-            .sort_index()
-            .rolling(24 * 2 * 10)
-            .sum(numeric_only=True)
+            self.rollups.get("electricity", "hourly")["consumption"]
+            .rolling("10D")
+            .sum()
         )
-        self.electricity_daily_chart = line_plot(
-            electricity_consumption_daily, "Electricity Consumption Daily"
+        self.series = {
+            **self.series,
+            "electricityDaily": columns.from_frame(electricity_consumption_daily),
+            "electricityRolling": columns.from_frame(electricity_consumption_rolling),
+        }
+        self.electricity_daily_chart = self.chart(
+            "electricityDaily",
+            line_plot,
+            electricity_consumption_daily,
+            "Electricity Consumption Daily",
         )
 
-        self.electricity_rolling_chart = line_plot(
-            electricity_consumption_rolling, "Electricity Consumption Rolling"
+        self.electricity_rolling_chart = self.chart(
+            "electricityRolling",
+            line_plot,
+            electricity_consumption_rolling,
+            "Electricity Consumption Rolling",
         )
 
     def gas_charts(self):
         """A series of gas charts based on consumption data"""
-        gas_consumption_daily = self.gas_consumption.resample("D").sum(
-            numeric_only=True
-        )
+        gas_consumption_daily = self.rollups.get("gas", "daily")[["consumption"]]
         gas_consumption_rolling = (
-            self.gas_consumption["consumption"]
-            .sort_index()
-            .rolling(24 * 2 * 30)
-            .sum(numeric_only=True)
-        )
-        # Volume correction * Calorific Value / convert from joules
-        gas_conversion_factor = 1.02264 * 39.1 / 3.6
-        # consumption * gasConversionFactor = kWh
-        hourly = (
-            octopusData.gas_consumption["consumption"]
-            .resample("H")
-            .sum(numeric_only=True)
-        )
-        gas_consumption = (
-            hourly.where((hourly.index < "2021-01-01") & (hourly > 0.1))
-            .sort_values(ascending=False)
-            .dropna()
-            * gas_conversion_factor
-        )
-        now = datetime.now()
-        last_year = now + relativedelta(years=-1)
-        # Winter 2022, after adjustment to lower flow temp in January
-        gas_consumption_2022 = (
-            hourly.where(
-                (hourly.index > "2021-09-30")
-                & (hourly.index < "2022-10-01")
-                & (hourly > 0.1)
-            )
-            .sort_values(ascending=False)
-            .dropna()
-            * gas_conversion_factor
+            self.rollups.get("gas", "hourly")["consumption"].rolling("30D").sum()
         )
-        gas_consumption_2023 = (
-            hourly.where(
-                (hourly.index > "2022-09-30")
-                & (hourly.index < "2023-10-01")
-                & (hourly > 0.1)
-            )
-            .sort_values(ascending=False)
-            .dropna()
-            * gas_conversion_factor
+        hourly = self.rollups.get("gas", "hourly")["consumption"]
+        self.fingerprints = {**self.fingerprints, "gasHourly": fingerprint(hourly)}
+        edges, seasons = season_histograms(hourly)
+        all_seasons = sum(seasons.values())
+
+        self.series = {
+            **self.series,
+            "gasDaily": columns.from_frame(gas_consumption_daily),
+            "gasRolling": columns.from_frame(gas_consumption_rolling),
+            "gasConsumptionBinned": columns.histogram_columns(edges, all_seasons),
+            **{
+                "gasConsumption%sBinned"
+                % season: columns.histogram_columns(edges, counts)
+                for season, counts in seasons.items()
+            },
+        }
+        self.gas_consumption_binned_chart = self.chart(
+            "gasConsumptionBinned",
+            histogram_plot,
+            (edges, all_seasons),
+            "Gas Consumption",
         )
-        gas_consumption_2024 = (
-            hourly.where(
-                (hourly.index > "2023-09-30")
-                & (hourly.index < now.isoformat())
-                & (hourly > 0.1)
+        self.gas_season_charts = {
+            season: self.chart(
+                "gasConsumption%sBinned" % season,
+                histogram_plot,
+                (edges, counts),
+                "Gas Consumption %s" % season,
             )
-            .sort_values(ascending=False)
-            .dropna()
-            * gas_conversion_factor
-        )
+            for season, counts in seasons.items()
+        }
 
-        self.gas_consumption_binned_chart = histogram_plot(
-            gas_consumption, "Gas Consumption"
-        )
-        self.gas_consumption_2022_binned_chart = histogram_plot(
-            gas_consumption_2022, "Gas Consumption 2022"
+        self.gas_daily_chart = self.chart(
+            "gasDaily", line_plot, gas_consumption_daily, "Gas Consumption Daily"
         )
-        self.gas_consumption_2023_binned_chart = histogram_plot(
-            gas_consumption_2023, "Gas Consumption 2023"
-        )
-        self.gas_consumption_2024_binned_chart = histogram_plot(
-            gas_consumption_2024, "Gas Consumption 2024"
-        )
-
-        self.gas_daily_chart = line_plot(gas_consumption_daily, "Gas Consumption Daily")
-        self.gas_rolling_chart = line_plot(
-            gas_consumption_rolling, "Gas Consumption Rolling"
+        self.gas_rolling_chart = self.chart(
+            "gasRolling", line_plot, gas_consumption_rolling, "Gas Consumption Rolling"
         )
 
 
@@ -198,7 +598,23 @@ cfg.read_file(open("config.ini"))
 # https://github.com/crdoconnor/strictyaml
 # https://nestedtext.org/
 
-client = OctopusEnergy(cfg)
+chart_cache = ChartCache(cfg["octopus"].getint("CHART_CACHE_SIZE", 32))
+
+
+def household_data(household_cfg, read_only=False):
+    """
+    An empty OctopusData for a household, see households.py. A read only
+    one never writes to the household's files.
+    """
+    return OctopusData(
+        store=ParquetStore(
+            household_cfg["octopus"].get("DATA_DIR", "./data"), read_only
+        )
+    )
+
 
-octopusData = OctopusData()
-octopusData.update(client)
+# The endpoints ask households for a household's snapshot, households owns
+# the update loop. Only the default household's last snapshot is read here,
+# its history is loaded and refreshed once the server is running.
+households = Households.from_config(cfg, household_data)
+households.snapshot()
@@ -0,0 +1,288 @@
+"""Backfill, and export, the whole consumption history from the command line
+
+The first run against an account with years of readings is best done once,
+at full speed, before starting the server:
+
+python backfill.py
+python backfill.py --export export --format csv --periods daily weekly
+
+The history from OCTOPUS_JOIN_DATETIME on is split into the same fixed
+windows the app uses (OctopusEnergy.windows_around), fetched
+BACKFILL_CONCURRENCY at a time and written to the ParquetStore as each one
+arrives. Every window written is then recorded in a journal,
+DATA_DIR/backfill.jsonl, synced to disk, so after a crash, or a network
+timeout, running it again only fetches the windows that aren't in the
+journal. The window up to now is never recorded, so it is fetched each
+time. --restart forgets the journal and fetches everything again.
+
+Progress and throughput are printed as each window completes. The totals
+the app keeps (rollups.py) are rebuilt for any fuel that gained readings.
+
+--export writes each fuel's readings, and its hourly, daily, weekly or
+monthly totals, to parquet or CSV files in a directory; weekly totals are
+labelled with the Sunday the week ends on, as in weekly.csv.
+
+The refresh lock (households.py) is held throughout, so it won't run
+while a server is refreshing the same data.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import configparser as cp
+import json
+import os
+from os.path import exists, join
+import sys
+import time
+from households import REFRESH_LOCK_FILE
+from octopus import OctopusEnergy
+from rollups import PERIODS, Rollups, rollup
+from store import ParquetStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+JOURNAL_FILE = "backfill.jsonl"
+FUELS = {
+    "electricity": OctopusEnergy.FuelType.ELECTRIC,
+    "gas": OctopusEnergy.FuelType.GAS,
+}
+
+
+def window_key(dataset, window):
+    start, end = window
+    return dataset, start.isoformat(), end.isoformat()
+
+
+class Journal(object):
+    """The windows written so far, one JSON line each, synced as they're added"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line, cut short by a crash
+                        continue
+                    self.done.add((entry["dataset"], entry["start"], entry["end"]))
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def record(self, dataset, window, rows):
+        """Add a window whose readings are in the store; not the one up to now"""
+        key = window_key(dataset, window)
+        entry = {"dataset": key[0], "start": key[1], "end": key[2], "rows": rows}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add(key)
+
+    def clear(self):
+        if exists(self.path):
+            os.remove(self.path)
+        self.done = set()
+
+
+class Progress(object):
+    """Windows and readings so far, and how quickly they're coming in"""
+
+    def __init__(self, windows, out=sys.stderr):
+        self.windows = windows
+        self.out = out
+        self.done = 0
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    def window(self, dataset, window, rows):
+        self.done += 1
+        self.rows += rows
+        seconds = time.perf_counter() - self.started
+        rate = self.rows / seconds if seconds else 0.0
+        remaining = seconds / self.done * (self.windows - self.done)
+        start, end = window
+        print(
+            "%d/%d %s %s to %s: %d readings, %d in all, %.0f a second, "
+            "%.0fs to go"
+            % (
+                self.done,
+                self.windows,
+                dataset,
+                start.date(),
+                "now" if end is None else end.date(),
+                rows,
+                self.rows,
+                rate,
+                remaining,
+            ),
+            file=self.out,
+            flush=True,
+        )
+
+
+def rebuild_rollups(store, fuel):
+    """
+    The totals from scratch, for readings written behind the app's back.
+    Left for the app to build if it hasn't yet.
+    """
+    readings = None
+    for period, freq in PERIODS.items():
+        dataset = "%s_%s" % (fuel, period)
+        if store.empty(dataset):
+            continue
+        if readings is None:
+            readings = store.read(fuel)
+        store.write(dataset, rollup(readings, freq))
+    if readings is not None:
+        Rollups(store).mark([fuel])
+
+
+def backfill(client, store, journal, fuels=tuple(FUELS), concurrency=4, out=None):
+    """
+    Fetch every window of `fuels` not in the journal, writing each to the
+    store and then the journal. Returns the windows that failed.
+    """
+    page_size = int(client.cfg["octopus"]["CONSUMPTION_PAGE_SIZE"])
+    todo = [
+        (fuel, window)
+        for fuel in fuels
+        for window in client.windows_around()
+        if window[1] is None or window_key(fuel, window) not in journal
+    ]
+    progress = Progress(len(todo), out or sys.stderr)
+    failed = []
+    gained = set()
+
+    def fetch(fuel, window):
+        return client.consumption_pages(
+            FUELS[fuel], **client.window_params(window, page_size)
+        )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(fetch, *job): job for job in todo}
+        for future in as_completed(futures):
+            fuel, window = futures[future]
+            try:
+                table = future.result()
+            except OctopusEnergy.DataUnavailable as e:
+                print("%s %s failed: %s" % (fuel, window, e), file=progress.out)
+                failed.append((fuel, window))
+                continue
+            # the store is written from this thread only
+            if store.write_table(fuel, table):
+                gained.add(fuel)
+            if window[1] is not None:
+                journal.record(fuel, window, table.num_rows)
+            progress.window(fuel, window, table.num_rows)
+
+    for fuel in gained:
+        rebuild_rollups(store, fuel)
+    return failed
+
+
+def export(store, directory, fmt="parquet", periods=("weekly",)):
+    """
+    Each fuel's readings, and its totals for `periods`, as parquet or csv
+    files in `directory`, e.g. gas.csv and gas_weekly.csv. Returns their
+    paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for fuel in FUELS:
+        readings = store.read(fuel)
+        if readings.empty:
+            continue
+        tables = {fuel: (readings, None)}
+        for period in periods:
+            # days, weeks and months are labelled with a date, as weekly.csv
+            date_format = None if period == "hourly" else "%Y-%m-%d"
+            tables["%s_%s" % (fuel, period)] = (
+                rollup(readings, PERIODS[period]),
+                date_format,
+            )
+        for name, (table, date_format) in tables.items():
+            path = join(directory, "%s.%s" % (name, fmt))
+            if fmt == "csv":
+                table.to_csv(path, date_format=date_format)
+            else:
+                table.to_parquet(path)
+            paths.append(path)
+    return paths
+
+
+def lock(data_dir):
+    """The refresh lock, or None if a server is holding it"""
+    os.makedirs(data_dir, exist_ok=True)
+    lock_file = open(join(data_dir, REFRESH_LOCK_FILE), "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+    return lock_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="config.ini")
+    parser.add_argument("--fuels", nargs="+", choices=list(FUELS), default=list(FUELS))
+    parser.add_argument("--concurrency", type=int, help="default BACKFILL_CONCURRENCY")
+    parser.add_argument(
+        "--restart", action="store_true", help="forget the journal, fetch everything"
+    )
+    parser.add_argument(
+        "--no-fetch", action="store_true", help="only export what is stored"
+    )
+    parser.add_argument("--export", metavar="DIRECTORY")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument(
+        "--periods", nargs="*", choices=list(PERIODS), default=["weekly"]
+    )
+    args = parser.parse_args(argv)
+
+    cfg = cp.ConfigParser()
+    cfg.read(args.config)
+    octopus = cfg["octopus"]
+    data_dir = octopus.get("DATA_DIR", "./data")
+    lock_file = lock(data_dir)
+    if lock_file is None:
+        print("%s is being refreshed by a server, stop it first" % data_dir)
+        return 2
+    store = ParquetStore(data_dir)
+    failed = []
+    with lock_file:
+        if not args.no_fetch:
+            journal = Journal(join(data_dir, JOURNAL_FILE))
+            if args.restart:
+                journal.clear()
+            started = time.perf_counter()
+            failed = backfill(
+                OctopusEnergy(cfg),
+                store,
+                journal,
+                args.fuels,
+                args.concurrency or octopus.getint("BACKFILL_CONCURRENCY", 4),
+            )
+            print(
+                "Backfilled in %.1fs, %d windows failed%s"
+                % (
+                    time.perf_counter() - started,
+                    len(failed),
+                    ", run it again to fetch them" if failed else "",
+                )
+            )
+        if args.export:
+            for path in export(store, args.export, args.format, args.periods):
+                print("Exported %s" % path)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+"""Benchmarks, run from the top of the repository e.g. python -m benchmarks.ingest"""
@@ -0,0 +1,254 @@
+"""A local fake of the Octopus API, for benchmarks
+
+Serves the end points the clients use: electricity meter-point, paginated
+consumption for both fuels and paginated Agile unit rates, from synthetic
+data (see synthetic.py). Like the real API, results are newest first unless
+order_by=period, filtered by period_from/period_to, and page_size is capped.
+Every request can be delayed by a fixed latency, and runs of readings can be
+left out, as gaps. Faults can be injected, to try the retries, timeouts and
+circuit breaker (transport.py) against: a share of requests answered 503,
+or 429 with a Retry-After header, or stalled, and the whole API down.
+https://developer.octopus.energy/docs/api/
+
+python -m benchmarks.fakeapi --years 2 --port 8001
+python -m benchmarks.fakeapi --errors 0.2 --throttled 0.1 --stalls 0.05
+"""
+import argparse
+import asyncio
+from contextlib import contextmanager
+import json
+import random
+import threading
+import time
+from urllib.parse import urlencode
+import numpy as np
+import pandas as pd
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from benchmarks import synthetic
+
+FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class Results(object):
+    """One dataset as pre-formatted JSON objects, by timestamp"""
+
+    def __init__(self, times, objects):
+        self.times = np.asarray(times.asi8)
+        self.objects = objects
+
+    @classmethod
+    def consumption(cls, frame):
+        starts = frame.index.strftime(FORMAT)
+        ends = frame["interval_end"].dt.strftime(FORMAT)
+        return cls(
+            frame.index,
+            [
+                '{"consumption":%s,"interval_start":"%s","interval_end":"%s"}'
+                % (value, start, end)
+                for value, start, end in zip(
+                    frame["consumption"].tolist(), starts, ends
+                )
+            ],
+        )
+
+    @classmethod
+    def rates(cls, frame):
+        starts = frame.index.strftime(FORMAT)
+        ends = frame["valid_to"].dt.strftime(FORMAT)
+        return cls(
+            frame.index,
+            [
+                '{"value_exc_vat":%s,"value_inc_vat":%s,"valid_from":"%s",'
+                '"valid_to":"%s","payment_method":null}' % row
+                for row in zip(
+                    frame["value_exc_vat"].tolist(),
+                    frame["value_inc_vat"].tolist(),
+                    starts,
+                    ends,
+                )
+            ],
+        )
+
+    def page(self, request, page_limit):
+        """A page of results for the request's query, as JSON bytes"""
+        query = request.query_params
+        first, last = 0, len(self.times)
+        if "period_from" in query:
+            start = pd.Timestamp(query["period_from"]).value
+            first = np.searchsorted(self.times, start, side="left")
+        if "period_to" in query:
+            end = pd.Timestamp(query["period_to"]).value
+            last = np.searchsorted(self.times, end, side="left")
+        objects = self.objects[first:last]
+        if query.get("order_by") != "period":
+            objects = objects[::-1]
+
+        page_size = min(int(query.get("page_size", 100)), page_limit)
+        page = int(query.get("page", 1))
+        results = objects[(page - 1) * page_size : page * page_size]
+        next_page = None
+        if page * page_size < len(objects):
+            next_query = dict(query)
+            next_query["page"] = str(page + 1)
+            next_page = str(request.url.replace(query=urlencode(next_query)))
+        return (
+            '{"count":%d,"next":%s,"previous":null,"results":[%s]}'
+            % (len(objects), json.dumps(next_page), ",".join(results))
+        ).encode()
+
+
+class FakeOctopus(object):
+    """
+    The fake API's data and settings. `latency` is seconds added to every
+    request, `page_limit` the largest page_size allowed and `gaps` the
+    number of runs of readings missing from each fuel.
+
+    Of the requests, a share `errors` is answered 503, `throttled` 429 with
+    Retry-After: `retry_after` and `stalls` only after `stall_seconds`.
+    With `down` set, every request is answered 503.
+    """
+
+    def __init__(
+        self,
+        years=1,
+        latency=0.0,
+        page_limit=25000,
+        gaps=0,
+        agile_days=31,
+        seed=0,
+        errors=0.0,
+        throttled=0.0,
+        retry_after=1,
+        stalls=0.0,
+        stall_seconds=60.0,
+    ):
+        self.years = years
+        self.latency = latency
+        self.page_limit = page_limit
+        self.errors = errors
+        self.throttled = throttled
+        self.retry_after = retry_after
+        self.stalls = stalls
+        self.stall_seconds = stall_seconds
+        self.down = False
+        self._random = random.Random(seed)
+        self.electricity = synthetic.consumption(years, "electricity", gaps, seed=seed)
+        self.gas = synthetic.consumption(years, "gas", gaps, seed=seed + 1)
+        # rates are published up to 11pm tomorrow
+        today = pd.Timestamp.now(tz="UTC").floor("D")
+        rate_times = pd.date_range(
+            today - pd.Timedelta(days=agile_days),
+            today + pd.Timedelta(hours=47),
+            freq=synthetic.SLOT,
+        )
+        self.agile = synthetic.agile_rates(rate_times, seed)
+        self.results = {
+            "electricity": Results.consumption(self.electricity),
+            "gas": Results.consumption(self.gas),
+            "agile": Results.rates(self.agile),
+        }
+        self.requests = 0
+        self.bytes_sent = 0
+        # requests answered with an error, or stalled
+        self.faults = 0
+
+    @property
+    def first(self):
+        """The first reading, for OCTOPUS_JOIN_DATETIME"""
+        return min(self.electricity.index[0], self.gas.index[0])
+
+    async def respond(self, request, content):
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        draw = self._random.random()
+        if self.down or draw < self.errors:
+            self.faults += 1
+            return Response(status_code=503)
+        if draw < self.errors + self.throttled:
+            self.faults += 1
+            return Response(
+                status_code=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        if draw < self.errors + self.throttled + self.stalls:
+            self.faults += 1
+            await asyncio.sleep(self.stall_seconds)
+        self.bytes_sent += len(content)
+        return Response(content=content, media_type="application/json")
+
+    def app(self):
+        app = FastAPI()
+
+        @app.get("/v1/electricity-meter-points/{mpan}/")
+        async def meter_point(request: Request, mpan: str):
+            content = json.dumps({"gsp": "_H", "mpan": mpan, "profile_class": 1})
+            return await self.respond(request, content.encode())
+
+        @app.get("/v1/electricity-meter-points/{mpan}/meters/{serial}/consumption/")
+        async def electricity(request: Request, mpan: str, serial: str):
+            page = self.results["electricity"].page(request, self.page_limit)
+            return await self.respond(request, page)
+
+        @app.get("/v1/gas-meter-points/{mprn}/meters/{serial}/consumption/")
+        async def gas(request: Request, mprn: str, serial: str):
+            page = self.results["gas"].page(request, self.page_limit)
+            return await self.respond(request, page)
+
+        @app.get(
+            "/v1/products/{product}/electricity-tariffs/{tariff}/standard-unit-rates/"
+        )
+        async def unit_rates(request: Request, product: str, tariff: str):
+            page = self.results["agile"].page(request, self.page_limit)
+            return await self.respond(request, page)
+
+        return app
+
+
+@contextmanager
+def serve(app, host="127.0.0.1", port=0):
+    """Run `app` in a background thread, giving its base URL"""
+    server = uvicorn.Server(
+        uvicorn.Config(app, host=host, port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield "http://%s:%d" % (host, port)
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-limit", type=int, default=25000)
+    parser.add_argument("--gaps", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--errors", type=float, default=0.0, help="share 503")
+    parser.add_argument("--throttled", type=float, default=0.0, help="share 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--stalls", type=float, default=0.0, help="share stalled")
+    parser.add_argument("--stall-seconds", type=float, default=60.0)
+    args = parser.parse_args()
+    fake = FakeOctopus(
+        args.years,
+        args.latency,
+        args.page_limit,
+        args.gaps,
+        errors=args.errors,
+        throttled=args.throttled,
+        retry_after=args.retry_after,
+        stalls=args.stalls,
+        stall_seconds=args.stall_seconds,
+    )
+    print("OCTOPUS_JOIN_DATETIME = %s" % fake.first)
+    uvicorn.run(fake.app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
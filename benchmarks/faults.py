@@ -0,0 +1,233 @@
+"""Checks of the retries, timeouts, rate limit and circuit breaker
+
+Each check runs an API client against the fake API (fakeapi.py) with one
+kind of fault injected, and checks how many requests and retries it made,
+how long it took and what state the circuit breaker was left in, see
+transport.py. Both clients are checked, as each has its own retry loop.
+
+python -m benchmarks.faults
+
+Prints a line per check and exits 1 if any failed.
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from benchmarks.fakeapi import FakeOctopus, serve
+from benchmarks.suite import write_config
+
+# retries and timeouts short enough for the checks to be quick
+SETTINGS = {
+    "HTTP_CONNECT_TIMEOUT": "1",
+    "HTTP_READ_TIMEOUT": "0.2",
+    "HTTP_RETRIES": "3",
+    "HTTP_BACKOFF": "0.01",
+    "HTTP_BACKOFF_CAP": "2",
+    "API_RATE": "0",
+    "CIRCUIT_FAILURES": "6",
+    "CIRCUIT_RESET": "0.5",
+}
+
+
+def equals(expected):
+    return lambda value: value == expected
+
+
+class Client(object):
+    """A fresh sync or async client, with the transport set up from `settings`"""
+
+    def __init__(self, workdir, url, first, kind, **settings):
+        cfg = write_config(workdir, url, first)
+        cfg.read_dict({"octopus": {**SETTINGS, **settings}})
+        self.kind = kind
+        if kind == "sync":
+            from octopus import OctopusEnergy
+
+            self.client = OctopusEnergy(cfg)
+        else:
+            from octopus_async import AsyncOctopusEnergy
+
+            self.client = AsyncOctopusEnergy(cfg)
+        self.transport = self.client.transport
+
+    def get(self):
+        """
+        GET the meter-point, returning (succeeded, seconds). Asks for a new
+        connection pool each time, as each call has its own event loop.
+        """
+        started = time.perf_counter()
+        try:
+            if self.kind == "sync":
+                self.client.electricity_meter_point()
+            else:
+
+                async def get():
+                    try:
+                        await self.client.electricity_meter_point()
+                    finally:
+                        await self.client.aclose()
+
+                asyncio.run(get())
+        except self.client.DataUnavailable:
+            return False, time.perf_counter() - started
+        return True, time.perf_counter() - started
+
+
+class Checks(object):
+    """Runs the checks, counting the fake API's requests for each"""
+
+    def __init__(self, fake, workdir, url):
+        self.fake = fake
+        self.workdir = workdir
+        self.url = url
+        self.failed = 0
+
+    def client(self, kind, **settings):
+        return Client(self.workdir, self.url, self.fake.first, kind, **settings)
+
+    def faults(self, errors=0.0, throttled=0.0, stalls=0.0, down=False, **settings):
+        self.fake.errors = errors
+        self.fake.throttled = throttled
+        self.fake.stalls = stalls
+        self.fake.down = down
+        for name, value in settings.items():
+            setattr(self.fake, name, value)
+
+    def check(self, name, **expected):
+        """expected as name=(value, predicate) pairs"""
+        problems = [
+            "%s=%r" % (what, value)
+            for what, (value, ok) in expected.items()
+            if not ok(value)
+        ]
+        self.failed += bool(problems)
+        print(
+            "%-50s %s" % (name, "FAIL " + ", ".join(problems) if problems else "ok"),
+            flush=True,
+        )
+
+    def call(self, client):
+        """(succeeded, seconds, requests made)"""
+        before = self.fake.requests
+        succeeded, seconds = client.get()
+        return succeeded, seconds, self.fake.requests - before
+
+    def run(self, kind):
+        # every answer 503: the first attempt and 3 retries, then give up
+        self.faults(errors=1.0)
+        client = self.client(kind)
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s 503: retried, then gave up" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(4)),
+            breaker=(client.transport.breaker.state, equals("closed")),
+        )
+        # two more failures open the circuit, after which nothing is sent
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s 503: circuit opens after 6 failures" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(2)),
+            breaker=(client.transport.breaker.state, equals("open")),
+        )
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s circuit open: fails fast, no request" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(0)),
+            seconds=(seconds, lambda s: s < 0.1),
+        )
+        # the API is back: after the reset, one trial closes it again
+        self.faults()
+        time.sleep(client.transport.breaker.reset)
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s circuit half open: trial request closes it" % kind,
+            succeeded=(succeeded, equals(True)),
+            requests=(requests, equals(1)),
+            breaker=(client.transport.breaker.state, equals("closed")),
+        )
+
+        # a 503 now and then: retried until it succeeds
+        self.faults(errors=0.5)
+        self.fake._random.seed(1)
+        client = self.client(kind)
+        results = [self.call(client) for _ in range(10)]
+        self.check(
+            "%s some 503s: every request succeeds" % kind,
+            succeeded=([r[0] for r in results], lambda r: all(r)),
+            retries=(sum(r[2] for r in results) - 10, lambda n: n > 0),
+        )
+
+        # 429 with Retry-After: 1, waited for rather than the backoff
+        self.faults(throttled=1.0, retry_after=1)
+        client = self.client(kind, HTTP_RETRIES="1")
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s 429: waits Retry-After, then gives up" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(2)),
+            seconds=(seconds, lambda s: 1 <= s < 1.5),
+        )
+        # a Retry-After longer than the cap isn't waited for at all
+        self.faults(throttled=1.0, retry_after=3600)
+        client = self.client(kind)
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s 429: Retry-After over the cap, no retry" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(1)),
+            seconds=(seconds, lambda s: s < 0.5),
+        )
+
+        # stalled responses: each attempt cut off by the read timeout
+        self.faults(stalls=1.0, stall_seconds=5)
+        client = self.client(kind)
+        succeeded, seconds, requests = self.call(client)
+        self.check(
+            "%s stalls: timed out and retried, in bounded time" % kind,
+            succeeded=(succeeded, equals(False)),
+            requests=(requests, equals(4)),
+            seconds=(seconds, lambda s: 0.8 <= s < 2.5),
+        )
+
+        # the API down: the circuit opens after CIRCUIT_FAILURES attempts
+        self.faults(down=True)
+        client = self.client(kind, HTTP_RETRIES="0", CIRCUIT_FAILURES="3")
+        requests = sum(self.call(client)[2] for _ in range(10))
+        self.check(
+            "%s down: 3 attempts, then the circuit is open" % kind,
+            requests=(requests, equals(3)),
+            breaker=(client.transport.breaker.state, equals("open")),
+        )
+
+        # the token bucket: 20 a second with no burst, 11 take half a second
+        self.faults()
+        client = self.client(kind, API_RATE="20", API_BURST="1")
+        started = time.perf_counter()
+        for _ in range(11):
+            self.call(client)
+        self.check(
+            "%s rate limit: 11 requests at 20 a second" % kind,
+            seconds=(time.perf_counter() - started, lambda s: 0.5 <= s < 1.0),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", nargs="+", default=["sync", "async"])
+    args = parser.parse_args()
+    fake = FakeOctopus(1, agile_days=1)
+    with serve(fake.app()) as url, tempfile.TemporaryDirectory() as workdir:
+        checks = Checks(fake, workdir, url)
+        for kind in args.clients:
+            checks.run(kind)
+        # leave no request stalled for the server to wait on
+        checks.faults()
+    return 1 if checks.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""Parse time and peak memory: pandas, whole page Arrow and streaming Arrow
+
+pandas is json.loads and a DataFrame of dicts, as octopus.py used to; arrow
+reads the whole body at once (octopus_2.parse_page); stream feeds it in
+chunks as it would arrive (pages.py), +frame includes making the frame.
+
+Each parser is run on the same synthetic page of consumption readings, read
+from a file by a fresh process, so that neither making the page nor another
+parser's peak memory hides its own.
+
+python -m benchmarks.ingest --readings 25000 100000 --repeat 5
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+def consumption_page(readings, start="2020-04-10 23:30:00+00:00"):
+    """A page of `readings` half hourly readings, as the API sends it"""
+    starts = pd.date_range(start, periods=readings, freq="30 min")
+    ends = starts + pd.Timedelta("30 min")
+    values = np.random.default_rng(0).gamma(2, 0.15, readings).round(3)
+    fmt = "%Y-%m-%dT%H:%M:%SZ"
+    results = [
+        {"consumption": value, "interval_start": s, "interval_end": e}
+        for value, s, e in zip(
+            values.tolist(), starts.strftime(fmt), ends.strftime(fmt)
+        )
+    ]
+    return json.dumps(
+        {"count": readings, "next": None, "previous": None, "results": results}
+    ).encode()
+
+
+def parse_pandas(content):
+    from octopus import OctopusEnergy
+
+    return OctopusEnergy.consumption_from_response(json.loads(content))
+
+
+def parse_arrow(content):
+    from octopus_2 import CONSUMPTION_SCHEMA, parse_page
+
+    return parse_page(content, CONSUMPTION_SCHEMA)[0]
+
+
+def parse_stream(content):
+    from pages import CHUNK_SIZE, CONSUMPTION_SCHEMA, read_results
+
+    chunks = (
+        content[start : start + CHUNK_SIZE]
+        for start in range(0, len(content), CHUNK_SIZE)
+    )
+    return read_results(chunks, CONSUMPTION_SCHEMA)[0]
+
+
+def parse_stream_frame(content):
+    from pages import to_frame
+
+    return to_frame(parse_stream(content), "interval_start")
+
+
+PARSERS = {
+    "pandas": parse_pandas,
+    "arrow": parse_arrow,
+    "stream": parse_stream,
+    "stream+frame": parse_stream_frame,
+}
+
+
+def run(parser, path, repeat):
+    """
+    Best time, and peak memory allocated while parsing: Python objects, by
+    tracemalloc, plus Arrow's own buffers, which tracemalloc can't see
+    """
+    import pyarrow as pa
+    import octopus, octopus_2, pages  # noqa: F401 imported before measuring
+
+    with open(path, "rb") as f:
+        content = f.read()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        readings = len(PARSERS[parser](content))
+        times.append(time.perf_counter() - started)
+
+    pool = pa.default_memory_pool()
+    arrow_before = pool.bytes_allocated()
+    tracemalloc.start()
+    result = PARSERS[parser](content)
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    arrow_peak = pool.max_memory() - arrow_before
+    return {
+        "parser": parser,
+        "readings": readings,
+        "bytes": len(content),
+        "seconds": min(times),
+        "peak_mib": (python_peak + arrow_peak) / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readings", type=int, nargs="+", default=[25000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for readings in args.readings:
+            path = os.path.join(directory, "%d.json" % readings)
+            with open(path, "wb") as f:
+                f.write(consumption_page(readings))
+            for name in PARSERS:
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    result = executor.submit(run, name, path, args.repeat).result()
+                results.append(result)
+                print(
+                    "%(parser)-12s %(readings)8d readings %(seconds)8.3f s "
+                    "%(peak_mib)8.1f MiB peak" % result
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Benchmarks for the app against a local fake Octopus API
+
+For each amount of history, the fake API (fakeapi.py) serves synthetic
+readings and each scenario runs in a fresh process, in a working directory
+with its own config.ini pointing at the fake API:
+
+cold_start          import app with an empty store, then its first refresh,
+                    fetching everything
+restart             import app again, then its first refresh, loading the
+                    store, nothing new to fetch
+refresh             OctopusData.update, with the sync client
+refresh_async       Households.refresh, with the async client
+arrow_cold_start    octopus_2.update_data into an empty store
+backfill_refresh    backfill.py into an empty store, less its last day, then
+                    the app's first refresh over it, which has to store the
+                    day it fetches next to the backfilled readings
+endpoints           each HTTP end point of main.py, in process
+
+Times are wall clock seconds, startup_seconds just the import, before the
+server could listen; peak_rss_mib is the process's peak resident
+memory, peak_alloc_mib the most allocated, by Python and Arrow, during one
+more run of the step. Results are saved as JSON, by commit, to compare with
+later:
+
+python -m benchmarks.suite --years 1 5 10 --latency 0.05
+python -m benchmarks.suite --years 1 --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import configparser as cp
+import json
+import multiprocessing
+import os
+from os.path import dirname, join
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from benchmarks.fakeapi import FakeOctopus, serve
+
+ROOT = dirname(dirname(os.path.abspath(__file__)))
+RESULTS = join(ROOT, "benchmarks", "results")
+
+ENDPOINTS = [
+    "/startpage",
+    "/starttimes",
+    "/consumption",
+    "/series",
+    "/series/electricityDaily",
+    "/series/gasRolling",
+    "/rollups/electricity/hourly",
+    "/rollups/gas/daily",
+    "/seasons",
+]
+
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def peak_alloc_mib(step):
+    """Most memory allocated by Python objects and Arrow buffers during step()"""
+    import pyarrow as pa
+
+    pool = pa.default_memory_pool()
+    arrow_before = pool.bytes_allocated()
+    tracemalloc.start()
+    step()
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (python_peak + max(pool.max_memory() - arrow_before, 0)) / 2**20
+
+
+def timed(step, repeat=1):
+    """Median seconds over `repeat` runs of step()"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - started)
+    return float(np.median(times))
+
+
+def write_config(workdir, url, first):
+    """config.ini for the app, pointing at the fake API"""
+    cfg = cp.ConfigParser()
+    cfg.read(join(ROOT, "config.ini"))
+    octopus = cfg["octopus"]
+    octopus["BASE_URL"] = url
+    octopus["OCTOPUS_JOIN_DATETIME"] = str(first)
+    octopus["DATA_DIR"] = join(workdir, "data")
+    octopus["APPLIANCES_FILE"] = join(workdir, "appliances.json")
+    # the fake API has no rate limit, pacing requests would only be measured
+    octopus["API_RATE"] = "0"
+    # scenarios share DATA_DIR/http, so a cache would answer for the API and
+    # every scenario after the first would make next to no requests
+    octopus["HTTP_CACHE"] = "no"
+    with open(join(workdir, "config.ini"), "w") as f:
+        cfg.write(f)
+    return cfg
+
+
+def readings(data):
+    return len(data.electricity_consumption) + len(data.gas_consumption)
+
+
+def cold_start(workdir, repeat):
+    os.chdir(workdir)
+    started = time.perf_counter()
+    import app
+
+    startup_seconds = time.perf_counter() - started
+    household = app.households.default
+    asyncio.run(app.households.refresh(household))
+    seconds = time.perf_counter() - started
+    count = readings(household.refresher.snapshot.data)
+    return {
+        "startup_seconds": startup_seconds,
+        "seconds": seconds,
+        "readings": count,
+        "readings_per_second": count / seconds,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def restart(workdir, repeat):
+    return cold_start(workdir, repeat)
+
+
+def refresh(workdir, repeat):
+    os.chdir(workdir)
+    import app
+
+    household = app.households.default
+    data = household.ensure_loaded().data
+
+    def step():
+        data.update(household.client)
+
+    return {
+        "seconds": timed(step, repeat),
+        "readings": readings(data),
+        "peak_alloc_mib": peak_alloc_mib(step),
+    }
+
+
+def refresh_async(workdir, repeat):
+    os.chdir(workdir)
+    import app
+
+    household = app.households.default
+
+    def step():
+        asyncio.run(app.households.refresh(household))
+        # the connection pool belongs to the loop that has just closed
+        household.async_client._client = None
+
+    return {
+        "seconds": timed(step, repeat),
+        "readings": readings(household.refresher.snapshot.data),
+        "peak_alloc_mib": peak_alloc_mib(step),
+    }
+
+
+def arrow_cold_start(workdir, repeat):
+    os.chdir(workdir)
+    from octopus_2 import ArrowOctopusEnergy, update_data
+    from store import ParquetStore
+
+    cfg = cp.ConfigParser()
+    cfg.read("config.ini")
+    store = ParquetStore(join(workdir, "arrow"))
+    started = time.perf_counter()
+    update_data(ArrowOctopusEnergy(cfg), store)
+    seconds = time.perf_counter() - started
+    count = sum(
+        entry["rows"]
+        for dataset in ("electricity", "gas")
+        for entry in store.manifest[dataset].values()
+    )
+    return {
+        "seconds": seconds,
+        "readings": count,
+        "readings_per_second": count / seconds,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def backfill_refresh(workdir, repeat):
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    import backfill
+    from metrics import REFRESH_FAILURES
+    from store import ParquetStore
+
+    # a store of its own, as the others' already has everything in it
+    os.makedirs(join(workdir, "backfill"), exist_ok=True)
+    os.chdir(join(workdir, "backfill"))
+    cfg = cp.ConfigParser()
+    cfg.read(join(workdir, "config.ini"))
+    data_dir = join(workdir, "backfill", "data")
+    cfg["octopus"]["DATA_DIR"] = data_dir
+    with open("config.ini", "w") as f:
+        cfg.write(f)
+    started = time.perf_counter()
+    if backfill.main(["--config", "config.ini"]) != 0:
+        raise RuntimeError("backfill failed")
+    backfill_seconds = time.perf_counter() - started
+
+    # as if the backfill ran yesterday: its newest partitions, as it wrote
+    # them, without the last day, for the refresh to add to
+    store = ParquetStore(data_dir)
+    for fuel in backfill.FUELS:
+        key = store.partitions(fuel)[-1]
+        path = store._partition_path(fuel, key)
+        table = pq.read_table(path)
+        cutoff = store.max(fuel) - pd.Timedelta(days=1)
+        pq.write_table(
+            table.filter(pc.less_equal(table["interval_start"], cutoff)), path
+        )
+        store.manifest[fuel][key]["max"] = cutoff.isoformat()
+    store._write_manifest()
+
+    started = time.perf_counter()
+    import app
+
+    household = app.households.default
+    asyncio.run(app.households.refresh(household))
+    seconds = time.perf_counter() - started
+    if REFRESH_FAILURES.value():
+        raise RuntimeError("the refresh after the backfill failed")
+    count = readings(household.refresher.snapshot.data)
+    stored = sum(len(ParquetStore(data_dir).read(fuel)) for fuel in backfill.FUELS)
+    if stored != count:
+        raise RuntimeError("%d readings stored, %d loaded" % (stored, count))
+    return {
+        "backfill_seconds": backfill_seconds,
+        "seconds": seconds,
+        "readings": count,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def endpoints(workdir, repeat):
+    os.chdir(workdir)
+    from fastapi.testclient import TestClient
+    import main
+
+    # no lifespan, so no background refreshes while measuring
+    client = TestClient(main.app)
+    results = {}
+    for path in ENDPOINTS:
+        sizes = []
+
+        def step():
+            response = client.get(path)
+            response.raise_for_status()
+            sizes.append(len(response.content))
+
+        latencies = [timed(step) for _ in range(repeat)]
+        results[path] = {
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "requests_per_second": repeat / sum(latencies),
+            "bytes": sizes[-1],
+            "peak_alloc_mib": peak_alloc_mib(step),
+        }
+    return results
+
+
+SCENARIOS = {
+    "cold_start": cold_start,
+    "restart": restart,
+    "refresh": refresh,
+    "refresh_async": refresh_async,
+    "arrow_cold_start": arrow_cold_start,
+    "backfill_refresh": backfill_refresh,
+    "endpoints": endpoints,
+}
+
+
+def run(years, args):
+    """Every scenario for `years` of history, each in a fresh process"""
+    fake = FakeOctopus(years, args.latency, args.page_limit, args.gaps)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with serve(fake.app()) as url, tempfile.TemporaryDirectory() as workdir:
+        write_config(workdir, url, fake.first)
+        for name in args.scenarios:
+            requests, bytes_sent = fake.requests, fake.bytes_sent
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                metrics = executor.submit(
+                    SCENARIOS[name], workdir, args.repeat
+                ).result()
+            if name != "endpoints":
+                metrics["api_requests"] = fake.requests - requests
+                metrics["api_bytes"] = fake.bytes_sent - bytes_sent
+            results.append({"years": years, "scenario": name, "metrics": metrics})
+            report(results[-1])
+    return results
+
+
+def report(result):
+    metrics = result["metrics"]
+    if result["scenario"] == "endpoints":
+        for path, m in metrics.items():
+            print(
+                "%2d years  %-28s p50 %8.4f s  p95 %8.4f s  %8.1f req/s  "
+                "%8.1f MiB"
+                % (
+                    result["years"],
+                    path,
+                    m["p50"],
+                    m["p95"],
+                    m["requests_per_second"],
+                    m["peak_alloc_mib"],
+                )
+            )
+        return
+    memory = metrics.get("peak_rss_mib", metrics.get("peak_alloc_mib"))
+    print(
+        "%2d years  %-28s %8.3f s  %8d readings  %6d requests  %8.1f MiB"
+        % (
+            result["years"],
+            result["scenario"],
+            metrics["seconds"],
+            metrics["readings"],
+            metrics["api_requests"],
+            memory,
+        )
+    )
+
+
+def seconds_by_step(results):
+    """{(years, scenario or end point): seconds} for comparing runs"""
+    seconds = {}
+    for result in results:
+        if result["scenario"] == "endpoints":
+            for path, m in result["metrics"].items():
+                seconds[result["years"], path] = m["p50"]
+        else:
+            seconds[result["years"], result["scenario"]] = result["metrics"]["seconds"]
+    return seconds
+
+
+def compare(results, path):
+    """Print how long each step took against a previous run"""
+    with open(path) as f:
+        previous = seconds_by_step(json.load(f)["results"])
+    for key, seconds in seconds_by_step(results).items():
+        if key in previous and previous[key] > 0:
+            print(
+                "%2d years  %-28s %8.3f s  was %8.3f s  x%.2f"
+                % (*key, seconds, previous[key], seconds / previous[key])
+            )
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, nargs="+", default=[1])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-limit", type=int, default=25000)
+    parser.add_argument("--gaps", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--output", help="default benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", help="a previous results file")
+    args = parser.parse_args()
+
+    results = []
+    for years in args.years:
+        results.extend(run(years, args))
+
+    output = args.output or join(RESULTS, "%s.json" % commit())
+    os.makedirs(dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": sys.version.split()[0],
+                "settings": {
+                    k: v for k, v in vars(args).items() if k not in ("output",)
+                },
+                "results": results,
+            },
+            f,
+            indent=1,
+        )
+    print("saved", output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
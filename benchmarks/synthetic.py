@@ -0,0 +1,82 @@
+"""Synthetic half hourly readings and Agile rates, for 1 to 10 years
+
+Readings have a daily shape, more in the evening, and a seasonal one, more
+gas in winter, plus noise, so that charts, rollups and seasons have
+something like real data to work on. Gaps, runs of missing half hours, can
+be cut out to exercise gap tracking and refetching.
+"""
+import numpy as np
+import pandas as pd
+
+SLOT = pd.Timedelta("30 min")
+
+
+def half_hours(years, end=None):
+    """`years` of half hours up to, not including, `end` (default now)"""
+    if end is None:
+        end = pd.Timestamp.now(tz="UTC").floor(SLOT)
+    start = end - pd.DateOffset(years=years)
+    return pd.date_range(start, end, freq=SLOT, inclusive="left")
+
+
+def readings(index, fuel="electricity", seed=0):
+    """Consumption for each half hour of `index`, electricity kWh or gas m3"""
+    rng = np.random.default_rng(seed)
+    hour = index.hour.to_numpy() + index.minute.to_numpy() / 60
+    day_of_year = index.dayofyear.to_numpy()
+    daily = 1 + 0.8 * np.exp(-(((hour - 19) / 3) ** 2))
+    winter = 1 + np.cos(2 * np.pi * (day_of_year - 15) / 365.25)
+    if fuel == "gas":
+        base = 0.05 + 0.4 * winter * (1 + 0.5 * np.exp(-(((hour - 7) / 2) ** 2)))
+    else:
+        base = 0.12 * daily * (1 + 0.2 * winter)
+    return (base * rng.gamma(4, 0.25, len(index))).round(3)
+
+
+def cut_gaps(index, gaps, seed=0, longest=48):
+    """`index` with `gaps` runs of 1 to `longest` half hours taken out"""
+    if not gaps:
+        return index
+    rng = np.random.default_rng(seed)
+    keep = np.ones(len(index), dtype=bool)
+    for start in rng.integers(1, len(index) - longest - 1, gaps):
+        keep[start : start + rng.integers(1, longest + 1)] = False
+    return index[keep]
+
+
+def consumption(years, fuel="electricity", gaps=0, end=None, seed=0):
+    """
+    Readings as OctopusEnergy returns them: consumption and interval_end,
+    indexed by interval_start
+    """
+    index = cut_gaps(half_hours(years, end), gaps, seed)
+    index.name = "interval_start"
+    return pd.DataFrame(
+        {
+            "consumption": readings(index, fuel, seed),
+            "interval_end": index + SLOT,
+        },
+        index=index,
+    )
+
+
+def agile_rates(index, seed=0):
+    """
+    Agile unit rates, p/kWh, for each half hour of `index`: cheap overnight,
+    dear from 4pm to 7pm, occasionally negative
+    """
+    rng = np.random.default_rng(seed)
+    hour = index.hour.to_numpy() + index.minute.to_numpy() / 60
+    price = 15 + 10 * np.sin(np.pi * (hour - 9) / 12) + rng.normal(0, 3, len(index))
+    price[(hour >= 16) & (hour < 19)] += 12
+    exc_vat = price.round(2)
+    index = index.rename("valid_from")
+    return pd.DataFrame(
+        {
+            "value_exc_vat": exc_vat,
+            "value_inc_vat": (exc_vat * 1.05).round(3),
+            "valid_to": index + SLOT,
+            "payment_method": None,
+        },
+        index=index,
+    )
@@ -0,0 +1,78 @@
+"""Content addressed cache for charts, and the ETags that go with it
+
+A chart is keyed on a fingerprint of the data it is drawn from plus its
+parameters, so a refresh that brings in no new readings finds every chart
+already built. The same fingerprints make strong ETags, letting a browser
+that already has the data get a 304 instead.
+https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+"""
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+import pandas as pd
+
+
+def fingerprint(*parts):
+    """
+    sha256, as hex, of numpy arrays, pandas objects and anything else by its
+    repr. Pandas objects are hashed by their index and values, not by repr,
+    which would leave most of the data out.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            part = part.select_dtypes("number")
+            digest.update(part.index.asi8.tobytes())
+            digest.update(np.ascontiguousarray(part.to_numpy()).tobytes())
+        elif isinstance(part, pd.Series):
+            digest.update(part.index.asi8.tobytes())
+            digest.update(np.ascontiguousarray(part.to_numpy()).tobytes())
+        elif isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (tuple, list)):
+            digest.update(fingerprint(*part).encode())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ChartCache(object):
+    """Least recently used cache of built charts, by fingerprint"""
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._charts = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._charts)
+
+    def get(self, key, build):
+        """The chart for `key`, calling build() to make it if it isn't cached"""
+        with self._lock:
+            if key in self._charts:
+                self._charts.move_to_end(key)
+                return self._charts[key]
+        chart = build()
+        with self._lock:
+            self._charts[key] = chart
+            while len(self._charts) > self.maxsize:
+                self._charts.popitem(last=False)
+        return chart
+
+
+def etag(*parts):
+    """A strong ETag, quoted as the header needs it"""
+    return '"%s"' % fingerprint(*parts)[:32]
+
+
+def not_modified(request, tag):
+    """True if the request's If-None-Match already has this ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or tag in [
+        t.strip() for t in if_none_match.split(",")
+    ]
@@ -0,0 +1,71 @@
+"""Compact binary encodings of chart data
+
+Rather than a plotly figure, JSON encoded and then JSON encoded again inside
+the response, the browser is sent just the numbers and fills in a small chart
+template (static/charts.json) itself.
+
+Packed: two little-endian columns of equal length, one after the other. The
+x column is int32 seconds since the epoch for time series, or float32 for
+histogram bins; the y column is always float32. 8 bytes a point, and the
+browser reads them straight into an Int32Array/Float32Array.
+
+Arrow: an Arrow IPC stream with `x` and `y` columns, for anything that can
+read Arrow, e.g. pyarrow or apache-arrow in javascript.
+https://arrow.apache.org/docs/format/Columnar.html#ipc-streaming-format
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+PACKED_MEDIA_TYPE = "application/octet-stream"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def time_series(series):
+    """A time indexed series as (seconds since the epoch, float32 values)"""
+    series = series.dropna()
+    seconds = (series.index.asi8 // 1_000_000_000).astype("<i4")
+    return seconds, series.to_numpy(dtype="<f4")
+
+
+def histogram_columns(edges, counts):
+    """Left edge of each bin and the count in each bin, see seasons.py"""
+    return np.asarray(edges, dtype="<f4"), np.asarray(counts, dtype="<f4")
+
+
+def pack(x, y):
+    """x then y, as raw little-endian bytes"""
+    return x.tobytes() + y.tobytes()
+
+
+def arrow(x, y):
+    """x and y as an Arrow IPC stream"""
+    if x.dtype.kind == "i":
+        x_array = pa.array(x.astype("int64"), type=pa.int64()).cast(
+            pa.timestamp("s", tz="UTC")
+        )
+    else:
+        x_array = pa.array(x)
+    return ipc_stream(pa.table({"x": x_array, "y": pa.array(y)}))
+
+
+def ipc_stream(table):
+    """Any Arrow table as an Arrow IPC stream"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode(columns, media_type=PACKED_MEDIA_TYPE):
+    """Encode (x, y) columns for the requested media type"""
+    if media_type == ARROW_MEDIA_TYPE:
+        return arrow(*columns)
+    return pack(*columns)
+
+
+def from_frame(frame):
+    """The consumption column of a frame, or a series, as a time series"""
+    if isinstance(frame, pd.DataFrame):
+        frame = frame["consumption"]
+    return time_series(frame)
@@ -0,0 +1 @@
+"""Lets the tests in tests/ import the app's modules, which sit at the top level"""
@@ -0,0 +1,164 @@
+"""Index of the gaps in the consumption readings
+
+Gaps are kept as half-open [start, end) intervals of missing half hours
+between the first and last reading, found with one diff over the sorted
+index rather than a full date_range and difference. New readings split or
+remove the gaps they fall in, and readings beyond either end add any new
+gaps there, so an update costs O(new readings).
+
+Each refresh asks the API for just the gaps, and counts how many times in a
+row a gap comes back empty. After GAP_ATTEMPTS tries it is left alone; some
+half hours the API will simply never have.
+"""
+import json
+import os
+from os.path import exists
+import numpy as np
+import pandas as pd
+
+SLOT = pd.Timedelta("30 m").value
+
+
+def find_gaps(index, start=None, end=None):
+    """
+    Missing half hours in a sorted DatetimeIndex as (starts, ends) arrays of
+    int64 nanoseconds. `start` and `end` extend the range looked at beyond
+    the first and last reading.
+    """
+    points = np.asarray(index.asi8, dtype=np.int64)
+    if start is not None:
+        points = np.concatenate([[pd.Timestamp(start).value - SLOT], points])
+    if end is not None:
+        points = np.concatenate([points, [pd.Timestamp(end).value]])
+    if len(points) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    step = np.diff(points)
+    holes = np.nonzero(step > SLOT)[0]
+    return points[holes] + SLOT, points[holes + 1]
+
+
+def _key(start, end):
+    """A gap as text, for the attempts JSON"""
+    return "/".join(
+        pd.Timestamp(pd.Timestamp(t).value, tz="UTC").isoformat() for t in (start, end)
+    )
+
+
+class GapIndex(object):
+    """
+    The gaps in one fuel's readings. update() returns a new GapIndex, so one
+    that has been published in a snapshot is never changed.
+    """
+
+    def __init__(self, starts, ends, first=None, last=None, attempts=None):
+        self.starts = starts
+        self.ends = ends
+        self.first = first
+        self.last = last
+        # empty refetches in a row, by gap
+        self.attempts = {} if attempts is None else attempts
+
+    @classmethod
+    def from_index(cls, index, attempts=None):
+        index = index.sort_values()
+        if index.empty:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        starts, ends = find_gaps(index)
+        return cls(starts, ends, index[0].value, index[-1].value, attempts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def missing(self):
+        """Number of missing half hours"""
+        return int(((self.ends - self.starts) // SLOT).sum())
+
+    def intervals(self):
+        """The gaps as (start, end) UTC timestamps"""
+        return [
+            (pd.Timestamp(s, tz="UTC"), pd.Timestamp(e, tz="UTC"))
+            for s, e in zip(self.starts, self.ends)
+        ]
+
+    def refetchable(self, max_attempts=3):
+        """The gaps still worth asking the API for"""
+        return [
+            (start, end)
+            for start, end in self.intervals()
+            if self.attempts.get(_key(start, end), 0) < max_attempts
+        ]
+
+    def update(self, new_index, refetched=()):
+        """
+        A GapIndex with `new_index`, new readings, filled in; readings that
+        were already there, such as corrected ones, change nothing.
+        `refetched` are the gaps that were asked for; those that are still
+        gaps afterwards have their attempt counted.
+        """
+        new = np.sort(np.asarray(new_index.asi8, dtype=np.int64))
+        if self.first is None:
+            gaps = GapIndex.from_index(pd.DatetimeIndex(new, tz="UTC"))
+            gaps.attempts = dict(self.attempts)
+            return gaps
+        starts, ends = list(self.starts), list(self.ends)
+
+        # split the gaps that new readings fall in
+        inside = new[(new >= self.first) & (new <= self.last)]
+        # readings already there, e.g. corrected ones, fill nothing
+        if len(inside) and len(self.starts):
+            gap = np.searchsorted(self.starts, inside, side="right") - 1
+            hit = (gap >= 0) & (inside < self.ends[np.maximum(gap, 0)])
+            for number in np.unique(gap[hit])[::-1]:
+                readings = inside[hit & (gap == number)]
+                start, end = self.starts[number], self.ends[number]
+                points = np.concatenate([[start - SLOT], readings, [end]])
+                holes = np.nonzero(np.diff(points) > SLOT)[0]
+                starts[number : number + 1] = list(points[holes] + SLOT)
+                ends[number : number + 1] = list(points[holes + 1])
+
+        # gaps in readings before the first and after the last
+        first, last = self.first, self.last
+        before, after = new[new < self.first], new[new > self.last]
+        if len(before):
+            s, e = find_gaps(
+                pd.DatetimeIndex(before, tz="UTC"), end=pd.Timestamp(first)
+            )
+            starts, ends = list(s) + starts, list(e) + ends
+            first = before[0]
+        if len(after):
+            s, e = find_gaps(
+                pd.DatetimeIndex(after, tz="UTC"),
+                start=pd.Timestamp(last) + pd.Timedelta(SLOT),
+            )
+            starts, ends = starts + list(s), ends + list(e)
+            last = after[-1]
+
+        gaps = GapIndex(
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            first,
+            last,
+        )
+        remaining = set(_key(s, e) for s, e in zip(gaps.starts, gaps.ends))
+        gaps.attempts = {k: v for k, v in self.attempts.items() if k in remaining}
+        for start, end in refetched:
+            key = _key(start, end)
+            if key in remaining:
+                gaps.attempts[key] = gaps.attempts.get(key, 0) + 1
+        return gaps
+
+
+def load_attempts(path):
+    """Empty refetch counts by fuel, as saved by save_attempts"""
+    if not exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_attempts(path, gap_indexes):
+    """Write each fuel's refetch counts, replacing the file atomically"""
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump({fuel: g.attempts for fuel, g in gap_indexes.items()}, f, indent=1)
+    os.replace(temporary, path)
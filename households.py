@@ -0,0 +1,396 @@
+"""Serving many households from one process
+
+Each household is a section of config.ini named household:<name>, with its
+own API_KEY, MPAN, E_SERIAL, MPRN and G_SERIAL, and anything else from
+[octopus] it wants to change. Its data, and its appliances, are kept in
+DATA_DIR/households/<name> unless it sets DATA_DIR or APPLIANCES_FILE itself:
+
+[household:flat]
+API_KEY = sk_live_...
+MPAN = ...
+
+With no household sections, [octopus] is the one household, "default",
+with its data in DATA_DIR as before.
+
+A household's data is only loaded when it is first asked for, and then in
+two steps: first the charts and summary saved by its last update, which is
+quick whatever the size of its history, then the history itself, by the
+first refresh or the first request that needs it. Loaded
+households are kept in least recently used order and, once together they
+take more than HOUSEHOLD_MEMORY megabytes, the coldest are dropped from
+memory; their data stays on disk to be loaded again when next needed.
+
+One background task refreshes every household that has been asked for in
+the last ACTIVE_HOUSEHOLD seconds, most overdue first, REFRESH_CONCURRENCY
+at a time, so a household that has just been refreshed waits its turn
+behind those that haven't. Households nobody is looking at aren't
+refreshed at all. A refresh that fails, whatever the reason, leaves the
+last snapshot in place and is tried again after POLL_INTERVAL seconds,
+doubling with each failure in a row, but never later than it would have
+been anyway.
+
+Under gunicorn every worker process serves every household, but only one
+of them refreshes each: the first to take the lock on DATA_DIR/refresh.lock
+calls the API and writes the household's files, and keeps the lock until
+it exits or drops the household from memory, when another worker takes
+over. The others open the store read only and, every POLL_INTERVAL
+seconds, look at the snapshot the refresher saved; when it has changed they
+swap in a new snapshot, the charts read from it and the history memory
+mapped from the compact copies in DATA_DIR/series, which the workers then
+share rather than each holding its own.
+
+Within a process, a refresh asked for while one is already running waits
+for that one rather than starting another, as does a request for history
+that is already being loaded.
+"""
+import asyncio
+import configparser as cp
+from collections import OrderedDict
+import copy
+import logging
+import os
+from os.path import join
+from threading import Lock, RLock
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no flock, e.g. on Windows, where each process refreshes for itself
+    fcntl = None
+from metrics import REFRESH_FAILURES
+from octopus import OctopusEnergy
+from octopus_async import AsyncOctopusEnergy
+from refresh import Refresher, next_refresh_delay
+
+logger = logging.getLogger(__name__)
+
+SECTION_PREFIX = "household:"
+DEFAULT_HOUSEHOLD = "default"
+# how often the refresh task looks for households that are due
+POLL_INTERVAL = 10
+REFRESH_LOCK_FILE = "refresh.lock"
+
+
+def retry_delay(failures):
+    """
+    Seconds before trying a household again after `failures` refreshes in
+    a row have failed: POLL_INTERVAL, doubling each time
+    """
+    return POLL_INTERVAL * 2 ** min(failures - 1, 10)
+
+
+def household_configs(cfg):
+    """
+    {name: config} for every household, each config having an [octopus]
+    section with the household's own settings in place of the shared ones
+    """
+    names = [
+        section[len(SECTION_PREFIX) :]
+        for section in cfg.sections()
+        if section.startswith(SECTION_PREFIX)
+    ]
+    if not names:
+        return {DEFAULT_HOUSEHOLD: cfg}
+    data_dir = cfg["octopus"].get("DATA_DIR", "./data")
+    configs = {}
+    for name in names:
+        household_dir = join(data_dir, "households", name)
+        settings = {
+            **cfg["octopus"],
+            "data_dir": household_dir,
+            "appliances_file": join(household_dir, "appliances.json"),
+            **cfg[SECTION_PREFIX + name],
+        }
+        household_cfg = cp.ConfigParser(interpolation=None)
+        household_cfg.read_dict({"octopus": settings})
+        configs[name] = household_cfg
+    return configs
+
+
+class Household(object):
+    """One household's settings, clients and, once loaded, its snapshots"""
+
+    def __init__(self, name, cfg, make_data):
+        self.name = name
+        self.cfg = cfg
+        self.make_data = make_data
+        self.client = OctopusEnergy(cfg)
+        self.async_client = AsyncOctopusEnergy(cfg)
+        # None until loaded, and again once evicted
+        self.refresher = None
+        self.memory = 0
+        self.last_used = 0.0
+        self.due = 0.0
+        self.lock = RLock()
+        # the saved snapshot the current one was read from, see follow
+        self.version = None
+        # the refresh in progress, if there is one
+        self.refreshing = None
+        # refreshes in a row that have failed
+        self.failures = 0
+        # held while this process is the one refreshing the household
+        self._lock_file = None
+
+    def elect(self):
+        """
+        True if this process refreshes the household, taking over from any
+        that has stopped. Never blocks.
+        """
+        if self._lock_file is not None or fcntl is None:
+            return True
+        data_dir = self.cfg["octopus"].get("DATA_DIR", "./data")
+        os.makedirs(data_dir, exist_ok=True)
+        lock_file = open(join(data_dir, REFRESH_LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info("Refreshing household %s in process %d", self.name, os.getpid())
+        return True
+
+    def resign(self):
+        """Let another process refresh the household"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @property
+    def leader(self):
+        return self._lock_file is not None or fcntl is None
+
+    def load(self):
+        """
+        The charts and summary saved by the last update, if there are any.
+        Nothing is read from the network, or from the history.
+        """
+        data = self.make_data(self.cfg, read_only=not self.elect())
+        # before restoring, so a newer save is never missed
+        self.version = data.snapshot_version()
+        refreshed_at = data.restore()
+        self.refresher = Refresher(self.cfg, self.async_client, data, refreshed_at)
+        self.memory = data.memory_usage()
+        # what was on disk may be behind, refresh it at the first chance
+        self.due = time.monotonic()
+
+    def ensure_loaded(self):
+        """
+        Load the stored history behind the snapshot, for the endpoints that
+        need the frames. Returns the snapshot.
+        """
+        with self.lock:
+            if self.refresher is None:
+                self.load()
+            snapshot = self.refresher.snapshot
+            if snapshot.data.loaded:
+                return snapshot
+            data = copy.copy(snapshot.data)
+            data.prepare()
+            if not data.store.read_only:
+                # what prepare() saved, so follow() doesn't read it back
+                self.version = data.snapshot_version()
+            self.refresher.publish(data)
+            self.memory = data.memory_usage()
+            return self.refresher.snapshot
+
+    def follow(self):
+        """
+        As ensure_loaded, first swapping in what the refreshing process last
+        saved if it has changed, or, if this process has just taken over,
+        the same again but writable. Returns the snapshot.
+        """
+        with self.lock:
+            if self.refresher is None:
+                self.load()
+            current = self.refresher.snapshot.data
+            read_only = not self.leader
+            version = current.snapshot_version()
+            if version == self.version and current.store.read_only == read_only:
+                return self.ensure_loaded()
+            data = self.make_data(self.cfg, read_only=read_only)
+            refreshed_at = data.restore()
+            data.prepare()
+            self.refresher.publish(data, refreshed_at)
+            self.version = version
+            self.memory = data.memory_usage()
+            return self.refresher.snapshot
+
+
+class Households(object):
+    """Every household, loading, evicting and refreshing them"""
+
+    def __init__(self, households, memory_limit, concurrency=2, active=24 * 3600):
+        """`households` by name, the first being the default"""
+        self.households = households
+        self.memory_limit = memory_limit
+        self.concurrency = concurrency
+        self.active = active
+        # loaded households, least recently used first
+        self._loaded = OrderedDict()
+        self._lock = Lock()
+        self._task = None
+
+    @classmethod
+    def from_config(cls, cfg, make_data):
+        """
+        The households set up in config.ini. make_data(cfg, read_only) makes
+        an empty OctopusData for a household's config.
+        """
+        octopus = cfg["octopus"]
+        return cls(
+            {
+                name: Household(name, household_cfg, make_data)
+                for name, household_cfg in household_configs(cfg).items()
+            },
+            octopus.getint("HOUSEHOLD_MEMORY", 1024) * 2**20,
+            octopus.getint("REFRESH_CONCURRENCY", 2),
+            octopus.getint("ACTIVE_HOUSEHOLD", 24 * 3600),
+        )
+
+    @property
+    def default(self):
+        return next(iter(self.households.values()))
+
+    def get(self, name=None):
+        """A household by name, the default if None. KeyError if unknown."""
+        if name is None:
+            return self.default
+        return self.households[name]
+
+    def snapshot(self, name=None, history=False):
+        """
+        The household's current snapshot, loading it first if needed, with
+        its history too if `history`. It can block while loading, so call it
+        from a worker thread, not the event loop.
+        """
+        household = self.get(name)
+        household.last_used = time.monotonic()
+        if history:
+            snapshot = household.ensure_loaded()
+        else:
+            # not waiting for the lock if the history is being loaded
+            refresher = household.refresher
+            if refresher is None:
+                with household.lock:
+                    if household.refresher is None:
+                        household.load()
+                    refresher = household.refresher
+            snapshot = refresher.snapshot
+        self._used(household)
+        return snapshot
+
+    def _used(self, household, touch=True):
+        """
+        Count the household's memory, marking it as the most recently used
+        if `touch`, and evict others until there's room
+        """
+        with self._lock:
+            self._loaded[household.name] = household
+            if touch:
+                self._loaded.move_to_end(household.name)
+            total = sum(h.memory for h in self._loaded.values())
+            for name in list(self._loaded):
+                if total <= self.memory_limit:
+                    break
+                if name == household.name:
+                    continue
+                cold = self._loaded.pop(name)
+                total -= cold.memory
+                cold.refresher = None
+                cold.resign()
+                logger.info("Evicted household %s from memory", name)
+
+    @property
+    def loaded(self):
+        return list(self._loaded.values())
+
+    def memory_usage(self):
+        return sum(h.memory for h in self.loaded)
+
+    def due(self, now=None):
+        """Loaded households that are active and due a refresh, most overdue first"""
+        if now is None:
+            now = time.monotonic()
+        return sorted(
+            (
+                h
+                for h in self.loaded
+                if h.due <= now and now - h.last_used <= self.active
+            ),
+            key=lambda h: h.due,
+        )
+
+    async def refresh(self, household):
+        """
+        Refresh one household, or wait for the refresh already running, and
+        work out when it is next due
+        """
+        task = household.refreshing
+        if task is None:
+            task = household.refreshing = asyncio.ensure_future(
+                self._refresh(household)
+            )
+            task.add_done_callback(lambda _: setattr(household, "refreshing", None))
+        # a caller that gives up doesn't cancel it for the others
+        await asyncio.shield(task)
+
+    async def _refresh(self, household):
+        refresher = household.refresher
+        if refresher is None:
+            return
+        leader = household.elect()
+        try:
+            # the history, and anything the refreshing process has saved, in
+            # a worker thread
+            await asyncio.to_thread(household.follow)
+            if household.refresher is not refresher:
+                return
+            if not leader:
+                household.due = time.monotonic() + POLL_INTERVAL
+                return
+            snapshot = await refresher.refresh()
+            household.version = snapshot.data.snapshot_version()
+        except Exception:
+            # whatever went wrong, keep serving the last good snapshot and
+            # keep the refresh task going, trying again after a backoff
+            REFRESH_FAILURES.inc()
+            logger.exception("Refresh of household %s failed", household.name)
+            household.failures += 1
+            snapshot = refresher.snapshot
+        else:
+            household.failures = 0
+        delay = next_refresh_delay(household.cfg, snapshot.data.agile_tariff)
+        if household.failures:
+            delay = min(delay, retry_delay(household.failures))
+        household.due = time.monotonic() + delay
+        # unless it was evicted while refreshing
+        if household.refresher is refresher:
+            household.memory = snapshot.data.memory_usage()
+            self._used(household, touch=False)
+
+    async def _run(self):
+        while True:
+            due = self.due()[: self.concurrency]
+            if not due:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            await asyncio.gather(*(self.refresh(h) for h in due))
+
+    def start(self):
+        """Start refreshing, must be called from the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for household in self.households.values():
+            household.resign()
+            await household.async_client.aclose()
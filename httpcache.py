@@ -0,0 +1,168 @@
+"""Disk backed cache of API responses
+
+Responses are kept as their raw bodies, one file per request, keyed by the
+URL and its query, under DATA_DIR/http. How long one can be reused depends
+on whether its answer can still change:
+
+- a query with both period_from and period_to whose count is every half
+  hour of the period, a fully elapsed consumption window, can never change
+  and is kept for ever
+- anything else, the open window up to now, a window with readings still
+  missing or tariff rates, for HTTP_CACHE_TTL seconds. Rates are asked for
+  from the last one stored on, with no period_to, so are never kept for
+  ever; the store (store.py) keeps them instead
+- meter-point details, such as the GSP, for METER_POINT_CACHE_TTL seconds
+
+Bodies are streamed to disk as they arrive and streamed back when reused,
+so the cache doesn't hold whole responses in memory either.
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from os.path import exists, join
+import re
+import tempfile
+import time
+from urllib.parse import parse_qsl, urlsplit
+import pandas as pd
+from metrics import HTTP_CACHE_REQUESTS
+
+SLOT = pd.Timedelta("30 min")
+METER_POINT = re.compile(r"/(electricity|gas)-meter-points/[^/]+/$")
+COUNT = re.compile(rb'"count"\s*:\s*(\d+)')
+
+
+def request_params(url, params=None):
+    """The query of a URL together with any params, as one sorted dict"""
+    query = dict(parse_qsl(urlsplit(url).query))
+    query.update({key: str(value) for key, value in (params or {}).items()})
+    return dict(sorted(query.items()))
+
+
+def cache_key(url, params=None):
+    """The file name for a request"""
+    base = urlsplit(url)._replace(query="").geturl()
+    request = json.dumps([base, request_params(url, params)])
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def expected_count(query):
+    """Half hours in the query's period, or None if it isn't closed"""
+    if "period_from" not in query or "period_to" not in query:
+        return None
+    period = pd.Timestamp(query["period_to"]) - pd.Timestamp(query["period_from"])
+    return period // SLOT
+
+
+class ResponseCache(object):
+    """Response bodies on disk, by request"""
+
+    def __init__(self, root, ttl=300, meter_point_ttl=7 * 24 * 3600):
+        self.root = root
+        self.ttl = ttl
+        self.meter_point_ttl = meter_point_ttl
+
+    @classmethod
+    def from_config(cls, cfg):
+        """The cache set up in config.ini, or None if HTTP_CACHE is off"""
+        octopus = cfg["octopus"]
+        if not octopus.getboolean("HTTP_CACHE", True):
+            return None
+        return cls(
+            octopus.get(
+                "HTTP_CACHE_DIR", join(octopus.get("DATA_DIR", "./data"), "http")
+            ),
+            octopus.getint("HTTP_CACHE_TTL", 300),
+            octopus.getint("METER_POINT_CACHE_TTL", 7 * 24 * 3600),
+        )
+
+    def _paths(self, key):
+        directory = join(self.root, key[:2])
+        return join(directory, key + ".json"), join(directory, key + ".meta")
+
+    def lifetime(self, url, params, head):
+        """
+        Seconds a response can be reused for, None for ever. `head` is the
+        start of the body, enough to hold its count.
+        """
+        if METER_POINT.search(urlsplit(url).path):
+            return self.meter_point_ttl
+        slots = expected_count(request_params(url, params))
+        count = COUNT.search(head)
+        if slots is not None and count is not None and int(count.group(1)) == slots:
+            return None
+        return self.ttl
+
+    def body(self, url, params=None):
+        """Path of the cached body for a request, if it is still good"""
+        body, meta = self._paths(cache_key(url, params))
+        try:
+            with open(meta) as f:
+                expires = json.load(f)["expires"]
+        except (OSError, ValueError):
+            HTTP_CACHE_REQUESTS.inc(cache="miss")
+            return None
+        if (expires is not None and expires < time.time()) or not exists(body):
+            HTTP_CACHE_REQUESTS.inc(cache="miss")
+            return None
+        HTTP_CACHE_REQUESTS.inc(cache="hit")
+        return body
+
+    @staticmethod
+    def chunks(path, size):
+        """A cached body, `size` bytes at a time"""
+        with open(path, "rb") as f:
+            while chunk := f.read(size):
+                yield chunk
+
+    def read(self, url, params=None):
+        """The cached body for a request as bytes, or None"""
+        path = self.body(url, params)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    @contextmanager
+    def recording(self, url, params=None):
+        """
+        A file to write a response body to as it arrives. It is only kept
+        if the block finishes without an exception.
+        """
+        body, meta = self._paths(cache_key(url, params))
+        os.makedirs(os.path.dirname(body), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(body))
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                yield f
+            with open(temporary, "rb") as f:
+                lifetime = self.lifetime(url, params, f.read(4096))
+            os.replace(temporary, body)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        expires = None if lifetime is None else time.time() + lifetime
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(meta))
+        with os.fdopen(descriptor, "w") as f:
+            json.dump({"url": url, "params": params, "expires": expires}, f)
+        os.replace(temporary, meta)
+
+    def write(self, url, params, content):
+        """Cache a body that has already been read"""
+        with self.recording(url, params) as f:
+            f.write(content)
+
+
+def tee(chunks, f):
+    """Pass chunks on, writing them to `f` as well"""
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+
+async def atee(chunks, f):
+    """As tee, for an async iterable of chunks"""
+    async for chunk in chunks:
+        f.write(chunk)
+        yield chunk
@@ -4,14 +4,47 @@ Needs a web server on the same port as 'origins' list e.g.
 python -m http.server 3000
 from the static directory run this server with: 
 uvicorn main:app --reload
+
+Every endpoint serves the default household unless another one, from
+config.ini, is asked for with ?household=<name>, see households.py.
 """
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, nullcontext
+from threading import Lock
+import time
+from typing import List, Optional
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import pandas as pd
-import numpy as np
-from app import octopusData, client, line_plot
+from pydantic import BaseModel, Field, field_validator, model_validator
+import columns
+from chartcache import etag, not_modified
+from metrics import HTTP_SECONDS, REGISTRY
+from profiling import ProfiledRoute, SlowRequestProfiler
+from query import History, QueryError, QueryUnavailable
+from rollups import PERIODS
+from seasons import GAS_CONVERSION_FACTOR, season_histograms
+from app import cfg, chart_cache, households, line_plot
+from refresh import Snapshot
+from starttimes import (
+    ApplianceRegistry,
+    StartTimeEngine,
+    check_constraint,
+    tariff_version,
+)
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Refresh the data in the background while the server is running"""
+    households.start()
+    yield
+    await households.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = ProfiledRoute
+profiler = SlowRequestProfiler.from_config(cfg)
 
 origins = ["http://localhost:3000", "http://127.0.0.1:3000"]
 
@@ -22,108 +55,477 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Age", "ETag"],
 )
 
 
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Time every request, by route, profiling it if that is turned on"""
+    started = time.perf_counter()
+    profiling = nullcontext()
+    if profiler is not None:
+        profiling = profiler.profile(request.method, request.url.path)
+    with profiling:
+        response = await call_next(request)
+    # by route template, so /series/{name} is one route whatever the name
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=getattr(route, "path", "unmatched"),
+        status=response.status_code,
+    )
+    return response
+
+
+def oldest_snapshot_age():
+    refreshers = [h.refresher for h in households.loaded]
+    return max((r.snapshot.age() for r in refreshers if r is not None), default=0)
+
+
+REGISTRY.gauge(
+    "octopus_snapshot_age_seconds",
+    "Seconds since the oldest data being served was refreshed",
+    oldest_snapshot_age,
+)
+REGISTRY.gauge(
+    "octopus_households_loaded",
+    "Households whose data is in memory",
+    lambda: len(households.loaded),
+)
+REGISTRY.gauge(
+    "octopus_households_refreshing",
+    "Loaded households this process refreshes, rather than following",
+    lambda: sum(h.leader for h in households.loaded),
+)
+REGISTRY.gauge(
+    "octopus_households_memory_bytes",
+    "Memory taken by the households' data, roughly",
+    households.memory_usage,
+)
+REGISTRY.gauge(
+    "octopus_chart_cache_size",
+    "Charts held in the chart cache",
+    lambda: len(chart_cache),
+)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Timings and counts in the Prometheus text format, see metrics.py"""
+    return PlainTextResponse(
+        REGISTRY.expose(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def ready(snapshot):
+    """The snapshot, unless there's nothing in it yet, before the first refresh"""
+    if not snapshot.data.summary:
+        raise HTTPException(
+            status_code=503,
+            detail="No data yet, try again shortly",
+            headers={"Retry-After": "10"},
+        )
+    return snapshot
+
+
+def household_snapshot(household: Optional[str] = None) -> Snapshot:
+    """
+    The snapshot of the household asked for with ?household=, or of the
+    default one, see households.py. Its charts, series and summary may have
+    been restored from the last run without the history behind them.
+    """
+    try:
+        return ready(households.snapshot(household))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown household")
+
+
+def household_history(household: Optional[str] = None) -> Snapshot:
+    """
+    As household_snapshot, with the history loaded. A plain function, so
+    FastAPI runs it in a worker thread, as loading it can take a while.
+    """
+    try:
+        return ready(households.snapshot(household, history=True))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown household")
+
+
+def snapshot_response(snapshot, response, data):
+    """Say how old the data is, both in the body and in the Age header"""
+    age = snapshot.age()
+    response.headers["Age"] = str(age)
+    data["snapshot_age"] = age
+    return data
+
+
+def conditional_response(snapshot, request, response, tag, data):
+    """
+    Data that has a strong ETag. The snapshot's age only goes in the Age
+    header, so the body is the same for as long as the ETag is.
+    """
+    headers = {"ETag": tag, "Age": str(snapshot.age())}
+    if not_modified(request, tag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return data
+
+
 @app.get("/startpage")
-async def root():
-    octopusData.update(client)
-    data = {
-        "missing_electric": len(octopusData.missing_electric),
-        "missing_gas": len(octopusData.missing_gas),
-        "recent_gas": octopusData.gas_consumption.index.max().isoformat(),
-        "recent_electric": octopusData.electricity_consumption.index.max().isoformat(),
+async def root(response: Response, snapshot: Snapshot = Depends(household_snapshot)):
+    data = dict(snapshot.data.summary)
+    return snapshot_response(snapshot, response, data)
+
+
+class StartTimes(object):
+    """
+    A household's appliances, its start time engine and the /starttimes
+    answers built for it. Requests are answered in worker threads, so the
+    engine and the answers are only used with the lock held.
+    """
+
+    def __init__(self, appliances_file):
+        self.appliances = ApplianceRegistry(appliances_file)
+        self.engine = StartTimeEngine(self.appliances)
+        # keyed on the tariff, appliance versions and the current half hour
+        self.answers = {}
+        self.lock = Lock()
+
+
+# by household name, made when first needed
+start_times = {}
+start_times_lock = Lock()
+
+
+def household_start_times(household: Optional[str] = None) -> StartTimes:
+    """The start times of the household asked for with ?household="""
+    try:
+        household = households.get(household)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown household")
+    with start_times_lock:
+        if household.name not in start_times:
+            start_times[household.name] = StartTimes(
+                household.cfg["octopus"].get("APPLIANCES_FILE", "./appliances.json")
+            )
+        return start_times[household.name]
+
+
+class Appliance(BaseModel):
+    pattern: list[float] = Field(min_length=1)
+    title: Optional[str] = None
+
+
+class ScheduleRequest(BaseModel):
+    """
+    A registered appliance by name, or an ad-hoc pattern. Constraints are UK
+    times of day, e.g. "07:00", or full timestamps.
+    """
+
+    name: Optional[str] = None
+    pattern: Optional[list[float]] = None
+    not_before: Optional[str] = None
+    finish_by: Optional[str] = None
+
+    _check_constraints = field_validator("not_before", "finish_by")(check_constraint)
+
+    @model_validator(mode="after")
+    def _check_appliance(self):
+        if self.name is None and not self.pattern:
+            raise ValueError("a name or a pattern is needed")
+        return self
+
+
+class Schedule(BaseModel):
+    appliances: list[ScheduleRequest]
+
+
+def start_time_data(start_time):
+    if start_time is None:
+        return {"start": None, "end": None, "cost": None, "alternatives": []}
+    return {
+        "start": start_time.start,
+        "end": start_time.end,
+        "cost": start_time.cost,
+        "alternatives": start_time.alternatives,
     }
-    return data
 
 
 @app.get("/starttimes")
-def starttimes():
-    octopusData.update(client)
+def starttimes(
+    request: Request,
+    response: Response,
+    snapshot: Snapshot = Depends(household_history),
+    planner: StartTimes = Depends(household_start_times),
+):
+    octopusData = snapshot.data
+    appliances = planner.appliances
 
     now = pd.Timestamp.now(tz="UTC")
-    today = octopusData.agile_tariff[octopusData.agile_tariff.index >= now]
-
-    def applicance_data(usagePattern, title):
-        start_time = (
-            today["value_inc_vat"]
-            .rolling(len(usagePattern))
-            .apply(lambda x: np.multiply(x, usagePattern).sum())
+    with planner.lock:
+        key = (
+            tariff_version(octopusData.agile_tariff),
+            appliances.version,
+            now.floor("30 min"),
         )
+        if key not in planner.answers:
+            best = planner.engine.best(octopusData.agile_tariff, now)
+            data = {"appliances": []}
+            for name, start_time in best.items():
+                title = appliances.title(name)
+                data["appliances"].append(
+                    {
+                        "name": name,
+                        "title": title,
+                        **start_time_data(start_time),
+                        "plot": line_plot(start_time.curve, "Start Times " + title),
+                    }
+                )
+            planner.answers = {key: data}
+        data = planner.answers[key]
 
-        start = start_time.idxmin()
-        end = start + pd.Timedelta("30 m") * len(usagePattern)
-        cost = start_time.min()
-        plot = line_plot(start_time, title)
+    return conditional_response(snapshot, request, response, etag(*key), data)
 
-        app_data = {
-            "start": start,
-            "end": end,
-            "cost": cost,
-            "plot": plot,
-        }
 
-        return app_data
+@app.get("/appliances")
+def list_appliances(planner: StartTimes = Depends(household_start_times)):
+    return planner.appliances.appliances
 
-    # order must match time order of series. latest to earliest, for instance
-    washing_machine = [0.2, 0.2, 0.2, 0.2, 0.2, 1, 1]
-    washing_machine_data = applicance_data(
-        washing_machine, "Start Times Washing Machine"
-    )
 
-    # washing_up = (
-    #     (4.18 * 8 * 2 * 30)  # 8 litres per bowl, 2 bowls
-    #     / (60 * 60)  # temperature difference. J/g/°C
-    #     / (0.8)  # seconds. This gives kWh
-    # )  # efficiency
-    # unit_cost = 2.74 / 100
-
-    # 0.9 kwH over 2:44. But actually 1/2 in the first 1/2 hour, delayed by 20min, 1/2 1 hour later.
-    # order must match time order of series. latest to earliest, for instance
-    gentle_dishwasher = [0.4, 0, 0.5]
-    gentle_dishwasher_data = applicance_data(
-        gentle_dishwasher, "Start Times Gentle Dishwasher"
-    )
+@app.put("/appliances/{name}")
+def put_appliance(
+    name: str,
+    appliance: Appliance,
+    planner: StartTimes = Depends(household_start_times),
+):
+    with planner.lock:
+        planner.appliances.add(name, appliance.pattern, appliance.title)
+        return planner.appliances.appliances[name]
 
-    # 0.75 kWh over 3:58
-    eco_dishwasher = [0.05, 0.05, 0.05, 0.05, 0.15, 0.15, 0.15, 0.1]
-    eco_dishwasher_data = applicance_data(eco_dishwasher, "Start Times Eco Dishwasher")
 
-    # 1.35 kWh over 3.11 hours
-    intense_dishwasher = [0.05, 0.1, 0.1, 0.1, 0.1, 0.5, 0.4]
-    intense_dishwasher_data = applicance_data(
-        intense_dishwasher, "Start Times Intense Dishwasher"
-    )
+@app.delete("/appliances/{name}")
+def delete_appliance(name: str, planner: StartTimes = Depends(household_start_times)):
+    with planner.lock:
+        if name not in planner.appliances.appliances:
+            raise HTTPException(status_code=404, detail="Unknown appliance")
+        planner.appliances.remove(name)
+
 
+@app.post("/schedule")
+def schedule(
+    request: Schedule,
+    response: Response,
+    snapshot: Snapshot = Depends(household_history),
+    planner: StartTimes = Depends(household_start_times),
+):
+    """Best starts for many appliances, with constraints, in one go"""
+    requests = [r.model_dump() for r in request.appliances]
+    with planner.lock:
+        for r in requests:
+            if not r["pattern"] and r["name"] not in planner.appliances.appliances:
+                raise HTTPException(status_code=404, detail="Unknown appliance")
+        results = planner.engine.schedule(snapshot.data.agile_tariff, requests)
     data = {
-        "WashingMachineEnd": washing_machine_data["end"],
-        "WashingMachineCost": washing_machine_data["cost"],
-        "WashingMachinePlot": washing_machine_data["plot"],
-        "GentleDishwasherStart": gentle_dishwasher_data["start"],
-        "GentleDishwasherCost": gentle_dishwasher_data["cost"],
-        "GentleDishwasherPlot": gentle_dishwasher_data["plot"],
-        "EcoDishwasherStart": eco_dishwasher_data["start"],
-        "EcoDishwasherCost": eco_dishwasher_data["cost"],
-        "EcoDishwasherPlot": eco_dishwasher_data["plot"],
-        "IntenseDishwasherStart": intense_dishwasher_data["start"],
-        "IntenseDishwasherCost": intense_dishwasher_data["cost"],
-        "IntenseDishwasherPlot": intense_dishwasher_data["plot"],
+        "schedule": [
+            {"name": r["name"], **start_time_data(start_time)}
+            for r, start_time in zip(requests, results)
+        ]
     }
-    return data
+    return snapshot_response(snapshot, response, data)
+
+
+def upcoming_rates(rates, now):
+    """Rates from the current half hour on, as columns"""
+    rates = rates.since(now.floor("30 min"))
+    return {
+        "valid_from": rates.index.tolist(),
+        "value_inc_vat": rates["value_inc_vat"].tolist() if len(rates) else [],
+    }
+
+
+@app.get("/tariffs")
+def tariffs(
+    response: Response,
+    snapshot: Snapshot = Depends(household_history),
+):
+    """
+    Upcoming unit rates of the household's tariff and, side by side, of each
+    tariff in TARIFFS
+    """
+    now = pd.Timestamp.now(tz="UTC")
+    data = {
+        "household": upcoming_rates(snapshot.data.agile_tariff, now),
+        "tariffs": {
+            tariff_code: upcoming_rates(rates, now)
+            for tariff_code, rates in snapshot.data.tariffs.items()
+        },
+    }
+    return snapshot_response(snapshot, response, data)
 
 
 @app.get("/consumption")
-def consumption():
-    octopusData.update(client)
+def consumption(
+    request: Request,
+    response: Response,
+    snapshot: Snapshot = Depends(household_snapshot),
+):
+    octopusData = snapshot.data
 
     data = {
         "gasConsumptionBinnedChart": octopusData.gas_consumption_binned_chart,
-        "gasConsumption2022BinnedChart": octopusData.gas_consumption_2022_binned_chart,
-        "gasConsumption2023BinnedChart": octopusData.gas_consumption_2023_binned_chart,
-        "gasConsumption2024BinnedChart": octopusData.gas_consumption_2024_binned_chart,
+        **{
+            "gasConsumption%sBinnedChart" % season: chart
+            for season, chart in octopusData.gas_season_charts.items()
+        },
         "electricityDailyChart": octopusData.electricity_daily_chart,
         "electricityRollingChart": octopusData.electricity_rolling_chart,
         "gasDailyChart": octopusData.gas_daily_chart,
         "gasRollingChart": octopusData.gas_rolling_chart,
     }
-    return data
+    tag = etag(sorted(octopusData.fingerprints.items()))
+    return conditional_response(snapshot, request, response, tag, data)
+
+
+@app.get("/series")
+def series_names(snapshot: Snapshot = Depends(household_snapshot)):
+    """The chart data available from /series/{name}"""
+    return list(snapshot.data.series)
+
+
+@app.get("/series/{name}")
+def series(
+    name: str, request: Request, snapshot: Snapshot = Depends(household_snapshot)
+):
+    """
+    Chart data as packed binary columns, or as an Arrow IPC stream if the
+    request accepts application/vnd.apache.arrow.stream. See columns.py
+    """
+    if name not in snapshot.data.series:
+        raise HTTPException(status_code=404, detail="Unknown series")
+    media_type = columns.PACKED_MEDIA_TYPE
+    if columns.ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        media_type = columns.ARROW_MEDIA_TYPE
+    tag = etag(snapshot.data.fingerprints.get(name), media_type)
+    headers = {"ETag": tag, "Age": str(snapshot.age()), "Vary": "Accept"}
+    if not_modified(request, tag):
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=columns.encode(snapshot.data.series[name], media_type),
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+@app.get("/rollups/{fuel}/{period}")
+def rollups(
+    fuel: str,
+    period: str,
+    request: Request,
+    snapshot: Snapshot = Depends(household_history),
+):
+    """
+    Hourly, daily, weekly or monthly totals for electricity or gas, encoded
+    as for /series/{name}
+    """
+    if fuel not in ("electricity", "gas") or period not in PERIODS:
+        raise HTTPException(status_code=404, detail="Unknown rollup")
+    media_type = columns.PACKED_MEDIA_TYPE
+    if columns.ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        media_type = columns.ARROW_MEDIA_TYPE
+    table = snapshot.data.rollups.get(fuel, period)
+    return Response(
+        content=columns.encode(columns.from_frame(table), media_type),
+        media_type=media_type,
+        headers={"Age": str(snapshot.age())},
+    )
+
+
+@app.get("/seasons")
+def seasons(
+    request: Request,
+    response: Response,
+    season: Optional[int] = None,
+    threshold: float = 0.1,
+    bins: int = Query(40, ge=1, le=1000),
+    factor: float = GAS_CONVERSION_FACTOR,
+    max_kwh: float = Query(20, gt=0),
+    start_month: int = Query(10, ge=1, le=12),
+    snapshot: Snapshot = Depends(household_history),
+):
+    """
+    Histograms of hourly gas use, in kWh, for every heating season, or just
+    one. Seasons are named after the year they end in.
+    """
+    hourly = snapshot.data.rollups.get("gas", "hourly")["consumption"]
+    edges, histograms = season_histograms(
+        hourly, bins, (0, max_kwh), threshold, factor, start_month
+    )
+    if season is not None:
+        if season not in histograms:
+            raise HTTPException(status_code=404, detail="No readings that season")
+        histograms = {season: histograms[season]}
+    data = {
+        "edges": edges.tolist(),
+        "seasons": {s: counts.tolist() for s, counts in histograms.items()},
+    }
+    tag = etag(
+        snapshot.data.fingerprints.get("gasHourly"),
+        sorted(request.query_params.items()),
+    )
+    return conditional_response(snapshot, request, response, tag, data)
+
+
+def table_response(request, table):
+    """
+    An Arrow table as JSON columns, or as an Arrow IPC stream if the request
+    accepts application/vnd.apache.arrow.stream
+    """
+    if columns.ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(
+            content=columns.ipc_stream(table), media_type=columns.ARROW_MEDIA_TYPE
+        )
+    return table.to_pydict()
+
+
+@app.get("/query")
+def query(
+    sql: str,
+    request: Request,
+    snapshot: Snapshot = Depends(household_snapshot),
+):
+    """
+    The result of a read only SQL SELECT over the stored history, each
+    dataset a table, e.g. gas or electricity_daily. See query.py
+    """
+    try:
+        table = History.from_config(cfg, snapshot.data.store).sql(sql)
+    except QueryUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return table_response(request, table)
+
+
+@app.get("/query/{dataset}")
+def query_dataset(
+    dataset: str,
+    request: Request,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    column: Optional[List[str]] = Query(None),
+    snapshot: Snapshot = Depends(household_snapshot),
+):
+    """
+    A stored dataset's rows in [start, end), with just the columns asked
+    for, reading only the months in range. See query.py
+    """
+    history = History.from_config(cfg, snapshot.data.store)
+    if dataset not in history.datasets():
+        raise HTTPException(status_code=404, detail="Unknown dataset")
+    try:
+        table = history.scan(dataset, column, start, end)
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return table_response(request, table)
@@ -0,0 +1,284 @@
+"""Counters and histograms, exposed in the Prometheus text format
+
+Where the time goes in a refresh or a request: each stage of
+OctopusData.update, every API request (status, bytes and pages), chart
+building and every end point. main.py serves them all at /metrics.
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+from contextlib import contextmanager
+from threading import Lock
+import time
+from urllib.parse import urlsplit
+
+# seconds, from a cached chart to a ten year backfill
+BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (n, _escape(v)) for n, v in pairs)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """A named metric, with a value for each combination of its labels"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                "%s needs labels %s, not %s" % (self.name, self.labelnames, labels)
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for each sample"""
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for suffix, values, extra, value in self.samples():
+            lines.append(
+                "%s%s%s %s"
+                % (
+                    self.name,
+                    suffix,
+                    _labels(self.labelnames, values, extra),
+                    _number(value),
+                )
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A total that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [("_total", key, (), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """A value read when the metrics are exposed, from function()"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        return [("", (), (), self.function())]
+
+
+class Histogram(Metric):
+    """Counts of observations, such as seconds, in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [
+                count + (value <= bound) for count, bound in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the block takes, even if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return counts[-1]
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(("_bucket", key, [("le", _number(bound))], count))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """The metrics to expose, in the order they were added"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        return self.add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self.add(Gauge(name, documentation, function))
+
+    def expose(self):
+        """Every metric in the Prometheus text format"""
+        return "".join(metric.expose() + "\n" for metric in self.metrics)
+
+
+def resource(path):
+    """
+    An API path without its meter-point numbers, serials and tariff codes,
+    e.g. gas-meter-points/meters/consumption, so labels stay few
+    """
+    return "/".join(
+        segment
+        for segment in urlsplit(path).path.split("/")
+        if segment and not any(c.isdigit() for c in segment)
+    )
+
+
+def observe_request(started, path, status):
+    """Record an API request to `path` that began at perf_counter() `started`"""
+    API_SECONDS.observe(
+        time.perf_counter() - started, resource=resource(path), status=status
+    )
+
+
+def counted(chunks, resource, source):
+    """Pass chunks on, counting their bytes"""
+    for chunk in chunks:
+        API_BYTES.inc(len(chunk), resource=resource, source=source)
+        yield chunk
+
+
+async def acounted(chunks, resource, source):
+    """As counted, for an async iterable of chunks"""
+    async for chunk in chunks:
+        API_BYTES.inc(len(chunk), resource=resource, source=source)
+        yield chunk
+
+
+REGISTRY = Registry()
+
+UPDATE_SECONDS = REGISTRY.histogram(
+    "octopus_update_seconds",
+    "Time taken by a whole OctopusData update",
+    ["client"],
+)
+UPDATE_STAGE_SECONDS = REGISTRY.histogram(
+    "octopus_update_stage_seconds",
+    "Time taken by each stage of an OctopusData update",
+    ["stage"],
+)
+REFRESH_FAILURES = REGISTRY.counter(
+    "octopus_refresh_failures",
+    "Background refreshes that failed, leaving the last snapshot in place",
+)
+API_SECONDS = REGISTRY.histogram(
+    "octopus_api_request_seconds",
+    "Time taken by requests to the Octopus API, until the body is read",
+    ["resource", "status"],
+)
+API_RETRIES = REGISTRY.counter(
+    "octopus_api_retries",
+    "Requests to the Octopus API tried again, by why the last attempt failed",
+    ["resource", "status"],
+)
+API_REJECTED = REGISTRY.counter(
+    "octopus_api_circuit_open",
+    "Requests to the Octopus API not made because it has been failing",
+    ["resource"],
+)
+API_BYTES = REGISTRY.counter(
+    "octopus_api_response_bytes",
+    "Bytes of Octopus API response bodies, from the network or the cache",
+    ["resource", "source"],
+)
+API_PAGES = REGISTRY.counter(
+    "octopus_api_pages",
+    "Pages of Octopus API responses, from the network or the cache",
+    ["resource", "source"],
+)
+HTTP_CACHE_REQUESTS = REGISTRY.counter(
+    "octopus_api_cache_requests",
+    "Octopus API requests looked up in the response cache, by whether it had them",
+    ["cache"],
+)
+CHART_SECONDS = REGISTRY.histogram(
+    "octopus_chart_build_seconds",
+    "Time taken to build a chart that wasn't already cached",
+    ["chart"],
+)
+CHART_REQUESTS = REGISTRY.counter(
+    "octopus_chart_requests",
+    "Charts asked for, by whether they were already cached",
+    ["cache"],
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    "octopus_http_request_seconds",
+    "Time taken to answer each end point",
+    ["method", "route", "status"],
+)
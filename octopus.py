@@ -4,9 +4,33 @@
 # https://developer.octopus.energy/docs/api/
 # https://json-schema.org/learn/miscellaneous-examples.html
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
+import json
+import logging
+import time
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
+from httpcache import ResponseCache, tee
+from metrics import (
+    API_BYTES,
+    API_PAGES,
+    API_REJECTED,
+    API_RETRIES,
+    counted,
+    observe_request,
+    resource,
+)
+from pages import AGILE_SCHEMA, CHUNK_SIZE, CONSUMPTION_SCHEMA, read_results
+from timeseries import SLOT, TimeSeries
+from transport import CircuitOpen, Transport
+
+# the regions, or GSPs, tariffs are priced for
+REGIONS = ("A", "B", "C", "D", "E", "F", "G", "P", "N", "J", "H", "K", "L", "M")
+
+logger = logging.getLogger(__name__)
 
 
 class OctopusEnergy(object):
@@ -33,30 +57,124 @@ class OctopusEnergy(object):
 
         self.cfg = cfg
         self.session = requests.Session()
+        # BASE_URL in config.ini can point elsewhere, e.g. the fake API in
+        # benchmarks/fakeapi.py
+        base_url = cfg["octopus"].get("BASE_URL")
+        if base_url:
+            self.BASE_URL = base_url.strip('"') + "/v1"
+        self.cache = ResponseCache.from_config(cfg)
+        self.transport = Transport.from_config(cfg)
+        # the meter-point's region, looked up once, see region()
+        self._region = None
+
+    def _url(self, path):
+        # `next` links from paginated responses are already complete URLs
+        return path if path.startswith("http") else self.BASE_URL + path
 
     def _get(self, path, params=None):
         """
-        Make a GET HTTP request
+        Make a GET HTTP request, or reuse the response if it can't have
+        changed, see httpcache.py
+        """
+        name = resource(path)
+        source = "cache"
+        content = None
+        if self.cache is not None:
+            content = self.cache.read(self._url(path), params)
+        if content is None:
+            source = "network"
+            started = time.perf_counter()
+            content = self._response(path, params).content
+            observe_request(started, path, 200)
+            if self.cache is not None:
+                self.cache.write(self._url(path), params, content)
+        API_BYTES.inc(len(content), resource=name, source=source)
+        API_PAGES.inc(resource=name, source=source)
+        return json.loads(content)
+
+    def _response(self, path, params=None, stream=False):
+        """
+        The response to a GET request, raising DataUnavailable if not OK.
+        Rate limited, timed out and retried as set up in config.ini, see
+        transport.py.
         """
         if params is None:
             params = {}
-        url = self.BASE_URL + path
-        try:
-            response = self.session.request(
-                method="GET",
-                url=url,
-                auth=(self.cfg["octopus"]["api_key"], ""),
-                params=params,
-            )
-        except requests.RequestException as e:
-            raise self.DataUnavailable("Network exception") from e
-
-        if response.status_code != 200:
-            raise self.DataUnavailable(
-                "Unexpected response status (%s)" % response.status_code
-            )
-
-        return response.json()
+        transport = self.transport
+        name = resource(path)
+        attempt = 0
+        while True:
+            try:
+                time.sleep(transport.wait())
+            except CircuitOpen as e:
+                API_REJECTED.inc(resource=name)
+                raise self.DataUnavailable(str(e)) from e
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                response = self.session.request(
+                    method="GET",
+                    url=self._url(path),
+                    auth=(self.cfg["octopus"]["api_key"], ""),
+                    params=params,
+                    stream=stream,
+                    timeout=(transport.connect_timeout, transport.read_timeout),
+                )
+            except requests.RequestException as e:
+                observe_request(started, path, "error")
+                status = "error"
+                error = self.DataUnavailable("Network exception")
+                cause = e
+            else:
+                if response.status_code == 200:
+                    transport.succeeded()
+                    return response
+                response.close()
+                observe_request(started, path, response.status_code)
+                status = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                error = self.DataUnavailable(
+                    "Unexpected response status (%s)" % response.status_code
+                )
+                cause = None
+            delay = transport.retry_delay(attempt, status, retry_after)
+            if delay is None:
+                raise error from cause
+            API_RETRIES.inc(resource=name, status=status)
+            time.sleep(delay)
+            attempt += 1
+
+    def _get_results(self, path, schema, params=None):
+        """
+        GET a page of results, parsed into `schema` as it arrives, see
+        pages.py. Returns (results as a table, the rest of the page).
+        Cached like _get.
+        """
+        url = self._url(path)
+        name = resource(path)
+        cached = None if self.cache is None else self.cache.body(url, params)
+        if cached is not None:
+            API_PAGES.inc(resource=name, source="cache")
+            chunks = counted(self.cache.chunks(cached, CHUNK_SIZE), name, "cache")
+            return read_results(chunks, schema)
+        started = time.perf_counter()
+        with self._response(path, params, stream=True) as response:
+            chunks = counted(response.iter_content(CHUNK_SIZE), name, "network")
+            try:
+                if self.cache is None:
+                    results = read_results(chunks, schema)
+                else:
+                    with self.cache.recording(url, params) as f:
+                        results = read_results(tee(chunks, f), schema)
+            except requests.RequestException as e:
+                observe_request(started, path, "error")
+                raise self.DataUnavailable("Network exception") from e
+            except ValueError as e:
+                observe_request(started, path, "incomplete")
+                raise self.DataUnavailable("Incomplete response") from e
+        observe_request(started, path, 200)
+        API_PAGES.inc(resource=name, source="network")
+        return results
 
     def electricity_meter_point(self):
         # See https://developer.octopus.energy/docs/api/#electricity-meter-points
@@ -78,35 +196,72 @@ class OctopusEnergy(object):
             params=params,
         )
 
-    def agile_tariff_unit_rates(self, **params):
-        """
-        Helper method to easily look-up the electricity unit rates for given GSP
-        """
-        gsp = self.electricity_meter_point()["gsp"]
+    AGILE_PRODUCT_CODE = "AGILE-18-02-21"
+
+    @staticmethod
+    def meter_point_region(meter_point):
+        """The region, or GSP, letter of an electricity meter-point"""
+        gsp = meter_point["gsp"]
 
         # Handle GSPs passed with leading underscore
         if len(gsp) == 2:
             gsp = gsp[1]
-        assert gsp in (
-            "A",
-            "B",
-            "C",
-            "D",
-            "E",
-            "F",
-            "G",
-            "P",
-            "N",
-            "J",
-            "H",
-            "K",
-            "L",
-            "M",
+        assert gsp in REGIONS
+
+        return gsp
+
+    @staticmethod
+    def tariff_code(product_code, region):
+        """e.g. E-1R-AGILE-18-02-21-C, a single rate electricity tariff"""
+        return "E-1R-%s-%s" % (product_code, region)
+
+    @staticmethod
+    def product_code(tariff_code):
+        """The product of a tariff code, e.g. AGILE-18-02-21"""
+        return tariff_code.split("-", 2)[2].rsplit("-", 1)[0]
+
+    @staticmethod
+    def unit_rates_path(tariff_code):
+        """A tariff's unit rates end point"""
+        return "/products/%s/electricity-tariffs/%s/standard-unit-rates/" % (
+            OctopusEnergy.product_code(tariff_code),
+            tariff_code,
+        )
+
+    def region(self):
+        """
+        The household's region: REGION in config.ini or else the
+        electricity meter-point's, looked up once
+        """
+        if self._region is None:
+            self._region = self.cfg["octopus"].get("REGION") or self.meter_point_region(
+                self.electricity_meter_point()
+            )
+        return self._region
+
+    def household_tariff_code(self):
+        """The household's Agile tariff, AGILE_PRODUCT_CODE in its region"""
+        return self.tariff_code(
+            self.cfg["octopus"].get("AGILE_PRODUCT_CODE", self.AGILE_PRODUCT_CODE),
+            self.region(),
         )
 
+    def compared_tariff_codes(self):
+        """
+        The tariff codes in TARIFFS, e.g. E-1R-AGILE-24-10-01-C, whose
+        rates are kept beside the household's own. Each must have half
+        hourly rates, as Agile does; see check_half_hourly.
+        """
+        return self.cfg["octopus"].get("TARIFFS", "").replace(",", " ").split()
+
+    def agile_tariff_unit_rates(self, **params):
+        """
+        Helper method to easily look-up the electricity unit rates for given GSP
+        """
+        tariff_code = self.household_tariff_code()
         return self.electricity_tariff_unit_rates(
-            product_code="AGILE-18-02-21",
-            tariff_code="E-1R-AGILE-18-02-21-%s" % gsp,
+            product_code=self.product_code(tariff_code),
+            tariff_code=tariff_code,
             params=params,
         )
 
@@ -114,17 +269,13 @@ class OctopusEnergy(object):
         """Get electricity consumption data"""
         # See https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
         return self._get(
-            f"/electricity-meter-points/{ (self.cfg['octopus']['mpan']) }/meters/{ self.cfg['octopus']['e_serial'] }/consumption/",
-            params=params,
+            self.meter_consumption_path(self.FuelType.ELECTRIC), params=params
         )
 
     def gas_meter_consumption(self, **params):
         """Get gas consumption data"""
         # See https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
-        return self._get(
-            f"/gas-meter-points/{ self.cfg['octopus']['mprn'] }/meters/{ self.cfg['octopus']['g_serial'] }/consumption/",
-            params=params,
-        )
+        return self._get(self.meter_consumption_path(self.FuelType.GAS), params=params)
 
     class FuelType(Enum):
         """Enumeration of fuel types"""
@@ -135,18 +286,73 @@ class OctopusEnergy(object):
     def get_agile_tarriff_rates(
         self, current_agile_rates=pd.DataFrame([]), page_size=1500
     ):
-        """Get agile tarrif rates"""
-        response = self.agile_tariff_unit_rates(page_size=page_size)
-        results = pd.DataFrame(response["results"])
-        dt = pd.to_datetime(results["valid_from"], utc=True)
-        dti = pd.DatetimeIndex(dt)
-        results_reindex = results.set_index(dti).drop("valid_from", axis=1)
-        # agile_tariff["valid_from"] = pd.to_datetime(agile_tariff["valid_from"]) # to date only .apply(lambda a: pd.to_datetime(a).date()) # for excel
-        results_reindex["valid_to"] = pd.to_datetime(results_reindex["valid_to"])
+        """Get agile tarrif rates, see tariff_rates"""
+        return self.tariff_rates(
+            self.household_tariff_code(), current_agile_rates, page_size
+        )
 
-        agile_tariff = pd.concat([results_reindex, current_agile_rates])
+    def tariff_rates(self, tariff_code, current_rates=pd.DataFrame([]), page_size=1500):
+        """
+        A tariff's unit rates merged into the current rates, as a TimeSeries.
+        Only rates from the end of the current ones on are asked for, so a
+        daily refresh is one small request.
+        """
+        current_rates = TimeSeries.from_frame(current_rates)
+        rates, _ = self._get_results(
+            self.unit_rates_path(tariff_code),
+            AGILE_SCHEMA,
+            self.rates_params(current_rates, page_size),
+        )
+        self.check_half_hourly(tariff_code, rates)
+        return self.merge_rates(current_rates, rates)
+
+    @staticmethod
+    def check_half_hourly(tariff_code, rates):
+        """ValueError unless every rate in the table is for one half hour"""
+        intervals = pc.subtract(rates["valid_to"], rates["valid_from"])
+        half_hourly = pc.equal(intervals, pa.scalar(SLOT.to_pytimedelta()))
+        if not pc.all(pc.fill_null(half_hourly, False), min_count=0).as_py():
+            raise ValueError("%s doesn't have half hourly rates" % tariff_code)
+
+    def compared_tariff_rates(self, current_tariffs, page_size=1500):
+        """
+        {tariff code: rates} for each of TARIFFS, as tariff_rates, from the
+        current rates by tariff code. A tariff without half hourly rates is
+        logged and left out.
+        """
+        tariffs = {}
+        for tariff_code in self.compared_tariff_codes():
+            try:
+                tariffs[tariff_code] = self.tariff_rates(
+                    tariff_code,
+                    current_tariffs.get(tariff_code, TimeSeries()),
+                    page_size,
+                )
+            except ValueError as e:
+                logger.warning("Skipping tariff %s: %s", tariff_code, e)
+        return tariffs
 
-        return agile_tariff.dropna().drop_duplicates()
+    @staticmethod
+    def rates_params(current_rates, page_size):
+        """
+        Query for the rates after `current_rates`, a TimeSeries: from the
+        valid_to of the last one, or all of them if there are none
+        """
+        params = {"page_size": page_size}
+        if not current_rates.empty:
+            last_valid_to = current_rates.max() + SLOT
+            params["period_from"] = last_valid_to.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return params
+
+    @staticmethod
+    def merge_rates(current_agile_rates, rates):
+        """
+        Rates, a table, merged with the current rates, as a TimeSeries; the
+        new ones win
+        """
+        return TimeSeries.from_frame(current_agile_rates).upsert(
+            TimeSeries.from_table(rates, "valid_from")
+        )
 
     def missing(consumption):
         """Apparently this needs a self, but I haven't figured it out yet"""
@@ -157,21 +363,23 @@ class OctopusEnergy(object):
         missing = total.difference(consumption.index)
         return missing
 
-    def consumption(self, fuel=None, current_consumption=pd.DataFrame([]), **params):
-        def consumption_from_response(response):
-            results = pd.DataFrame(response["results"]).dropna().drop_duplicates()
-            dt = pd.to_datetime(results["interval_start"], utc=True)
-            dti = pd.DatetimeIndex(dt)
-            new_consumption = results.set_index(dti).drop("interval_start", axis=1)
-            # needs to be forced to UTC? otherwise treats it as an object
-            new_consumption["interval_end"] = pd.to_datetime(
-                new_consumption["interval_end"], utc=True
-            )
-            # https://stackoverflow.com/questions/55385497/how-can-i-convert-my-datetime-column-in-pandas-all-to-the-same-timezone
-            # https://stackoverflow.com/questions/63495502/creating-pandas-datetimeindex-in-dataframe-from-dst-aware-datetime-objects
-            # https://queirozf.com/entries/pandas-time-series-examples-datetimeindex-periodindex-and-timedeltaindex
-            return new_consumption.dropna().drop_duplicates()
+    @staticmethod
+    def consumption_from_response(response):
+        """Consumption, indexed by interval_start, from an API response"""
+        results = pd.DataFrame(response["results"]).dropna().drop_duplicates()
+        dt = pd.to_datetime(results["interval_start"], utc=True)
+        dti = pd.DatetimeIndex(dt)
+        new_consumption = results.set_index(dti).drop("interval_start", axis=1)
+        # needs to be forced to UTC? otherwise treats it as an object
+        new_consumption["interval_end"] = pd.to_datetime(
+            new_consumption["interval_end"], utc=True
+        )
+        # https://stackoverflow.com/questions/55385497/how-can-i-convert-my-datetime-column-in-pandas-all-to-the-same-timezone
+        # https://stackoverflow.com/questions/63495502/creating-pandas-datetimeindex-in-dataframe-from-dst-aware-datetime-objects
+        # https://queirozf.com/entries/pandas-time-series-examples-datetimeindex-periodindex-and-timedeltaindex
+        return new_consumption.dropna().drop_duplicates()
 
+    def consumption(self, fuel=None, current_consumption=pd.DataFrame([]), **params):
         if fuel == self.FuelType.ELECTRIC:
             # https://treyhunner.com/2018/10/asterisks-in-python-what-they-are-and-how-to-use-them/
             # When calling a function, the * operator can be used to unpack an
@@ -185,68 +393,139 @@ class OctopusEnergy(object):
         if fuel is self.FuelType.GAS:
             response = self.gas_meter_consumption(**params)
 
-        new_consumption = consumption_from_response(response)
-        consumption = pd.concat([new_consumption, current_consumption])
+        new_consumption = self.consumption_from_response(response)
+        consumption = TimeSeries.from_frame(current_consumption.dropna()).upsert(
+            TimeSeries.from_frame(new_consumption)
+        )
+        return consumption.frame()
 
-        return consumption.dropna().drop_duplicates().sort_index()
+    def meter_consumption_path(self, fuel):
+        """The consumption end point for a fuel"""
+        octopus = self.cfg["octopus"]
+        if fuel is self.FuelType.GAS:
+            return f"/gas-meter-points/{ octopus['mprn'] }/meters/{ octopus['g_serial'] }/consumption/"
+        return f"/electricity-meter-points/{ octopus['mpan'] }/meters/{ octopus['e_serial'] }/consumption/"
 
-    def update_consumption(
-        self, fuel=FuelType.ELECTRIC, original_consumption=pd.DataFrame([])
-    ):
+    def consumption_pages(self, fuel, **params):
         """
-        Assume that there is a single contiguous block of readings (with some
-        missing). Build upwards from that before starting to build downwards.
-        If there is not data, get some first.
+        All of the readings for a query, following the `next` cursor until
+        the last page, as one table.
         """
+        table, page = self._get_results(
+            self.meter_consumption_path(fuel), CONSUMPTION_SCHEMA, params
+        )
+        tables = [table]
+        while page.get("next"):
+            table, page = self._get_results(page["next"], CONSUMPTION_SCHEMA)
+            tables.append(table)
+        return pa.concat_tables(tables)
+
+    def backfill_windows(self, original_consumption=pd.DataFrame([])):
+        """
+        Split the time from OCTOPUS_JOIN_DATETIME to now that isn't covered by
+        the current readings into fixed windows. A window holds at most
+        CONSUMPTION_PAGE_SIZE half hours, so each normally needs one request.
+        """
+        original_consumption = TimeSeries.from_frame(original_consumption)
+        if original_consumption.empty:
+            return self.windows_around()
+        return self.windows_around(
+            original_consumption.min(), original_consumption.max()
+        )
 
-        max_page_size = int(self.cfg["octopus"]["CONSUMPTION_PAGE_SIZE"])
+    def windows_around(self, first=None, last=None):
+        """
+        As backfill_windows, for readings held from `first` to `last`, or
+        none at all if they are None.
+        """
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        window = pd.Timedelta("30 m") * page_size
         octopus_join_datetime = pd.to_datetime(
-            self.cfg["octopus"]["OCTOPUS_JOIN_DATETIME"], utc=True
+            octopus["OCTOPUS_JOIN_DATETIME"], utc=True
         )
         now = pd.Timestamp.now(tz="utc")
 
-        if original_consumption.empty:
-            original_consumption = self.consumption(fuel, page_size=max_page_size)
-
-        original_max = original_consumption.index.max()
-        original_min = original_consumption.index.min()
-
-        def additional_consuption(min_time, max_time):
-            """
-            Working from an initial data set, add extra consumption before and
-            after the current time series data
-            """
-            new_consumption = pd.DataFrame([])
-
-            previous_min = max_time
-            new_min = min_time
-
-            while (new_min < previous_min) and (max_time > min_time):
-                previous_min = new_min
-                old_consumption = new_consumption
-                new_consumption = self.consumption(
-                    fuel,
-                    period_from=min_time.isoformat(),
-                    period_to=max_time.isoformat(),
-                    page_size=max_page_size,
-                )
-                new_consumption = (
-                    pd.concat([old_consumption, new_consumption])
-                    .dropna()
-                    .drop_duplicates()
-                )
-                new_min = new_consumption.index.min()
+        if first is None:
+            ranges = [(octopus_join_datetime, now)]
+        else:
+            ranges = [
+                (octopus_join_datetime, first),
+                (last + pd.Timedelta("30 m"), now),
+            ]
+
+        windows = []
+        for start, end in ranges:
+            while start < end:
+                windows.append((start, min(start + window, end)))
+                start += window
+        # Leave the window up to now open, so that it is the same request
+        # until new readings arrive, see httpcache.py
+        if windows and windows[-1][1] == now:
+            windows[-1] = (windows[-1][0], None)
+        return windows
+
+    @staticmethod
+    def window_params(window, page_size):
+        """Query for the readings in a (start, end) window, end None for now"""
+        start, end = window
+        params = {"period_from": start.isoformat(), "page_size": page_size}
+        if end is not None:
+            params["period_to"] = end.isoformat()
+        return params
+
+    @staticmethod
+    def merge_consumption(original_consumption, results):
+        """
+        Merge the results of every window, one table, with the current
+        readings, as a TimeSeries with one reading per interval_start; the
+        new readings win.
+        """
+        original_consumption = TimeSeries.from_frame(original_consumption)
+        if results.num_rows == 0:
+            return original_consumption
+        return original_consumption.upsert(
+            TimeSeries.from_table(results, "interval_start")
+        )
+
+    def gap_results(self, fuel, gaps):
+        """
+        Results for just the gaps in the readings, (start, end) pairs, see
+        gaps.py. Fetched in parallel like the backfill.
+        """
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        concurrency = octopus.getint("BACKFILL_CONCURRENCY", 4)
 
-            return new_consumption
+        def results(gap):
+            return self.consumption_pages(fuel, **self.window_params(gap, page_size))
 
-        newer_consumption = additional_consuption(original_max, now)
-        older_consumption = additional_consuption(octopus_join_datetime, original_min)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pages = list(executor.map(results, gaps))
+        return pa.concat_tables([CONSUMPTION_SCHEMA.empty_table(), *pages])
 
-        new_consumption = pd.concat(
-            [older_consumption, original_consumption, newer_consumption]
-        )
+    def update_consumption(
+        self, fuel=FuelType.ELECTRIC, original_consumption=pd.DataFrame([])
+    ):
+        """
+        Fill in the readings from OCTOPUS_JOIN_DATETIME to now, either side of
+        the current block. The missing time is split into windows that are
+        fetched in parallel, up to BACKFILL_CONCURRENCY at a time, and the
+        results are merged once at the end.
+        """
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        concurrency = octopus.getint("BACKFILL_CONCURRENCY", 4)
+
+        def window_results(window):
+            return self.consumption_pages(fuel, **self.window_params(window, page_size))
+
+        windows = self.backfill_windows(original_consumption)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pages = list(executor.map(window_results, windows))
 
-        return new_consumption.dropna().drop_duplicates().sort_index()
+        results = pa.concat_tables([CONSUMPTION_SCHEMA.empty_table(), *pages])
+        return self.merge_consumption(original_consumption, results)
 
     def gas_cost(g_consumption, start_date, end_date):
         selection = g_consumption[
@@ -1,67 +1,45 @@
 # https://developer.octopus.energy/docs/api/
-
-from pathlib import Path
-from os.path import exists
+"""Octopus data through Arrow rather than pandas
+
+Both clients parse API pages into typed Arrow columns as they stream in, see
+pages.py. ArrowOctopusEnergy keeps them as Arrow tables: they are merged and
+deduplicated with pyarrow.compute and written to the ParquetStore without
+ever becoming pandas frames. update_data brings the store up to date this
+way:
+
+python octopus_2.py
+
+Only this bulk path is Arrow throughout. OctopusData (app.py) can be given
+an ArrowOctopusEnergy, as it is an OctopusEnergy, but its update goes the
+usual way: the tables become TimeSeries, for the charts and totals, and
+new rows are written back as frames.
+
+table_from_binary_json and parse_page read a whole page that is already in
+memory, such as a saved response. benchmarks/ingest.py compares them, and
+the streaming parser, with pandas for parse time and peak memory.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import configparser as cp
 import math
 import sys
-import types
-import requests
 import pyarrow as pa
-from pyarrow import json, concat_tables
+from pyarrow import json
 import pyarrow.compute as pc
-import pyarrow.parquet as pq
-from strictyaml import load
-
-
-# by default, strictyaml brings everything in as text
-# cast to required types as required, or use a schema
-cfg = load(Path("config.yml").read_text())
-
-
-def octopus_session() -> requests.Session:
-    """
-    Setup session using secret api key from Octopus
-    dashboard
-    """
-    session = requests.Session()
-    session.auth = (cfg["API_KEY"], "")
-    return session
-
-
-def _session_get(session: requests.Session, url: str, parameters: dict) -> pa.Table:
-    """
-    Get octopus data and return a pyarrow table
-    """
-    response = session.get(url, params=parameters)
-    table = table_from_binary_json(response.content)
-
-    return table
-
-
-def get_electricity_meter_consumption(
-    session: requests.Session, page_size: int = 48
-) -> pa.Table:
-    """
-    Get electric consumption data
-    https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
-    """
-    parameters = {"page_size": page_size}
-    url = f"{cfg['BASE_URL']}/v1/electricity-meter-points/{cfg['MPAN']}/meters/{cfg['E_SERIAL']}/consumption/"
-    table = _session_get(session, url, parameters)
-    return table
-
-
-def get_gas_meter_consumption(
-    session: requests.Session, page_size: int = 48
-) -> pa.Table:
-    """
-    Get gas consumption data
-    https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
-    """
-    parameters = {"page_size": page_size}
-    url = f"{cfg['BASE_URL']}/v1/gas-meter-points/{cfg['MPRN']}/meters/{cfg['G_SERIAL']}/consumption/"
-    table = _session_get(session, url, parameters)
-    return table
+from octopus import OctopusEnergy
+from pages import AGILE_SCHEMA, CONSUMPTION_SCHEMA
+from store import ParquetStore, unique_rows
+from timeseries import SLOT
+
+
+def page_schema(results_schema):
+    """The schema of a page of API results"""
+    return pa.schema(
+        [
+            ("count", pa.int64()),
+            ("next", pa.string()),
+            ("results", pa.list_(pa.struct(list(results_schema)))),
+        ]
+    )
 
 
 def minimum_block_size(thing):
@@ -74,135 +52,111 @@ def minimum_block_size(thing):
     return block_size
 
 
-def table_from_binary_json(binary_json) -> pa.Table:
+def table_from_binary_json(binary_json, schema=None) -> pa.Table:
     """
-    From the binary JSON content, build an arrow table
+    From the binary JSON content, build an arrow table. With a schema, the
+    fields are parsed as those types and anything else is ignored.
     """
     # This block size needs to be large enough to handle the entire JSON data
     content_block_size = minimum_block_size(binary_json)
-    read_options = pa.json.ReadOptions(block_size=content_block_size)
+    read_options = json.ReadOptions(block_size=content_block_size)
+    if schema is None:
+        parse_options = json.ParseOptions()
+    else:
+        parse_options = json.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior="ignore"
+        )
     reader = pa.BufferReader(binary_json)
-    table_from_json = pa.json.read_json(reader, read_options=read_options)
+    table_from_json = json.read_json(
+        reader, read_options=read_options, parse_options=parse_options
+    )
     return table_from_json
 
 
-def results_table(table_from_json):
+def results_table(table_from_json, schema=None):
     """
     Transform the results data to a table
     """
+    if schema is None:
+        schema = pa.schema(table_from_json.schema.field("results").type.value_type)
     flattened_results = pc.list_flatten(table_from_json["results"])
     table = pa.Table.from_batches(
-        [pa.RecordBatch.from_struct_array(c) for c in flattened_results.chunks]
+        [pa.RecordBatch.from_struct_array(c) for c in flattened_results.chunks],
+        schema=schema,
     )
     return table
 
 
-def update_data(session, data=None):
-    """
-    Update the data for:
-    Gas consumption
-    Electricity consumption
-    Agile unit rates
-    """
-
-    def write_data(data):
-        pq.write_table(data.agile_tariff_rates, "./agile_tariff_rates.parquet")
-        pq.write_table(
-            data.electricity_consumption, "./electricity_consumption.parquet"
-        )
-        pq.write_table(data.gas_consumption, "./gas_consumption.parquet")
-
-    def get_remaining_data(data):
-        remaining_data = data
-
-        return remaining_data
-
-    def get_initial_data():
-        data = types.SimpleNamespace()
-        if exists("./agile_tariff_rates.parquet"):
-            data.agile_tariff_rates = pq.read_table("./agile_tariff_rates.parquet")
-        else:
-            data.agile_tariff_rates = get_agile_tarriff_rates(session, current=None)
-
-        if exists("./electricity_consumption.parquet"):
-            data.electricity_consumption = pq.read_table(
-                "./electricity_consumption.parquet"
-            )
-        else:
-            electricity_consumption = get_electricity_meter_consumption(
-                session, page_size=25000
-            )
-            data.electricity_consumption = results_table(electricity_consumption)
-
-        if exists("./gas_consumption.parquet"):
-            data.gas_consumption = pq.read_table("./gas_consumption.parquet")
-        else:
-            gas_consumption = get_gas_meter_consumption(session, page_size=25000)
-            data.gas_consumption = results_table(gas_consumption)
-
-        write_data(data)
-        return data
-
-    if data is None:
-        data = get_initial_data()
-
-    gas_consumption = get_gas_meter_consumption(session)
-    electricity_consumption = get_electricity_meter_consumption(session)
+def parse_page(content, schema):
+    """(results as a table, next page URL or None) from a page of JSON"""
+    page = table_from_binary_json(content, page_schema(schema))
+    return results_table(page, schema), page["next"][0].as_py()
 
-    write_data(data)
-    return data
 
-
-def electricity_meter_point(session):
+class ArrowOctopusEnergy(OctopusEnergy):
     """
-    https://developer.octopus.energy/docs/api/#electricity-meter-points
+    OctopusEnergy, with tables to be written straight to the store by
+    update_data. Everything else it inherits, so OctopusData.update works
+    with it as with OctopusEnergy, not through these tables.
     """
-    url = f"{cfg['BASE_URL']}/v1/electricity-meter-points/{cfg['MPAN']}/"
-    return_value = session.get(url)
-    return return_value.json()
 
+    def window_tables(self, fuel, windows):
+        """
+        Readings for (start, end) windows or gaps, fetched in parallel up to
+        BACKFILL_CONCURRENCY at a time, as one deduplicated table
+        """
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        concurrency = octopus.getint("BACKFILL_CONCURRENCY", 4)
 
-def electricity_tariff_unit_rates(session, product_code, tariff_code):
-    """
-    https://developer.octopus.energy/docs/api/#list-tariff-charges
-    """
-    url = f"{cfg['BASE_URL']}/v1/products/{product_code}/electricity-tariffs/{tariff_code}/standard-unit-rates/"
-    response = session.get(url)
-    return_value = response.content
-    return return_value
-
-
-def agile_tariff_unit_rates(session):
-    """
-    Electricity unit rates for given GSP
-    """
-    gsp = electricity_meter_point(session)["gsp"]
+        def window_table(window):
+            return self.consumption_pages(fuel, **self.window_params(window, page_size))
 
-    # Handle GSPs passed with leading underscore
-    if len(gsp) == 2:
-        gsp = gsp[1]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            tables = list(executor.map(window_table, windows))
+        if not tables:
+            return CONSUMPTION_SCHEMA.empty_table()
+        return unique_rows(pa.concat_tables(tables), "interval_start")
 
-    return_value = electricity_tariff_unit_rates(
-        session, product_code="AGILE-18-02-21", tariff_code="E-1R-AGILE-18-02-21-" + gsp
-    )
-    return return_value
+    def agile_table(self, last=None, page_size=1500):
+        """
+        The published Agile rates, one row per valid_from, only those after
+        the rate starting at `last` if given
+        """
+        params = {"page_size": page_size}
+        if last is not None:
+            params["period_from"] = (last + SLOT).strftime("%Y-%m-%dT%H:%M:%SZ")
+        table, _ = self._get_results(
+            self.unit_rates_path(self.household_tariff_code()), AGILE_SCHEMA, params
+        )
+        return unique_rows(table, "valid_from")
 
 
-def get_agile_tarriff_rates(session, current=None):
-    """
-    Get agile tarrif rates
+def update_data(client, store):
     """
-    response = agile_tariff_unit_rates(session)
-    new = results_table(response)
-
-    if current is None:
-        results = new
-    else:
-        results = pa.concat_tables([current, new])
+    Update the store's data for:
+    Gas consumption
+    Electricity consumption
+    Agile unit rates
+    Only what isn't already stored is fetched, and it is merged into the
+    month partitions it falls in as Arrow tables.
+    """
+    for fuel, dataset in (
+        (OctopusEnergy.FuelType.ELECTRIC, "electricity"),
+        (OctopusEnergy.FuelType.GAS, "gas"),
+    ):
+        if store.empty(dataset):
+            windows = client.windows_around()
+        else:
+            windows = client.windows_around(store.min(dataset), store.max(dataset))
+        store.write_table(dataset, client.window_tables(fuel, windows))
 
-    # do some kind of cleanup, time limiting it.
-    return results
+    store.write_table("agile_tariff", client.agile_table(store.max("agile_tariff")))
 
 
-s = octopus_session()
-app_data = update_data(s, None)
+if __name__ == "__main__":
+    cfg = cp.ConfigParser()
+    cfg.read("config.ini")
+    update_data(
+        ArrowOctopusEnergy(cfg), ParquetStore(cfg["octopus"].get("DATA_DIR", "./data"))
+    )
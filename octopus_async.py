@@ -0,0 +1,365 @@
+"""An asyncio version of the OctopusEnergy client
+
+Uses one pooled, keep-alive, httpx.AsyncClient so that requests made at the
+same time share connections. Independent resources (Agile rates, electricity
+and gas) can be fetched with asyncio.gather, so a refresh takes as long as
+the slowest call rather than the sum of all of them.
+https://www.python-httpx.org/async/
+"""
+import asyncio
+import json
+import logging
+import time
+import httpx
+import pandas as pd
+import pyarrow as pa
+from httpcache import ResponseCache, atee
+from metrics import (
+    API_BYTES,
+    API_PAGES,
+    API_REJECTED,
+    API_RETRIES,
+    acounted,
+    counted,
+    observe_request,
+    resource,
+)
+from octopus import OctopusEnergy
+from pages import (
+    AGILE_SCHEMA,
+    CHUNK_SIZE,
+    CONSUMPTION_SCHEMA,
+    aread_results,
+    read_results,
+)
+from timeseries import TimeSeries
+from transport import CircuitOpen, Transport
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOctopusEnergy(object):
+    """Get data from Octopus Energy using API credentials, without blocking"""
+
+    BASE_URL = OctopusEnergy.BASE_URL
+    DataUnavailable = OctopusEnergy.DataUnavailable
+    FuelType = OctopusEnergy.FuelType
+    meter_consumption_path = OctopusEnergy.meter_consumption_path
+    backfill_windows = OctopusEnergy.backfill_windows
+    windows_around = OctopusEnergy.windows_around
+    window_params = staticmethod(OctopusEnergy.window_params)
+    _url = OctopusEnergy._url
+    merge_consumption = staticmethod(OctopusEnergy.merge_consumption)
+    merge_rates = staticmethod(OctopusEnergy.merge_rates)
+    rates_params = staticmethod(OctopusEnergy.rates_params)
+    check_half_hourly = staticmethod(OctopusEnergy.check_half_hourly)
+    unit_rates_path = staticmethod(OctopusEnergy.unit_rates_path)
+    compared_tariff_codes = OctopusEnergy.compared_tariff_codes
+
+    def __init__(self, cfg, max_connections=10):
+        """Configuration as for OctopusEnergy"""
+        self.cfg = cfg
+        self.max_connections = max_connections
+        base_url = cfg["octopus"].get("BASE_URL")
+        if base_url:
+            self.BASE_URL = base_url.strip('"') + "/v1"
+        self.cache = ResponseCache.from_config(cfg)
+        self.transport = Transport.from_config(cfg)
+        self._client = None
+        self._region = None
+
+    @property
+    def client(self):
+        """
+        The connection pool. Created on first use so that it belongs to the
+        event loop that uses it.
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.BASE_URL,
+                auth=(self.cfg["octopus"]["api_key"], ""),
+                timeout=httpx.Timeout(
+                    self.transport.read_timeout,
+                    connect=self.transport.connect_timeout,
+                ),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _response(self, path, params=None):
+        """
+        The response to a GET request, its body not yet read, raising
+        DataUnavailable if not OK. Retried as OctopusEnergy._response.
+        """
+        transport = self.transport
+        name = resource(path)
+        attempt = 0
+        while True:
+            try:
+                await asyncio.sleep(transport.wait())
+            except CircuitOpen as e:
+                API_REJECTED.inc(resource=name)
+                raise self.DataUnavailable(str(e)) from e
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                # Complete URLs, such as `next` links, are used as they are.
+                # Passing any params, even {}, would make httpx replace their
+                # query string.
+                response = await self.client.send(
+                    self.client.build_request("GET", path, params=params),
+                    stream=True,
+                )
+            except httpx.HTTPError as e:
+                observe_request(started, path, "error")
+                status = "error"
+                error = self.DataUnavailable("Network exception")
+                cause = e
+            else:
+                if response.status_code == 200:
+                    transport.succeeded()
+                    return response
+                await response.aclose()
+                observe_request(started, path, response.status_code)
+                status = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                error = self.DataUnavailable(
+                    "Unexpected response status (%s)" % response.status_code
+                )
+                cause = None
+            delay = transport.retry_delay(attempt, status, retry_after)
+            if delay is None:
+                raise error from cause
+            API_RETRIES.inc(resource=name, status=status)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get(self, path, params=None):
+        """
+        Make a GET HTTP request, or reuse the response as OctopusEnergy._get
+        """
+        name = resource(path)
+        if self.cache is not None:
+            content = self.cache.read(self._url(path), params)
+            if content is not None:
+                API_BYTES.inc(len(content), resource=name, source="cache")
+                API_PAGES.inc(resource=name, source="cache")
+                return json.loads(content)
+        started = time.perf_counter()
+        response = await self._response(path, params)
+        try:
+            await response.aread()
+        except httpx.HTTPError as e:
+            observe_request(started, path, "error")
+            raise self.DataUnavailable("Network exception") from e
+        finally:
+            await response.aclose()
+        observe_request(started, path, 200)
+        API_BYTES.inc(len(response.content), resource=name, source="network")
+        API_PAGES.inc(resource=name, source="network")
+        if self.cache is not None:
+            self.cache.write(self._url(path), params, response.content)
+        return response.json()
+
+    async def _get_results(self, path, schema, params=None):
+        """As OctopusEnergy._get_results"""
+        url = self._url(path)
+        name = resource(path)
+        cached = None if self.cache is None else self.cache.body(url, params)
+        if cached is not None:
+            API_PAGES.inc(resource=name, source="cache")
+            chunks = counted(self.cache.chunks(cached, CHUNK_SIZE), name, "cache")
+            return await asyncio.to_thread(read_results, chunks, schema)
+        started = time.perf_counter()
+        response = await self._response(path, params)
+        try:
+            chunks = acounted(response.aiter_bytes(CHUNK_SIZE), name, "network")
+            if self.cache is None:
+                results = await aread_results(chunks, schema)
+            else:
+                with self.cache.recording(url, params) as f:
+                    results = await aread_results(atee(chunks, f), schema)
+        except httpx.HTTPError as e:
+            observe_request(started, path, "error")
+            raise self.DataUnavailable("Network exception") from e
+        except ValueError as e:
+            observe_request(started, path, "incomplete")
+            raise self.DataUnavailable("Incomplete response") from e
+        finally:
+            await response.aclose()
+        observe_request(started, path, 200)
+        API_PAGES.inc(resource=name, source="network")
+        return results
+
+    async def electricity_meter_point(self):
+        # See https://developer.octopus.energy/docs/api/#electricity-meter-points
+        return await self._get(
+            "/electricity-meter-points/%s/" % self.cfg["octopus"]["mpan"]
+        )
+
+    async def electricity_tariff_unit_rates(
+        self, product_code, tariff_code, params=None
+    ):
+        # See https://developer.octopus.energy/docs/api/#list-tariff-charges
+        return await self._get(
+            "/products/%s/electricity-tariffs/%s/standard-unit-rates/"
+            % (product_code, tariff_code),
+            params=params,
+        )
+
+    async def region(self):
+        """As OctopusEnergy.region"""
+        if self._region is None:
+            self._region = self.cfg["octopus"].get(
+                "REGION"
+            ) or OctopusEnergy.meter_point_region(await self.electricity_meter_point())
+        return self._region
+
+    async def household_tariff_code(self):
+        """As OctopusEnergy.household_tariff_code"""
+        return OctopusEnergy.tariff_code(
+            self.cfg["octopus"].get(
+                "AGILE_PRODUCT_CODE", OctopusEnergy.AGILE_PRODUCT_CODE
+            ),
+            await self.region(),
+        )
+
+    async def agile_tariff_unit_rates(self, **params):
+        """
+        Helper method to easily look-up the electricity unit rates for given GSP
+        """
+        tariff_code = await self.household_tariff_code()
+        return await self.electricity_tariff_unit_rates(
+            product_code=OctopusEnergy.product_code(tariff_code),
+            tariff_code=tariff_code,
+            params=params,
+        )
+
+    async def electricity_meter_consumption(self, **params):
+        """Get electricity consumption data"""
+        # See https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
+        return await self._get(
+            self.meter_consumption_path(self.FuelType.ELECTRIC), params=params
+        )
+
+    async def gas_meter_consumption(self, **params):
+        """Get gas consumption data"""
+        # See https://developer.octopus.energy/docs/api/#list-consumption-for-a-meter
+        return await self._get(
+            self.meter_consumption_path(self.FuelType.GAS), params=params
+        )
+
+    async def get_agile_tarriff_rates(
+        self, current_agile_rates=pd.DataFrame([]), page_size=1500
+    ):
+        """Get agile tarrif rates, see OctopusEnergy.tariff_rates"""
+        return await self.tariff_rates(
+            await self.household_tariff_code(), current_agile_rates, page_size
+        )
+
+    async def tariff_rates(
+        self, tariff_code, current_rates=pd.DataFrame([]), page_size=1500
+    ):
+        """As OctopusEnergy.tariff_rates"""
+        current_rates = TimeSeries.from_frame(current_rates)
+        rates, _ = await self._get_results(
+            self.unit_rates_path(tariff_code),
+            AGILE_SCHEMA,
+            self.rates_params(current_rates, page_size),
+        )
+        self.check_half_hourly(tariff_code, rates)
+        return self.merge_rates(current_rates, rates)
+
+    async def compared_tariff_rates(self, current_tariffs, page_size=1500):
+        """As OctopusEnergy.compared_tariff_rates, the tariffs at the same time"""
+
+        async def rates(tariff_code):
+            try:
+                return await self.tariff_rates(
+                    tariff_code,
+                    current_tariffs.get(tariff_code, TimeSeries()),
+                    page_size,
+                )
+            except ValueError as e:
+                logger.warning("Skipping tariff %s: %s", tariff_code, e)
+                return None
+
+        tariff_codes = self.compared_tariff_codes()
+        tariffs = await asyncio.gather(*(rates(code) for code in tariff_codes))
+        return {
+            tariff_code: tariff_rates
+            for tariff_code, tariff_rates in zip(tariff_codes, tariffs)
+            if tariff_rates is not None
+        }
+
+    async def consumption(
+        self, fuel=None, current_consumption=pd.DataFrame([]), **params
+    ):
+        if fuel is self.FuelType.ELECTRIC:
+            response = await self.electricity_meter_consumption(**params)
+
+        if fuel is self.FuelType.GAS:
+            response = await self.gas_meter_consumption(**params)
+
+        new_consumption = OctopusEnergy.consumption_from_response(response)
+        consumption = TimeSeries.from_frame(current_consumption.dropna()).upsert(
+            TimeSeries.from_frame(new_consumption)
+        )
+        return consumption.frame()
+
+    async def consumption_pages(self, fuel, **params):
+        """As OctopusEnergy.consumption_pages"""
+        table, page = await self._get_results(
+            self.meter_consumption_path(fuel), CONSUMPTION_SCHEMA, params
+        )
+        tables = [table]
+        while page.get("next"):
+            table, page = await self._get_results(page["next"], CONSUMPTION_SCHEMA)
+            tables.append(table)
+        return pa.concat_tables(tables)
+
+    async def gap_results(self, fuel, gaps):
+        """As OctopusEnergy.gap_results"""
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        semaphore = asyncio.Semaphore(octopus.getint("BACKFILL_CONCURRENCY", 4))
+
+        async def results(gap):
+            async with semaphore:
+                return await self.consumption_pages(
+                    fuel, **self.window_params(gap, page_size)
+                )
+
+        pages = await asyncio.gather(*(results(gap) for gap in gaps))
+        return pa.concat_tables([CONSUMPTION_SCHEMA.empty_table(), *pages])
+
+    async def update_consumption(
+        self, fuel=FuelType.ELECTRIC, original_consumption=pd.DataFrame([])
+    ):
+        """
+        As OctopusEnergy.update_consumption, the windows are fetched as
+        concurrent tasks, at most BACKFILL_CONCURRENCY at a time.
+        """
+        octopus = self.cfg["octopus"]
+        page_size = int(octopus["CONSUMPTION_PAGE_SIZE"])
+        semaphore = asyncio.Semaphore(octopus.getint("BACKFILL_CONCURRENCY", 4))
+
+        async def window_results(window):
+            async with semaphore:
+                return await self.consumption_pages(
+                    fuel, **self.window_params(window, page_size)
+                )
+
+        windows = self.backfill_windows(original_consumption)
+        pages = await asyncio.gather(*(window_results(w) for w in windows))
+
+        results = pa.concat_tables([CONSUMPTION_SCHEMA.empty_table(), *pages])
+        return self.merge_consumption(original_consumption, results)
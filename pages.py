@@ -0,0 +1,188 @@
+"""Streaming parser for pages of API results
+
+A page of results looks like {"count": ..., "next": ..., "results": [...]}.
+Rather than holding the whole body, and then a dict per reading, the
+response is fed in as it arrives. The run of complete objects in each chunk
+of the `results` array is cut out of the stream as raw JSON and, about every
+BATCH_SIZE objects, handed to Arrow's JSON reader, giving a RecordBatch of
+typed columns. So at most a chunk and a batch of raw JSON are held at a
+time, however big the page; everything else is compact columns.
+
+The objects in `results` are flat, as they are for consumption and tariff
+end points. The rest of the page, count, next and previous, is parsed once
+the array is done.
+https://arrow.apache.org/docs/python/json.html
+"""
+import json
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json
+
+TIMESTAMP = pa.timestamp("ns", tz="UTC")
+
+CONSUMPTION_SCHEMA = pa.schema(
+    [
+        ("consumption", pa.float64()),
+        ("interval_end", TIMESTAMP),
+        ("interval_start", TIMESTAMP),
+    ]
+)
+
+AGILE_SCHEMA = pa.schema(
+    [
+        ("value_exc_vat", pa.float64()),
+        ("value_inc_vat", pa.float64()),
+        ("valid_to", TIMESTAMP),
+        ("payment_method", pa.string()),
+        ("valid_from", TIMESTAMP),
+    ]
+)
+
+# Readings per RecordBatch
+BATCH_SIZE = 4096
+# Bytes read from the response at a time
+CHUNK_SIZE = 1 << 16
+
+RESULTS_START = re.compile(rb'"results"\s*:\s*\[')
+ESCAPED = re.compile(rb"\\.")
+
+
+def _outside_string(run):
+    """
+    True if the end of `run`, which starts between objects, isn't inside a
+    string: the quotes, less escaped ones, are paired.
+    """
+    if b"\\" in run:
+        run = ESCAPED.sub(b"", run)
+    return run.count(b'"') % 2 == 0
+
+
+def _find(buffer, character, start=0):
+    """First `character` at or after `start` outside a string, or -1"""
+    found = buffer.find(character, start)
+    while found >= 0 and not _outside_string(buffer[:found]):
+        found = buffer.find(character, found + 1)
+    return found
+
+
+def _rfind(buffer, character):
+    """Last `character` outside a string, or -1"""
+    found = buffer.rfind(character)
+    while found >= 0 and not _outside_string(buffer[:found]):
+        found = buffer.rfind(character, 0, found)
+    return found
+
+
+HEAD, RESULTS, TAIL = range(3)
+
+
+class ResultsStream(object):
+    """
+    Parse a page of results fed in chunk by chunk. feed() and close() return
+    the RecordBatches completed so far; after close(), `page` holds the
+    other fields of the page.
+    """
+
+    def __init__(self, schema, batch_size=BATCH_SIZE):
+        self.schema = schema
+        self.batch_size = batch_size
+        self.page = None
+        self._state = HEAD
+        self._buffer = b""
+        self._head = b""
+        self._tail = []
+        # runs of complete objects waiting to be made into a batch
+        self._objects = []
+        self._count = 0
+        self._page_schema = pa.schema([("results", pa.list_(pa.struct(list(schema))))])
+
+    def feed(self, chunk):
+        if self._state == TAIL:
+            self._tail.append(chunk)
+            return []
+        self._buffer += chunk
+        if self._state == HEAD:
+            start = RESULTS_START.search(self._buffer)
+            if start is None:
+                return []
+            self._head = self._buffer[: start.end() - 1]
+            self._buffer = self._buffer[start.end() :]
+            self._state = RESULTS
+
+        # as the objects are flat, a ] outside a string ends the array and a
+        # } outside a string ends an object
+        end = _find(self._buffer, b"]")
+        if end >= 0:
+            self._add(self._buffer[:end])
+            self._tail.append(self._buffer[end + 1 :])
+            self._buffer = b""
+            self._state = TAIL
+        else:
+            end = _rfind(self._buffer, b"}")
+            self._add(self._buffer[: end + 1])
+            self._buffer = self._buffer[end + 1 :]
+        if self._count >= self.batch_size:
+            return [self._batch()]
+        return []
+
+    def _add(self, run):
+        """Keep a run of complete objects for the next batch"""
+        if run.strip():
+            self._objects.append(run)
+            self._count += run.count(b"}")
+
+    def _batch(self):
+        """The objects collected so far as a RecordBatch"""
+        results = b"".join(self._objects).lstrip(b" \t\r\n,")
+        document = b'{"results":[' + results + b"]}"
+        self._objects = []
+        self._count = 0
+        table = pyarrow.json.read_json(
+            pa.BufferReader(document),
+            read_options=pyarrow.json.ReadOptions(
+                use_threads=False, block_size=len(document) + 1
+            ),
+            parse_options=pyarrow.json.ParseOptions(
+                explicit_schema=self._page_schema,
+                unexpected_field_behavior="ignore",
+            ),
+        )
+        flattened = pc.list_flatten(table["results"]).combine_chunks()
+        return pa.RecordBatch.from_struct_array(flattened)
+
+    def close(self):
+        if self._state != TAIL:
+            raise ValueError("Incomplete page of results")
+        batches = [self._batch()] if self._objects else []
+        self.page = json.loads(self._head + b"[]" + b"".join(self._tail))
+        del self.page["results"]
+        return batches
+
+
+def read_results(chunks, schema, batch_size=BATCH_SIZE):
+    """(results as a table, the rest of the page) from an iterable of chunks"""
+    stream = ResultsStream(schema, batch_size)
+    batches = []
+    for chunk in chunks:
+        batches.extend(stream.feed(chunk))
+    batches.extend(stream.close())
+    return pa.Table.from_batches(batches, schema), stream.page
+
+
+async def aread_results(chunks, schema, batch_size=BATCH_SIZE):
+    """As read_results, from an async iterable of chunks"""
+    stream = ResultsStream(schema, batch_size)
+    batches = []
+    async for chunk in chunks:
+        batches.extend(stream.feed(chunk))
+    batches.extend(stream.close())
+    return pa.Table.from_batches(batches, schema), stream.page
+
+
+def to_frame(table, key):
+    """Results as a frame indexed by `key`, as the API clients return them"""
+    frame = table.to_pandas().set_index(key)
+    frame.index = pd.DatetimeIndex(frame.index, name=key)
+    return frame
@@ -0,0 +1,123 @@
+"""Call profiles of slow requests, if PROFILE_SLOW_REQUESTS is set
+
+With PROFILE_SLOW_REQUESTS seconds in config.ini, every request is run
+under cProfile and any that takes longer has its profile saved to
+PROFILE_DIR (default DATA_DIR/profiles), one .prof file per request, to
+read with pstats or snakeviz. Profiling slows every request down, so it is
+off unless asked for.
+
+Plain (def) end points run in a worker thread, which the profiler on the
+event loop can't see, so ProfiledRoute gives them a profiler of their own
+and the two are saved together. Only one request at a time can have the
+event loop profiled; one that overlaps it just has its end point profiled.
+"""
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
+import functools
+import os
+from os.path import join
+import pstats
+import re
+import time
+from fastapi.routing import APIRoute
+
+# the profilers for the current request, None if it isn't being profiled
+PROFILES = ContextVar("profiles", default=None)
+
+
+def profiled(endpoint):
+    """A plain end point that profiles itself when its request is"""
+    if asyncio.iscoroutinefunction(endpoint):
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profiles = PROFILES.get()
+        if profiles is None:
+            return endpoint(*args, **kwargs)
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        return profile.runcall(endpoint, *args, **kwargs)
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """An APIRoute whose end point can be profiled in its worker thread"""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled(endpoint), **kwargs)
+
+
+class SlowRequestProfiler(object):
+    """Profiles requests, keeping those slower than `threshold` seconds"""
+
+    def __init__(self, threshold, directory):
+        self.threshold = threshold
+        self.directory = directory
+        self._loop_profile = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        """The profiler set up in config.ini, or None if it is off"""
+        octopus = cfg["octopus"]
+        threshold = octopus.getfloat("PROFILE_SLOW_REQUESTS", 0)
+        if threshold <= 0:
+            return None
+        return cls(
+            threshold,
+            octopus.get(
+                "PROFILE_DIR", join(octopus.get("DATA_DIR", "./data"), "profiles")
+            ),
+        )
+
+    def path(self, method, url_path, seconds):
+        name = re.sub(r"[^A-Za-z0-9]+", "_", url_path).strip("_") or "root"
+        return join(
+            self.directory,
+            "%s-%s-%s-%.3fs.prof"
+            % (time.strftime("%Y%m%dT%H%M%S"), method, name, seconds),
+        )
+
+    @contextmanager
+    def profile(self, method, url_path):
+        """
+        Profile the block, the event loop's part of a request, and any plain
+        end point it runs. Saved if it was slow.
+        """
+        profiles = []
+        loop_profile = None
+        if self._loop_profile is None:
+            loop_profile = self._loop_profile = cProfile.Profile()
+            profiles.append(loop_profile)
+        token = PROFILES.set(profiles)
+        started = time.perf_counter()
+        if loop_profile is not None:
+            loop_profile.enable()
+        try:
+            yield
+        finally:
+            if loop_profile is not None:
+                loop_profile.disable()
+                self._loop_profile = None
+            PROFILES.reset(token)
+            seconds = time.perf_counter() - started
+            if seconds >= self.threshold:
+                self.save(profiles, self.path(method, url_path, seconds))
+
+    def save(self, profiles, path):
+        """The profiles, merged into one file; those with no calls are left out"""
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(path)
@@ -0,0 +1,151 @@
+"""Queries over the stored history, reading only the months they need
+
+The parquet store (store.py) can be queried in place, without loading the
+history into memory. Each dataset, e.g. gas, gas_daily or agile_tariff, is
+an Arrow dataset of its monthly partitions, each one tagged with the range
+of timestamps the manifest says it holds. A time range, given as start and
+end or as a WHERE on the timestamp column, then skips every other month
+without opening its file, and only the columns asked for are read; within
+a file, parquet row group statistics do the same.
+
+    history = History(ParquetStore("./data"))
+    history.scan("gas", ["consumption"], start="2024-01-01", end="2024-02-01")
+    history.sql(
+        "SELECT date_trunc('week', interval_start) AS week, "
+        "sum(consumption) FROM gas_daily GROUP BY week ORDER BY week"
+    )
+
+scan() needs nothing but pyarrow. sql() needs duckdb (pip install duckdb),
+which reads the same Arrow datasets, passing its filters and columns down
+to them. Queries are read only: one SELECT, over the datasets only, with
+no access to other files, and at most QUERY_ROW_LIMIT rows.
+
+main.py serves both, at /query/{dataset} and /query?sql=.
+"""
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+from store import index_column
+
+try:
+    import duckdb
+except ImportError:
+    # scan() still works, sql() raises QueryUnavailable
+    duckdb = None
+
+SELECT = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+
+
+class QueryError(ValueError):
+    """A query that can't be answered, e.g. an unknown dataset or column"""
+
+
+class QueryUnavailable(Exception):
+    """SQL was asked for without duckdb installed"""
+
+
+def timestamp(value):
+    """A time, UTC if no zone is given, or None"""
+    if value is None:
+        return None
+    try:
+        value = pd.Timestamp(value)
+    except ValueError as e:
+        raise QueryError("Not a time: %s" % value) from e
+    return value.tz_localize("UTC") if value.tz is None else value.tz_convert("UTC")
+
+
+class History(object):
+    """Read only queries over a ParquetStore"""
+
+    def __init__(self, store, row_limit=100000):
+        self.store = store
+        self.row_limit = row_limit
+
+    @classmethod
+    def from_config(cls, cfg, store):
+        return cls(store, cfg["octopus"].getint("QUERY_ROW_LIMIT", 100000))
+
+    def datasets(self):
+        return sorted(
+            name for name in self.store.manifest if not self.store.empty(name)
+        )
+
+    def dataset(self, name):
+        """
+        The dataset's partitions as an Arrow dataset, each with the range
+        of timestamps in it, so that filters on time skip whole files
+        """
+        if name not in self.datasets():
+            raise QueryError("Unknown dataset %s" % name)
+        keys = self.store.partitions(name)
+        paths = [self.store._partition_path(name, key) for key in keys]
+        # partitions of one dataset are all written alike
+        schema = pq.read_schema(paths[-1]).remove_metadata()
+        column = index_column(name)
+        kind = schema.field(column).type
+        ranges = []
+        for key in keys:
+            entry = self.store.manifest[name][key]
+            ranges.append(
+                (ds.field(column) >= pa.scalar(pd.Timestamp(entry["min"]), kind))
+                & (ds.field(column) <= pa.scalar(pd.Timestamp(entry["max"]), kind))
+            )
+        return ds.FileSystemDataset.from_paths(
+            paths,
+            schema=schema,
+            format=ds.ParquetFileFormat(),
+            filesystem=pyarrow.fs.LocalFileSystem(),
+            partitions=ranges,
+        )
+
+    def scan(self, name, columns=None, start=None, end=None):
+        """
+        The rows of a dataset in [start, end), oldest first, with just
+        `columns` and the timestamp, as an Arrow table
+        """
+        key = index_column(name)
+        dataset = self.dataset(name)
+        unknown = set(columns or ()) - set(dataset.schema.names)
+        if unknown:
+            raise QueryError("Unknown columns %s" % ", ".join(sorted(unknown)))
+        columns = [key] + [c for c in columns or dataset.schema.names if c != key]
+        start, end = timestamp(start), timestamp(end)
+        condition = None
+        if start is not None:
+            condition = ds.field(key) >= start
+        if end is not None:
+            before = ds.field(key) < end
+            condition = before if condition is None else condition & before
+        table = dataset.head(self.row_limit, columns=columns, filter=condition)
+        return table.sort_by(key)
+
+    def sql(self, query):
+        """
+        The result of one SELECT over the datasets, each a table by its own
+        name (quoted if it has a hyphen, "tariff_E-1R-..."), as an Arrow
+        table of up to row_limit rows
+        """
+        if duckdb is None:
+            raise QueryUnavailable("SQL queries need duckdb, pip install duckdb")
+        if not SELECT.match(query):
+            raise QueryError("Only SELECT queries can be run")
+        connection = duckdb.connect()
+        try:
+            for name in self.datasets():
+                connection.register(name, self.dataset(name))
+            # nothing but the datasets registered above can be read
+            connection.execute("SET enable_external_access = false")
+            connection.execute("SET lock_configuration = true")
+            result = connection.execute(
+                "SELECT * FROM (%s) LIMIT %d" % (query, self.row_limit)
+            ).arrow()
+            # a table, or from duckdb 1.5 a reader of one
+            return result.read_all() if hasattr(result, "read_all") else result
+        except duckdb.Error as e:
+            raise QueryError(str(e)) from e
+        finally:
+            connection.close()
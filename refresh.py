@@ -0,0 +1,106 @@
+"""Background refresh of the Octopus data
+
+A refresher holds one household's snapshot and refreshes it with the
+asyncio client, when households.py says it is due. Each refresh works on a
+shallow copy of the current data, so the snapshot handed to the endpoints
+is never changed after it has been published; the endpoints only ever read
+it.
+
+Agile rates for the next day are published in the late afternoon (around
+16:00 UK time), so after AGILE_PUBLISH_HOUR the refresher polls more often
+until tomorrow's rates have arrived.
+"""
+import copy
+from dataclasses import dataclass
+from datetime import timedelta
+import pandas as pd
+
+UK_TIMEZONE = "Europe/London"
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """A published, read only, copy of the data and when it was refreshed"""
+
+    data: object
+    refreshed_at: pd.Timestamp
+
+    def age(self):
+        """Age of the snapshot in whole seconds"""
+        return int((pd.Timestamp.now(tz="UTC") - self.refreshed_at).total_seconds())
+
+
+def agile_rates_complete(agile_tariff, now):
+    """
+    True if the stored Agile rates already run to the end of tomorrow, UK time,
+    so there is nothing new to wait for. `agile_tariff` is a TimeSeries.
+    """
+    if agile_tariff.empty:
+        return False
+    end_of_tomorrow = (
+        now.tz_convert(UK_TIMEZONE).normalize() + timedelta(days=2)
+    ).tz_convert("UTC")
+    return agile_tariff.max() + pd.Timedelta("30 m") >= end_of_tomorrow
+
+
+def next_refresh_delay(cfg, agile_tariff, now=None):
+    """
+    Seconds until the next refresh.
+
+    Normally REFRESH_INTERVAL. After AGILE_PUBLISH_HOUR (UK time), and until
+    tomorrow's rates have been seen, AGILE_REFRESH_INTERVAL. Before
+    AGILE_PUBLISH_HOUR the delay is shortened so the first poll lands on
+    the publication time.
+    """
+    if now is None:
+        now = pd.Timestamp.now(tz="UTC")
+    octopus = cfg["octopus"]
+    interval = octopus.getint("REFRESH_INTERVAL", 30 * 60)
+    agile_interval = octopus.getint("AGILE_REFRESH_INTERVAL", 5 * 60)
+    publish_hour = octopus.getint("AGILE_PUBLISH_HOUR", 16)
+
+    if agile_rates_complete(agile_tariff, now):
+        return interval
+
+    local_now = now.tz_convert(UK_TIMEZONE)
+    publish_time = local_now.normalize() + timedelta(hours=publish_hour)
+    if local_now >= publish_time:
+        return min(interval, agile_interval)
+    return min(interval, max(1, int((publish_time - local_now).total_seconds())))
+
+
+class Refresher(object):
+    """Refresh the Octopus data and publish snapshots"""
+
+    def __init__(self, cfg, octopus_client, data, refreshed_at=None):
+        """
+        `octopus_client` is an AsyncOctopusEnergy. `data` is an OctopusData,
+        loaded or restored, that becomes the first snapshot so that requests
+        can be served straight away. `refreshed_at` is when it was last
+        refreshed, if not now.
+        """
+        self.cfg = cfg
+        self.client = octopus_client
+        if refreshed_at is None:
+            refreshed_at = pd.Timestamp.now(tz="UTC")
+        self._snapshot = Snapshot(data, refreshed_at)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def publish(self, data, refreshed_at=None):
+        """
+        Replace the snapshot's data with the same data, more fully loaded,
+        or with data another process refreshed at `refreshed_at`
+        """
+        if refreshed_at is None:
+            refreshed_at = self._snapshot.refreshed_at
+        self._snapshot = Snapshot(data, refreshed_at)
+
+    async def refresh(self):
+        """Update a copy of the current data and publish it"""
+        data = copy.copy(self._snapshot.data)
+        await data.update_async(self.client)
+        self._snapshot = Snapshot(data, pd.Timestamp.now(tz="UTC"))
+        return self._snapshot
@@ -0,0 +1,121 @@
+"""Hourly, daily, weekly and monthly consumption totals
+
+Kept for each fuel as tables of (consumption, readings) by bucket, stored in
+the ParquetStore next to the raw readings as e.g. gas_hourly. New readings
+are added to the buckets they fall in, and corrected ones the difference
+from the reading they replace; nothing is recalculated from the full
+history, and only the touched buckets are written back.
+
+The raw readings are saved first, then the totals, then DATA_DIR/rollups.json
+records the version of the raw readings (ParquetStore.version) the totals
+count. If it doesn't match, after a crash between the two or readings
+written by backfill.py, the fuel's totals are built again from its readings.
+
+Buckets are UTC, as resample gives on the raw readings. Weeks end on Sunday
+and are labelled with it, as in weekly.csv.
+"""
+import json
+import os
+from os.path import exists, join
+import pandas as pd
+from timeseries import TimeSeries
+
+PERIODS = {"hourly": "H", "daily": "D", "weekly": "W", "monthly": "MS"}
+# the version of each fuel's raw readings its totals count
+MARKS_FILE = "rollups.json"
+
+
+def rollup(readings, freq):
+    """Total consumption and number of readings in each bucket with readings"""
+    if readings.empty:
+        return pd.DataFrame(columns=["consumption", "readings"])
+    grouped = readings["consumption"].resample(freq)
+    table = pd.DataFrame({"consumption": grouped.sum(), "readings": grouped.count()})
+    return table[table["readings"] > 0]
+
+
+class Rollups(object):
+    """
+    Totals for every fuel and period. add() returns a new Rollups, so one
+    that has been published in a snapshot is never changed.
+    """
+
+    def __init__(self, store, tables=None):
+        self.store = store
+        self.tables = {} if tables is None else tables
+
+    @classmethod
+    def load(cls, store, consumption):
+        """
+        Read the stored totals for each fuel in `consumption`, a dict of raw
+        readings, frames or TimeSeries, by fuel. Totals that haven't been
+        stored yet, or don't count the stored readings, are built from the
+        raw readings.
+        """
+        marks = load_marks(store)
+        tables = {}
+        for fuel, readings in consumption.items():
+            counted = marks.get(fuel) == store.version(fuel)
+            for period, freq in PERIODS.items():
+                dataset = "%s_%s" % (fuel, period)
+                if store.empty(dataset) or not counted:
+                    if isinstance(readings, TimeSeries):
+                        readings = readings.frame()
+                    table = rollup(readings, freq)
+                    store.write(dataset, table)
+                else:
+                    table = store.read(dataset)
+                tables[fuel, period] = table
+        rollups = cls(store, tables)
+        rollups.mark(consumption)
+        return rollups
+
+    def add(self, fuel, readings, replaced=None):
+        """
+        Add readings that have been saved to the store, new or corrected.
+        `replaced` are the readings the corrected ones replace, which are
+        taken away. Only the buckets they touch are written to the store.
+        """
+        if readings.empty:
+            return self
+        tables = dict(self.tables)
+        for period, freq in PERIODS.items():
+            change = rollup(readings, freq)
+            if replaced is not None and not replaced.empty:
+                change = change.sub(rollup(replaced, freq), fill_value=0)
+            current = tables.get((fuel, period))
+            if current is None or current.empty:
+                table = change
+            else:
+                table = current.add(change, fill_value=0)
+            table["readings"] = table["readings"].astype("int64")
+            tables[fuel, period] = table
+            self.store.write("%s_%s" % (fuel, period), table.loc[change.index])
+        rollups = Rollups(self.store, tables)
+        rollups.mark([fuel])
+        return rollups
+
+    def mark(self, fuels):
+        """Record that the totals of `fuels` count the stored readings"""
+        if self.store.read_only:
+            return
+        marks = load_marks(self.store)
+        marks.update({fuel: self.store.version(fuel) for fuel in fuels})
+        os.makedirs(self.store.root, exist_ok=True)
+        path = join(self.store.root, MARKS_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(marks, f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, fuel, period):
+        """Totals for a fuel, e.g. get("gas", "daily")"""
+        return self.tables.get((fuel, period), rollup(pd.DataFrame([]), None))
+
+
+def load_marks(store):
+    """The raw readings' versions by fuel, as saved by Rollups.mark"""
+    path = join(store.root, MARKS_FILE)
+    if not exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,63 @@
+"""Histograms of hourly gas use for every heating season at once
+
+A heating season runs from October to the following September (the start
+month is configurable) and is named after the year it ends in, so winter
+2021/22 is season 2022. Each hourly reading is given a season number and a
+bin number, and one np.bincount over season * bins + bin counts every
+season's histogram in a single pass, with no sorting and nothing to add by
+hand for a new year.
+"""
+import numpy as np
+
+# Volume correction * Calorific Value / convert from joules
+# consumption * GAS_CONVERSION_FACTOR = kWh
+GAS_CONVERSION_FACTOR = 1.02264 * 39.1 / 3.6
+
+
+def season_of(index, start_month=10):
+    """Season, the year it ends in, for each timestamp of an index"""
+    years = index.year.to_numpy()
+    if start_month == 1:
+        # January to December ends in the same year
+        return years
+    return years + (index.month.to_numpy() >= start_month)
+
+
+def season_histograms(
+    hourly,
+    bins=40,
+    value_range=(0, 20),
+    threshold=0.1,
+    factor=GAS_CONVERSION_FACTOR,
+    start_month=10,
+):
+    """
+    Histograms of hourly use above `threshold`, converted with `factor`,
+    for every season. Returns (left edges of the bins, {season: counts}).
+    Values outside `value_range` go in the first or last bin.
+    """
+    low, high = value_range
+    width = (high - low) / bins
+    edges = low + width * np.arange(bins)
+
+    used = hourly.to_numpy() > threshold
+    if not used.any():
+        return edges, {}
+    values = hourly.to_numpy()[used] * factor
+    seasons = season_of(hourly.index[used], start_month)
+
+    first = seasons.min()
+    season_number = seasons - first
+    bin_number = np.clip(
+        np.floor((values - low) * bins / (high - low)).astype(int), 0, bins - 1
+    )
+    counts = np.bincount(
+        season_number * bins + bin_number,
+        minlength=(season_number.max() + 1) * bins,
+    ).reshape(-1, bins)
+
+    return edges, {
+        int(first + number): season_counts
+        for number, season_counts in enumerate(counts)
+        if season_counts.any()
+    }
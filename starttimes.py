@@ -0,0 +1,346 @@
+"""Cheapest start times for appliances on the Agile tariff
+
+An appliance is described by its usage pattern, the kWh it uses in each
+half hour from when it starts. The household's appliances are kept in a JSON
+registry. The cost of starting in every slot, for every
+appliance, is one matrix product of a sliding window view of the prices with
+the (zero padded) patterns, rather than a rolling apply per appliance.
+https://numpy.org/doc/stable/reference/generated/numpy.lib.stride_tricks.sliding_window_view.html
+"""
+import json
+import os
+import re
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from os.path import dirname, exists
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    import fcntl
+except ImportError:
+    # no flock, e.g. on Windows, where there is one process to serve
+    fcntl = None
+
+SLOT = pd.Timedelta("30 m")
+UK_TIMEZONE = "Europe/London"
+# a constraint's time of day, e.g. 07:00 or 7:30
+TIME_OF_DAY = re.compile(r"^([01]?\d|2[0-3]):[0-5]\d$")
+
+# The appliances a new registry starts with. kWh used in each half hour, in
+# time order, from the start of the programme
+APPLIANCES = {
+    "WashingMachine": [0.2, 0.2, 0.2, 0.2, 0.2, 1, 1],
+    # washing_up = (
+    #     (4.18 * 8 * 2 * 30)  # 8 litres per bowl, 2 bowls
+    #     / (60 * 60)  # temperature difference. J/g/°C
+    #     / (0.8)  # seconds. This gives kWh
+    # )  # efficiency
+    # unit_cost = 2.74 / 100
+    # 0.9 kwH over 2:44. But actually 1/2 in the first 1/2 hour, delayed by 20min, 1/2 1 hour later.
+    "GentleDishwasher": [0.4, 0, 0.5],
+    # 0.75 kWh over 3:58
+    "EcoDishwasher": [0.05, 0.05, 0.05, 0.05, 0.15, 0.15, 0.15, 0.1],
+    # 1.35 kWh over 3.11 hours
+    "IntenseDishwasher": [0.05, 0.1, 0.1, 0.1, 0.1, 0.5, 0.4],
+}
+
+
+def cost_matrix(prices, patterns):
+    """
+    Cost of starting each pattern in each slot, shape (slots, patterns).
+    Starts that would run past the last price are np.inf.
+    """
+    prices = np.asarray(prices, dtype=float)
+    if not patterns:
+        return np.empty((len(prices), 0))
+    longest = max(len(pattern) for pattern in patterns)
+    weights = np.zeros((len(patterns), longest))
+    for row, pattern in enumerate(patterns):
+        weights[row, : len(pattern)] = pattern
+
+    # pad so that every slot has a full window, then mask the starts that
+    # only fit because of the padding
+    padded = np.concatenate([prices, np.zeros(longest - 1)])
+    costs = sliding_window_view(padded, longest) @ weights.T
+    lengths = np.array([len(pattern) for pattern in patterns])
+    last_start = len(prices) - lengths
+    costs[np.arange(len(prices))[:, None] > last_start[None, :]] = np.inf
+    return costs
+
+
+def title_from_name(name):
+    """WashingMachine -> Washing Machine"""
+    return "".join(" " + c if c.isupper() else c for c in name).strip()
+
+
+class ApplianceRegistry(object):
+    """
+    Appliance usage patterns, saved as JSON. Every gunicorn worker has its
+    own registry on the same file, so it is read again whenever the file
+    has changed, and each change is made to what is in the file, under a
+    lock, rather than to this copy of it.
+    """
+
+    def __init__(self, path="./appliances.json"):
+        self.path = path
+        # bumped on every change, for caches of anything built from it
+        self._version = 0
+        self._stat = None
+        self._appliances = self._read()
+        self._stat = self._file_stat()
+
+    def _file_stat(self):
+        """What changes when the file is replaced, None if there is none"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        if exists(self.path):
+            with open(self.path) as f:
+                return json.load(f)
+        return {
+            name: {"title": title_from_name(name), "pattern": pattern}
+            for name, pattern in APPLIANCES.items()
+        }
+
+    def reload(self):
+        """Read the file again if another process has changed it"""
+        stat = self._file_stat()
+        if stat != self._stat:
+            self._appliances = self._read()
+            self._stat = stat
+            self._version += 1
+
+    @property
+    def appliances(self):
+        self.reload()
+        return self._appliances
+
+    @property
+    def version(self):
+        self.reload()
+        return self._version
+
+    def patterns(self):
+        return {name: a["pattern"] for name, a in self.appliances.items()}
+
+    def title(self, name):
+        return self.appliances[name]["title"]
+
+    def _change(self, change):
+        """
+        Apply `change` to the appliances in the file, with the file locked
+        so that no other process's change is lost, and save them
+        """
+        os.makedirs(dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            appliances = self._read()
+            change(appliances)
+            temporary = self.path + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(appliances, f, indent=1)
+            os.replace(temporary, self.path)
+            self._appliances = appliances
+            self._stat = self._file_stat()
+            self._version += 1
+
+    def add(self, name, pattern, title=None):
+        def add(appliances):
+            appliances[name] = {
+                "title": title or title_from_name(name),
+                "pattern": list(pattern),
+            }
+
+        self._change(add)
+
+    def remove(self, name):
+        self._change(lambda appliances: appliances.pop(name, None))
+
+
+def constraint_time(value, now, before=None):
+    """
+    A constraint as a UTC timestamp. Either a full timestamp, or a UK time of
+    day such as "07:00" which is taken as the next one after now or, when
+    `before` is given, the last one before that.
+    """
+    if value is None:
+        return None
+    if TIME_OF_DAY.match(value):
+        local_now = now.tz_convert(UK_TIMEZONE)
+        time_of_day = pd.Timedelta(value + ":00")
+        if before is None:
+            when = local_now.normalize() + time_of_day
+            if when <= local_now:
+                when += pd.Timedelta("1 D")
+        else:
+            local_before = before.tz_convert(UK_TIMEZONE)
+            when = local_before.normalize() + time_of_day
+            if when >= local_before:
+                when -= pd.Timedelta("1 D")
+        return when.tz_convert("UTC")
+    when = pd.Timestamp(value)
+    if when.tz is None:
+        when = when.tz_localize(UK_TIMEZONE)
+    return when.tz_convert("UTC")
+
+
+def check_constraint(value):
+    """
+    The constraint if constraint_time can read it, a time of day as HH:MM
+    or an ISO 8601 timestamp, otherwise ValueError
+    """
+    if value is None or TIME_OF_DAY.match(value):
+        return value
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("not a time of day, HH:MM, or a timestamp: %r" % value)
+    return value
+
+
+def tariff_version(agile_tariff):
+    """
+    Published rates don't change, so new rates mean a new length or end.
+    Households in different regions have the same times but not the same
+    prices, so a checksum of the prices is part of it too.
+    """
+    if agile_tariff.empty:
+        return (0, None, 0)
+    prices = agile_tariff["value_inc_vat"].to_numpy(dtype=np.float64)
+    return (len(agile_tariff), agile_tariff.index.max(), zlib.crc32(prices.tobytes()))
+
+
+@dataclass(frozen=True)
+class StartTime:
+    """Best start for an appliance, the next best, and every start's cost"""
+
+    start: pd.Timestamp
+    end: pd.Timestamp
+    cost: float
+    alternatives: list
+    curve: pd.Series
+
+
+class StartTimeEngine(object):
+    """
+    Cost curves for all appliances, recalculated only for new rates. One
+    household's; not safe to share between threads without a lock.
+    """
+
+    def __init__(self, appliances=APPLIANCES, top_k=3):
+        """`appliances` maps names to patterns, or is an ApplianceRegistry"""
+        self.appliances = appliances
+        self.top_k = top_k
+        self._key = None
+        self._curves = None
+
+    def patterns(self):
+        if isinstance(self.appliances, ApplianceRegistry):
+            return self.appliances.patterns()
+        return self.appliances
+
+    def curves(self, agile_tariff, patterns=None):
+        """Cost of every start slot for every appliance, one column each"""
+        if patterns is None:
+            patterns = self.patterns()
+        key = (
+            tariff_version(agile_tariff),
+            tuple((name, tuple(p)) for name, p in patterns.items()),
+        )
+        if key != self._key:
+            rates = agile_tariff["value_inc_vat"].sort_index()
+            costs = cost_matrix(rates.to_numpy(), list(patterns.values()))
+            self._curves = pd.DataFrame(
+                costs, index=rates.index, columns=list(patterns)
+            ).replace(np.inf, np.nan)
+            self._key = key
+        return self._curves
+
+    def _start_time(self, curve, length):
+        """Best and next best starts from a cost curve"""
+        curve = curve.dropna()
+        if curve.empty:
+            return None
+        costs = curve.to_numpy()
+        k = min(self.top_k + 1, len(costs))
+        order = np.argpartition(costs, k - 1)[:k]
+        # cheapest first, earliest first when the costs are the same
+        order = order[np.lexsort((order, costs[order]))]
+        start = curve.index[order[0]]
+        return StartTime(
+            start=start,
+            end=start + SLOT * length,
+            cost=float(costs[order[0]]),
+            alternatives=[(curve.index[i], float(costs[i])) for i in order[1:]],
+            curve=curve,
+        )
+
+    def best(self, agile_tariff, now=None):
+        """The best starts, from now on, for every appliance"""
+        if agile_tariff.empty:
+            # no rates yet, or none recent enough to keep
+            return {}
+        if now is None:
+            now = pd.Timestamp.now(tz="UTC")
+        patterns = self.patterns()
+        curves = self.curves(agile_tariff, patterns)
+        curves = curves[curves.index >= now]
+
+        results = {}
+        for name, pattern in patterns.items():
+            start_time = self._start_time(curves[name], len(pattern))
+            if start_time is not None:
+                results[name] = start_time
+        return results
+
+    def schedule(self, agile_tariff, requests, now=None):
+        """
+        Best starts for many appliances at once. Each request is a dict with
+        a registered `name` and/or a `pattern`, and optional `not_before` and
+        `finish_by` constraints (see constraint_time). Every request is
+        costed and constrained in the same pass over the tariff; a request
+        that can't be met gets None.
+        """
+        if now is None:
+            now = pd.Timestamp.now(tz="UTC")
+        registered = self.patterns()
+        patterns = [r.get("pattern") or registered[r["name"]] for r in requests]
+        if not patterns:
+            return []
+        if agile_tariff.empty:
+            return [None] * len(requests)
+
+        rates = agile_tariff["value_inc_vat"].sort_index()
+        costs = cost_matrix(rates.to_numpy(), patterns)
+
+        # nanoseconds since the epoch, so the constraints are plain int64
+        starts = rates.index.asi8
+        lengths = np.array([len(p) for p in patterns])
+        earliest = np.empty(len(requests), dtype=np.int64)
+        latest = np.full(len(requests), np.iinfo(np.int64).max)
+        for column, request in enumerate(requests):
+            finish_by = constraint_time(request.get("finish_by"), now)
+            not_before = constraint_time(request.get("not_before"), now, finish_by)
+            earliest[column] = max(now, not_before or now).value
+            if finish_by is not None:
+                latest[column] = (finish_by - SLOT * lengths[column]).value
+        allowed = (starts[:, None] >= earliest[None, :]) & (
+            starts[:, None] <= latest[None, :]
+        )
+        costs[~allowed] = np.inf
+
+        results = []
+        for column, pattern in enumerate(patterns):
+            curve = pd.Series(costs[:, column], index=rates.index)
+            results.append(
+                self._start_time(curve.replace(np.inf, np.nan), len(pattern))
+            )
+        return results
@@ -75,6 +75,30 @@ function loadingData() {
         });
 }
 
+function applianceRow(appliance) {
+    "use strict";
+    // as text, titles are set by any client with PUT /appliances/{name}
+    let row = document.createElement("tr");
+    row.append(
+        ...[appliance.title, appliance.start, appliance.end, appliance.cost].map(
+            function (value) {
+                let cell = document.createElement("td");
+                cell.textContent = value;
+                return cell;
+            }
+        )
+    );
+    return row;
+}
+
+function appliancePlot(appliance) {
+    "use strict";
+    let plot = document.createElement("div");
+    plot.id = appliance.name + "Plot";
+    document.getElementById("starttimePlots").appendChild(plot);
+    plotme(plot.id, appliance.plot);
+}
+
 function starttimes() {
     "use strict";
     fetch("http://localhost:8000/starttimes")
@@ -82,44 +106,80 @@ function starttimes() {
             return response.json();
         })
         .then(function (data) {
-            replaceMe("WashingMachineEnd", data.WashingMachineEnd);
-            replaceMe("WashingMachineCost", data.WashingMachineCost);
-            replaceMe("GentleDishwasherStart", data.GentleDishwasherStart);
-            replaceMe("GentleDishwasherCost", data.GentleDishwasherCost);
-            replaceMe("EcoDishwasherStart", data.EcoDishwasherStart);
-            replaceMe("EcoDishwasherCost", data.EcoDishwasherCost);
-            replaceMe("IntenseDishwasherStart", data.IntenseDishwasherStart);
-            replaceMe("IntenseDishwasherCost", data.IntenseDishwasherCost);
-            plotme("WashingMachinePlot", data.WashingMachinePlot);
-            plotme("GentleDishwasherPlot", data.GentleDishwasherPlot);
-            plotme("EcoDishwasherPlot", data.EcoDishwasherPlot);
-            plotme("IntenseDishwasherPlot", data.IntenseDishwasherPlot);
+            document.getElementById("starttimes").replaceChildren(
+                ...data.appliances.map(applianceRow)
+            );
+            document.getElementById("starttimePlots").replaceChildren();
+            data.appliances.forEach(appliancePlot);
         });
 }
 
-function consumption() {
+function unpack(buffer, template) {
+    "use strict";
+    // See columns.py, x then y, both 4 bytes a point
+    let points = buffer.byteLength / 8;
+    let x = new Float32Array(buffer, 0, points);
+    if (template.x === "time") {
+        x = Array.from(new Int32Array(buffer, 0, points), function (t) {
+            return new Date(t * 1000);
+        });
+    }
+    return { x: x, y: new Float32Array(buffer, 4 * points, points) };
+}
+
+function chartDiv(name) {
+    "use strict";
+    let chart = document.getElementById(name + "Chart");
+    if (chart === null) {
+        chart = document.createElement("div");
+        chart.id = name + "Chart";
+        document.getElementById("consumptionCharts").appendChild(chart);
+    }
+    return chart;
+}
+
+function seriesTemplate(name, templates) {
+    "use strict";
+    // Heating seasons come and go, e.g. gasConsumption2025Binned
+    let season = name.match(/^gasConsumption(\d+)Binned$/);
+    if (name in templates || season === null) {
+        return templates[name];
+    }
+    return { title: "Gas Consumption " + season[1], x: "bin" };
+}
+
+function seriesPlot(name, template) {
     "use strict";
-    fetch("http://localhost:8000/consumption")
+    let chart = chartDiv(name);
+    fetch("http://localhost:8000/series/" + name)
         .then(function (response) {
-            return response.json();
+            return response.arrayBuffer();
         })
-        .then(function (data) {
-            plotme("electricityDailyChart", data.electricityDailyChart);
-            plotme("electricityRollingChart", data.electricityRollingChart);
-            plotme("gasDailyChart", data.gasDailyChart);
-            plotme("gasRollingChart", data.gasRollingChart);
-            plotme("gasConsumptionBinnedChart", data.gasConsumptionBinnedChart);
-            plotme(
-                "gasConsumption2022BinnedChart",
-                data.gasConsumption2022BinnedChart
-            );
-            plotme(
-                "gasConsumption2023BinnedChart",
-                data.gasConsumption2023BinnedChart
-            );
-            plotme(
-                "gasConsumption2024BinnedChart",
-                data.gasConsumption2024BinnedChart
+        .then(function (buffer) {
+            let trace = unpack(buffer, template);
+            trace.type = template.x === "time" ? "scatter" : "bar";
+            Plotly.react(
+                chart,
+                [trace],
+                { title: template.title, showlegend: false, bargap: 0 },
+                { responsive: true }
             );
         });
 }
+
+function consumption() {
+    "use strict";
+    // The chart templates are static, only the data comes from the server
+    Promise.all([
+        fetch("charts.json").then(function (response) {
+            return response.json();
+        }),
+        fetch("http://localhost:8000/series").then(function (response) {
+            return response.json();
+        }),
+    ]).then(function (results) {
+        results[1].forEach(function (name) {
+            seriesPlot(name, seriesTemplate(name, results[0]));
+        });
+    });
+}
@@ -0,0 +1,223 @@
+"""Partitioned parquet store for consumption and tariff history
+
+Each dataset (electricity, gas, agile_tariff) is kept as one parquet file per
+calendar month (UTC), e.g. ./data/gas/2023-11.parquet, with a manifest.json
+that records the row count and min/max timestamp of every partition.
+
+New readings are only ever merged into the partitions they fall in, so a
+refresh costs O(new readings) rather than O(history). Files are written to a
+temporary name and moved into place, so a reader never sees half a file.
+
+Every partition is written the same way, by write_table, as a plain Arrow
+table with the dataset's timestamp as its last column: write() turns its
+frame into one, and octopus_2.py and backfill.py write tables directly. So
+the app and the Arrow client can share a DATA_DIR. read() sets the
+timestamp column as the index, as it does for partitions written by pandas,
+with the index stored, before this.
+
+A read only store, as the workers that don't refresh have (households.py),
+ignores writes, so that only one process ever writes the files.
+"""
+import json
+import os
+from os.path import exists, join
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# The timestamp each dataset is indexed by, see index_column
+INDEX_COLUMNS = {"agile_tariff": "valid_from"}
+# other tariffs' rates are kept as e.g. tariff_E-1R-AGILE-24-10-01-C
+TARIFF_PREFIX = "tariff_"
+
+
+def month_key(timestamp):
+    """The partition a timestamp belongs to e.g. 2023-11"""
+    return timestamp.tz_convert("UTC").strftime("%Y-%m")
+
+
+def month_bounds(key):
+    """First instant of the partition and first instant of the next"""
+    start = pd.Timestamp(key + "-01", tz="UTC")
+    return start, start + pd.offsets.MonthBegin(1)
+
+
+def index_column(dataset):
+    """The timestamp column a dataset is indexed by"""
+    if dataset.startswith(TARIFF_PREFIX):
+        return "valid_from"
+    return INDEX_COLUMNS.get(dataset, "interval_start")
+
+
+def frame_table(dataset, frame):
+    """
+    A frame indexed by timestamp as a partition is stored: an Arrow table
+    with the timestamp as its last column, without pandas metadata
+    """
+    columns = frame.reset_index(drop=True)
+    columns[index_column(dataset)] = frame.index.tz_convert("UTC")
+    table = pa.Table.from_pandas(columns, preserve_index=False)
+    return table.replace_schema_metadata(None)
+
+
+def unique_rows(table, key, current=None):
+    """
+    The rows of `current` and then `table`, Arrow tables, with one row per
+    `key`, the last one seen, sorted by `key`. A column only one of them
+    has is kept, null in the other's rows.
+    """
+    table = table.replace_schema_metadata(None)
+    if current is not None and current.num_rows:
+        table = pa.concat_tables(
+            [current.replace_schema_metadata(None), table], promote_options="permissive"
+        )
+    table = table.append_column("row", pa.array(np.arange(table.num_rows)))
+    last = table.group_by(key).aggregate([("row", "max")])["row_max"]
+    table = table.take(last).select(table.column_names[:-1])
+    return table.take(pc.sort_indices(table[key]))
+
+
+def _atomic_write(path, write):
+    """Write to a temporary file then move it over the real one"""
+    temporary = path + ".tmp"
+    write(temporary)
+    os.replace(temporary, path)
+
+
+class ParquetStore(object):
+    """Append-only, month partitioned parquet files with a manifest"""
+
+    def __init__(self, root="./data", read_only=False):
+        self.root = root
+        self.read_only = read_only
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            path = join(self.root, "manifest.json")
+            if exists(path):
+                with open(path) as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = {}
+        return self._manifest
+
+    def _write_manifest(self):
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+
+        os.makedirs(self.root, exist_ok=True)
+        _atomic_write(join(self.root, "manifest.json"), write)
+
+    def _partition_path(self, dataset, key):
+        return join(self.root, dataset, key + ".parquet")
+
+    def partitions(self, dataset, start=None, end=None):
+        """Partition keys, oldest first, holding data in [start, end)"""
+        keys = []
+        for key, entry in sorted(self.manifest.get(dataset, {}).items()):
+            if start is not None and pd.Timestamp(entry["max"]) < start:
+                continue
+            if end is not None and pd.Timestamp(entry["min"]) >= end:
+                continue
+            keys.append(key)
+        return keys
+
+    def empty(self, dataset):
+        return not self.manifest.get(dataset)
+
+    def version(self, dataset):
+        """
+        Changes whenever the dataset is written: each partition written is
+        replaced, so has a new file. As JSON, for files that say which
+        version they were made from.
+        """
+        version = []
+        for key in self.partitions(dataset):
+            stat = os.stat(self._partition_path(dataset, key))
+            version.append([key, stat.st_ino, stat.st_mtime_ns])
+        return version
+
+    def min(self, dataset):
+        """Earliest timestamp stored, without reading any data"""
+        entries = self.manifest.get(dataset, {}).values()
+        return min((pd.Timestamp(e["min"]) for e in entries), default=None)
+
+    def max(self, dataset):
+        """Latest timestamp stored, without reading any data"""
+        entries = self.manifest.get(dataset, {}).values()
+        return max((pd.Timestamp(e["max"]) for e in entries), default=None)
+
+    def read(self, dataset, start=None, end=None):
+        """
+        Read [start, end) of a dataset. Only the partitions overlapping the
+        range are opened.
+        """
+        keys = self.partitions(dataset, start, end)
+        if not keys:
+            return pd.DataFrame([])
+        frame = pd.concat([self._read_partition(dataset, key) for key in keys])
+        if start is not None:
+            frame = frame[frame.index >= start]
+        if end is not None:
+            frame = frame[frame.index < end]
+        return frame
+
+    def _read_partition(self, dataset, key):
+        frame = pd.read_parquet(self._partition_path(dataset, key))
+        if not isinstance(frame.index, pd.DatetimeIndex):
+            frame = frame.set_index(index_column(dataset))
+        return frame
+
+    def write(self, dataset, frame):
+        """
+        Merge `frame`, indexed by timestamp, into the dataset. Only the
+        partitions the new rows fall in are rewritten; where a timestamp
+        already exists the new row wins.
+        """
+        if frame.empty or self.read_only:
+            return []
+        return self.write_table(dataset, frame_table(dataset, frame))
+
+    def import_file(self, dataset, path):
+        """
+        One-off import of a single, unpartitioned, parquet file such as the
+        original e_consumption.parquet
+        """
+        if self.empty(dataset) and exists(path) and not self.read_only:
+            self.write(dataset, pd.read_parquet(path))
+
+    def write_table(self, dataset, table):
+        """
+        As write, for an Arrow table with the dataset's timestamp as a
+        column. Partitions are merged and written as Arrow tables, without
+        going through pandas, whichever way they were written before.
+        """
+        if table.num_rows == 0 or self.read_only:
+            return []
+        key_column = index_column(dataset)
+        os.makedirs(join(self.root, dataset), exist_ok=True)
+        entries = self.manifest.setdefault(dataset, {})
+        keys = pc.strftime(table[key_column], format="%Y-%m")
+
+        touched = []
+        for key in pc.unique(keys).to_pylist():
+            rows = table.filter(pc.equal(keys, key))
+            path = self._partition_path(dataset, key)
+            existing = pq.read_table(path) if exists(path) else None
+            rows = unique_rows(rows, key_column, existing)
+            _atomic_write(path, lambda temporary: pq.write_table(rows, temporary))
+            first, last = pc.min_max(rows[key_column]).values()
+            entries[key] = {
+                "min": first.as_py().isoformat(),
+                "max": last.as_py().isoformat(),
+                "rows": rows.num_rows,
+            }
+            touched.append(key)
+
+        self._write_manifest()
+        return touched
@@ -0,0 +1,76 @@
+import json
+import pytest
+from pages import AGILE_SCHEMA, read_results
+
+# strings with everything the parser has to look past: brackets and braces,
+# escaped quotes and backslashes, and "results" itself
+AWKWARD = [
+    "DIRECT_DEBIT",
+    "] } ]}",
+    'say "hi"',
+    "back\\slash\\",
+    '"results": [{"value_inc_vat": 1}]',
+    "\\\"]",
+]
+
+
+def page(rows):
+    return json.dumps(
+        {
+            "count": len(rows),
+            "next": 'https://example.com/?q="results":[]}',
+            "previous": None,
+            "results": rows,
+        }
+    ).encode()
+
+
+ROWS = [
+    {
+        "value_exc_vat": i / 10,
+        "value_inc_vat": i / 8,
+        "valid_from": "2024-01-01T%02d:00:00Z" % i,
+        "valid_to": "2024-01-01T%02d:30:00Z" % i,
+        "payment_method": payment_method,
+    }
+    for i, payment_method in enumerate(AWKWARD)
+]
+
+
+def chunks(body, size):
+    return [body[i : i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize("batch_size", [1, 4096])
+def test_every_chunk_size(batch_size):
+    body = page(ROWS)
+    for size in range(1, len(body) + 1):
+        table, rest = read_results(chunks(body, size), AGILE_SCHEMA, batch_size)
+        assert table["payment_method"].to_pylist() == AWKWARD, size
+        assert table["value_inc_vat"].to_pylist() == [r["value_inc_vat"] for r in ROWS]
+        assert rest == {
+            "count": len(ROWS),
+            "next": 'https://example.com/?q="results":[]}',
+            "previous": None,
+        }
+
+
+def test_results_in_a_string_before_the_array():
+    body = json.dumps(
+        {"detail": '"results": [1, 2]', "count": 1, "results": ROWS[:1]}
+    ).encode()
+    for size in range(1, len(body) + 1):
+        table, rest = read_results(chunks(body, size), AGILE_SCHEMA)
+        assert table.num_rows == 1, size
+        assert rest == {"detail": '"results": [1, 2]', "count": 1}
+
+
+def test_empty_results():
+    table, rest = read_results([page([])], AGILE_SCHEMA)
+    assert table.num_rows == 0
+    assert rest["count"] == 0
+
+
+def test_incomplete_page():
+    with pytest.raises(ValueError):
+        read_results([page(ROWS)[:-20]], AGILE_SCHEMA)
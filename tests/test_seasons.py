@@ -0,0 +1,22 @@
+import pandas as pd
+from seasons import season_histograms, season_of
+
+
+def test_season_is_named_after_the_year_it_ends_in():
+    index = pd.DatetimeIndex(["2023-06-01", "2023-09-30", "2023-10-01"], tz="UTC")
+    assert season_of(index).tolist() == [2023, 2023, 2024]
+
+
+def test_january_season_ends_in_the_same_year():
+    index = pd.DatetimeIndex(["2023-01-01", "2023-06-01", "2023-12-31"], tz="UTC")
+    assert season_of(index, start_month=1).tolist() == [2023, 2023, 2023]
+
+
+def test_histograms_by_season():
+    index = pd.date_range("2023-09-30 22:00", periods=4, freq="H", tz="UTC")
+    hourly = pd.Series([1.0, 2.0, 0.0, 3.0], index=index)
+    edges, counts = season_histograms(hourly, bins=4, value_range=(0, 4), factor=1)
+    assert edges.tolist() == [0, 1, 2, 3]
+    assert sorted(counts) == [2023, 2024]
+    assert counts[2023].tolist() == [0, 1, 1, 0]
+    assert counts[2024].tolist() == [0, 0, 0, 1]
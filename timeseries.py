@@ -0,0 +1,521 @@
+"""Readings, or rates, kept sorted with one row per half hour
+
+A TimeSeries holds its timestamps as int32 half-hour slot numbers, counted
+from 1970-01-01 UTC, in a sorted numpy array with no repeats, and each
+column as a numpy array beside it. Floats are kept as float32, good for six
+significant figures, far finer than the meters' three decimal places, and
+are given back as the same decimals. Columns that are always the timestamp
+plus half an hour (interval_end, valid_to) aren't kept at all but worked
+out when asked for, and those the API sends that nothing here uses
+(value_exc_vat, payment_method) are dropped. A row of readings is 8 bytes
+rather than the 24 of a pandas frame.
+
+upsert() merges a batch into it by binary search rather than concatenating
+and sorting the whole history again:
+
+- a batch that is all newer than the last timestamp, the usual refresh, is
+  appended: O(new), amortised, by writing into spare room at the end of the
+  arrays, which earlier TimeSeries sharing them never look at
+- anything else, filling a gap or correcting old readings, is one
+  searchsorted and one np.insert, O(n) copying but never a sort
+
+When the same timestamp turns up more than once, the latest row wins, both
+within a batch and against what is already held. A TimeSeries is never
+changed once made, upsert() returns a new one, so one that has been
+published in a snapshot can be read without locks.
+
+save() writes the arrays to one file that load() memory maps, so loading
+reads nothing until it is used and the pages are shared with any other
+process that maps the same file. It can leave room at the end of each
+array for append_saved() to add newer rows in place, O(new) again.
+
+frame() gives the pandas view, indexed by timestamp, for the chart, store
+and rollup code, and series["column"] one column as a Series, both with the
+derived columns and float64 values as before.
+"""
+import json
+import os
+from threading import Lock
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+SLOT = pd.Timedelta("30 min")
+SLOT_NANOSECONDS = SLOT.value
+# columns that are always the timestamp plus one slot
+DERIVED = ("interval_end", "valid_to")
+# columns the API sends that nothing uses
+UNUSED = ("value_exc_vat", "payment_method")
+# the least room to allocate, in rows, when the arrays have to grow
+MIN_CAPACITY = 1024
+# significant figures a float32 keeps exactly
+FLOAT32_DIGITS = 6
+
+# save() file layout: MAGIC, the header's length, the JSON header, then
+# each array starting on an ALIGNMENT byte boundary
+MAGIC = b"OCTOTS01"
+ALIGNMENT = 64
+# header bytes to spare, for append_saved to write a longer one
+HEADER_ROOM = 1024
+
+
+def _nanoseconds(values):
+    """Timestamps, tz-aware or not, as int64 nanoseconds UTC"""
+    values = pd.DatetimeIndex(values)
+    if values.tz is not None:
+        values = values.tz_convert("UTC")
+    return np.asarray(values.asi8, dtype=np.int64)
+
+
+def _slots(values):
+    """Timestamps as int32 half-hour slots, ValueError if any aren't on one"""
+    slots, remainder = np.divmod(_nanoseconds(values), SLOT_NANOSECONDS)
+    if remainder.any():
+        raise ValueError("Timestamps must be on the hour or half hour")
+    return slots.astype(np.int32)
+
+
+def _compact(values):
+    if values.dtype == np.float64:
+        return values.astype(np.float32)
+    return values
+
+
+def _float64(values):
+    """
+    float32 values back as float64 at the six significant figures float32
+    holds, so a reading of 0.119 is 0.119 again, not 0.11900000274181366
+    """
+    values = values.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 10.0 ** (FLOAT32_DIGITS - 1 - np.floor(np.log10(np.abs(values))))
+    scale[~np.isfinite(scale)] = 1.0
+    return np.round(values * scale) / scale
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _latest(keys):
+    """
+    Positions that sort `keys`, keeping only the last of any repeats, so
+    the latest row wins
+    """
+    order = np.argsort(keys, kind="stable")
+    ordered = keys[order]
+    last = np.ones(len(ordered), dtype=bool)
+    last[:-1] = ordered[1:] != ordered[:-1]
+    return order[last]
+
+
+class _Buffer(object):
+    """
+    Arrays with room to grow, shared by TimeSeries that only add to the end.
+    Without a capacity, the arrays are used as they are, with no room.
+    """
+
+    def __init__(self, keys, columns, capacity=None):
+        if capacity is None:
+            self.keys = keys
+            self.columns = dict(columns)
+        else:
+            self.keys = np.empty(capacity, dtype=keys.dtype)
+            self.keys[: len(keys)] = keys
+            self.columns = {}
+            for name, values in columns.items():
+                self.columns[name] = np.empty(capacity, dtype=values.dtype)
+                self.columns[name][: len(values)] = values
+        self.used = len(keys)
+        self.lock = Lock()
+
+    @property
+    def capacity(self):
+        return len(self.keys)
+
+
+class TimeSeries(object):
+    """Rows sorted by a unique half-hour timestamp, see the module docstring"""
+
+    def __init__(self, keys=None, columns=None, times=(), name=None, derived=()):
+        """
+        `keys` are sorted, unique, int32 slots and `columns` numpy arrays,
+        by name, of the same length. Columns named in `times` hold
+        timestamps, as int64 nanoseconds, and those in `derived` are worked
+        out from the keys. `name` is the index name.
+        """
+        keys = np.empty(0, dtype=np.int32) if keys is None else keys
+        columns = {} if columns is None else columns
+        self._buffer = _Buffer(keys, columns)
+        self._length = len(keys)
+        self.times = frozenset(times)
+        self.name = name
+        self.derived = tuple(derived)
+
+    @classmethod
+    def _view(cls, buffer, length, like):
+        """The first `length` rows of a buffer"""
+        series = cls.__new__(cls)
+        series._buffer = buffer
+        series._length = length
+        series.times = like.times
+        series.name = like.name
+        series.derived = like.derived
+        return series
+
+    @classmethod
+    def _from_unsorted(cls, keys, columns, times, name, derived):
+        keep = _latest(keys)
+        return cls(
+            keys[keep],
+            {column: values[keep] for column, values in columns.items()},
+            times,
+            name,
+            derived,
+        )
+
+    @classmethod
+    def from_frame(cls, frame):
+        """A frame indexed by timestamp. Timestamp columns are kept as such."""
+        if isinstance(frame, TimeSeries):
+            return frame
+        if frame.empty and not len(frame.columns):
+            return cls()
+        columns, times, derived = {}, [], []
+        for column in frame.columns:
+            if column in UNUSED:
+                continue
+            if column in DERIVED:
+                derived.append(column)
+            elif pd.api.types.is_datetime64_any_dtype(frame[column]):
+                columns[column] = _nanoseconds(frame[column])
+                times.append(column)
+            else:
+                columns[column] = _compact(frame[column].to_numpy())
+        return cls._from_unsorted(
+            _slots(frame.index), columns, times, frame.index.name, derived
+        )
+
+    @classmethod
+    def from_table(cls, table, key):
+        """An Arrow table of results, by its `key` timestamp column"""
+        columns, times, derived = {}, [], []
+        for column in table.column_names:
+            if column == key or column in UNUSED:
+                continue
+            values = table[column]
+            if column in DERIVED:
+                derived.append(column)
+            elif pa.types.is_timestamp(values.type):
+                columns[column] = _nanoseconds(values.to_pandas())
+                times.append(column)
+            else:
+                columns[column] = _compact(values.to_numpy())
+        return cls._from_unsorted(
+            _slots(table[key].to_pandas()), columns, times, key, derived
+        )
+
+    @property
+    def keys(self):
+        return self._buffer.keys[: self._length]
+
+    @property
+    def columns(self):
+        return {
+            name: values[: self._length]
+            for name, values in self._buffer.columns.items()
+        }
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def empty(self):
+        return self._length == 0
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + sum(v.nbytes for v in self.columns.values())
+
+    @staticmethod
+    def _timestamp(slot):
+        return pd.Timestamp(int(slot) * SLOT_NANOSECONDS, tz="UTC")
+
+    def min(self):
+        """The first timestamp, NaT if empty"""
+        if self.empty:
+            return pd.NaT
+        return self._timestamp(self._buffer.keys[0])
+
+    def max(self):
+        """The last timestamp, NaT if empty"""
+        if self.empty:
+            return pd.NaT
+        return self._timestamp(self._buffer.keys[self._length - 1])
+
+    @property
+    def index(self):
+        """The timestamps as a DatetimeIndex, UTC"""
+        return pd.DatetimeIndex(
+            pd.to_datetime(self.keys.astype(np.int64) * SLOT_NANOSECONDS, utc=True),
+            name=self.name,
+        )
+
+    def _values(self, column, index):
+        """A column for the pandas view, as it was before being compacted"""
+        if column in self.derived:
+            return index + SLOT
+        values = self.columns[column]
+        if column in self.times:
+            return pd.to_datetime(values, utc=True)
+        if values.dtype == np.float32:
+            return _float64(values)
+        return values.copy()
+
+    def __getitem__(self, column):
+        """One column as a Series, indexed by timestamp"""
+        index = self.index
+        return pd.Series(
+            self._values(column, index), index=index, name=column, copy=False
+        )
+
+    def frame(self):
+        """The pandas view, indexed by timestamp"""
+        index = self.index
+        return pd.DataFrame(
+            {
+                column: self._values(column, index)
+                for column in list(self._buffer.columns) + list(self.derived)
+            },
+            index=index,
+        )
+
+    def since(self, start):
+        """The rows at or after `start`, sharing this series' arrays"""
+        if self.empty:
+            return self
+        slot = -(-_nanoseconds([start])[0] // SLOT_NANOSECONDS)
+        first = np.searchsorted(self.keys, slot)
+        if first == 0:
+            return self
+        return self._like(
+            self.keys[first:],
+            {name: values[first:] for name, values in self.columns.items()},
+        )
+
+    def _like(self, keys, columns):
+        return TimeSeries(keys, columns, self.times, self.name, self.derived)
+
+    def upsert(self, batch):
+        """
+        A TimeSeries with the rows of `batch`, another TimeSeries, added;
+        where both have a timestamp, the batch's row wins
+        """
+        if batch.empty:
+            return self
+        if self.empty:
+            return batch
+        if set(batch.columns) != set(self._buffer.columns):
+            # e.g. an old file with other columns, merge them the slow way
+            return TimeSeries.from_frame(pd.concat([self.frame(), batch.frame()]))
+        if batch.keys[0] > self.keys[-1]:
+            return self._append(batch)
+
+        keys, new_keys = self.keys, batch.keys
+        positions = np.searchsorted(keys, new_keys)
+        found = positions < len(keys)
+        found[found] = keys[positions[found]] == new_keys[found]
+        inserts = positions[~found]
+        columns = {}
+        for name, values in self.columns.items():
+            values = values.copy()
+            new_values = batch.columns[name].astype(values.dtype, copy=False)
+            values[positions[found]] = new_values[found]
+            columns[name] = np.insert(values, inserts, new_values[~found])
+        return self._like(np.insert(keys, inserts, new_keys[~found]), columns)
+
+    def _append(self, batch):
+        """`batch`, all newer than the last row, added to the end"""
+        buffer, start = self._buffer, self._length
+        end = start + len(batch)
+        with buffer.lock:
+            # room to spare, and nothing else has been added after this one
+            shared = buffer.used == start and buffer.capacity >= end
+            if shared:
+                buffer.used = end
+        if not shared:
+            buffer = _Buffer(
+                self.keys,
+                self.columns,
+                max(2 * end, MIN_CAPACITY),
+            )
+            buffer.used = end
+        buffer.keys[start:end] = batch.keys
+        for name, values in buffer.columns.items():
+            values[start:end] = batch.columns[name]
+        return TimeSeries._view(buffer, end, self)
+
+    def _rows(self, selection):
+        return self._like(
+            self.keys[selection],
+            {name: values[selection] for name, values in self.columns.items()},
+        )
+
+    def _found(self, other):
+        """Whether each row's timestamp is in `other`, and its position there"""
+        positions = np.searchsorted(other.keys, self.keys)
+        found = positions < len(other)
+        found[found] = other.keys[positions[found]] == self.keys[found]
+        return found, positions
+
+    def difference(self, other):
+        """The rows whose timestamp isn't in `other`"""
+        if other.empty:
+            return self
+        found, _ = self._found(other)
+        if not found.any():
+            return self
+        return self._rows(~found)
+
+    def intersection(self, other):
+        """The rows whose timestamp is in `other`"""
+        if self.empty or other.empty:
+            return self._rows(slice(0, 0))
+        found, _ = self._found(other)
+        return self._rows(found)
+
+    def changes(self, other):
+        """
+        The rows that aren't in `other` or differ from its row, such as
+        readings the API has since corrected. O(new rows) when this is
+        `other` with rows appended, see _append.
+        """
+        if other.empty:
+            return self
+        if self._buffer is other._buffer and self._length >= other._length:
+            return self._rows(slice(other._length, self._length))
+        if set(self.columns) != set(other.columns):
+            return self
+        found, positions = self._found(other)
+        changed = ~found
+        at = positions[found]
+        for name, values in self.columns.items():
+            new, old = values[found], other.columns[name][at]
+            differ = new != old
+            if values.dtype.kind == "f":
+                differ &= ~(np.isnan(new) & np.isnan(old))
+            changed[found] |= differ
+        return self._rows(changed)
+
+    def save(self, path, meta=None, spare=0):
+        """
+        Write the arrays to `path`, replacing it atomically, with `meta`, any
+        JSON, for load() to return. Room is left for `spare` more rows, and
+        a bigger header, for append_saved.
+        """
+        arrays = [("", self.keys)] + list(self.columns.items())
+        capacity = self._length + spare
+        header = {
+            "name": self.name,
+            "times": sorted(self.times),
+            "derived": list(self.derived),
+            "length": self._length,
+            "capacity": capacity,
+            "meta": meta,
+            "arrays": [],
+        }
+        size = 0
+        for name, values in arrays:
+            header["arrays"].append([name, values.dtype.str, size])
+            size = _aligned(size + values.itemsize * capacity)
+        encoded = json.dumps(header).encode()
+        # JSON allows trailing spaces, so the header can be rewritten longer
+        room = _aligned(2 * len(encoded) + HEADER_ROOM)
+        start = _aligned(len(MAGIC) + 8 + room)
+
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(MAGIC + room.to_bytes(8, "little") + encoded.ljust(room))
+            for (_, values), (_, _, offset) in zip(arrays, header["arrays"]):
+                f.seek(start + offset)
+                f.write(np.ascontiguousarray(values).tobytes())
+            f.truncate(start + size)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def append_saved(path, batch, meta, saved_meta):
+        """
+        Add `batch`, which may be empty, to the end of the TimeSeries saved
+        at `path`, in place, O(len(batch)), and mark it with `meta`. Only done if it was saved
+        with `saved_meta`, has the same columns and room for the rows, and
+        they are all newer than its last; returns False, having changed
+        nothing, if not. Processes that have it mapped only see the rows
+        they loaded.
+        """
+        with open(path, "r+b") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return False
+            room = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(room))
+            rows = header["length"]
+            arrays = [("", batch.keys)] + list(batch.columns.items())
+            if (
+                header["meta"] != saved_meta
+                or rows + len(batch) > header.get("capacity", rows)
+                or sorted(name for name, _, _ in header["arrays"])
+                != sorted(name for name, _ in arrays)
+            ):
+                return False
+            header["length"] = rows + len(batch)
+            header["meta"] = meta
+            encoded = json.dumps(header).encode()
+            if len(encoded) > room:
+                return False
+            start = _aligned(len(MAGIC) + 8 + room)
+            layout = {name: (dtype, offset) for name, dtype, offset in header["arrays"]}
+            if rows and len(batch):
+                dtype, offset = layout[""]
+                itemsize = np.dtype(dtype).itemsize
+                f.seek(start + offset + (rows - 1) * itemsize)
+                last = np.frombuffer(f.read(itemsize), dtype=dtype)[0]
+                if batch.keys[0] <= last:
+                    return False
+            # the rows, then the header that counts them
+            for name, values in arrays:
+                dtype, offset = layout[name]
+                values = np.ascontiguousarray(values, dtype=dtype)
+                f.seek(start + offset + rows * values.itemsize)
+                f.write(values.tobytes())
+            f.flush()
+            f.seek(len(MAGIC) + 8)
+            f.write(encoded.ljust(room))
+        return True
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        (TimeSeries, meta) saved at `path`, its arrays memory mapped, read
+        only, unless not `mmap`. ValueError if it isn't a saved TimeSeries.
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s isn't a saved TimeSeries" % path)
+            length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(length))
+        start = _aligned(len(MAGIC) + 8 + length)
+        rows = header["length"]
+        arrays = {}
+        for name, dtype, offset in header["arrays"]:
+            if rows == 0:
+                arrays[name] = np.empty(0, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(
+                    path, dtype=dtype, mode="r", offset=start + offset, shape=(rows,)
+                )
+            else:
+                arrays[name] = np.fromfile(
+                    path, dtype=dtype, count=rows, offset=start + offset
+                )
+        keys = arrays.pop("")
+        series = cls(keys, arrays, header["times"], header["name"], header["derived"])
+        return series, header["meta"]
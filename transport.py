@@ -0,0 +1,194 @@
+"""Timeouts, retries, rate limiting and a circuit breaker for the API clients
+
+Both clients (octopus.py, octopus_async.py) send every request through a
+Transport, set up from config.ini:
+
+- connect and read timeouts, HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT
+  seconds, so a stalled API can't hold a refresh up for ever
+- up to HTTP_RETRIES more attempts for network errors, 429 and 5xx
+  responses, after a random delay of up to HTTP_BACKOFF * 2^attempt seconds
+  (full jitter), capped at HTTP_BACKOFF_CAP. A Retry-After header is
+  waited for instead, unless it is longer than the cap, when the request
+  gives up rather than wait
+- a token bucket, API_RATE requests a second with bursts of API_BURST,
+  shared by everything using the client
+- a circuit breaker: after CIRCUIT_FAILURES failed attempts in a row the
+  API isn't called for CIRCUIT_RESET seconds, requests fail straight away,
+  and then one is let through to see if it has recovered
+
+A request that still fails raises DataUnavailable, as before, and the
+refresh keeps serving the stored data (households.py), so an API that is
+down or slow costs at most a bounded wait, then nothing until the circuit
+closes again.
+https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+"""
+from email.utils import parsedate_to_datetime
+import random
+from threading import Lock
+import time
+
+# statuses worth trying again, the rest won't change
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitOpen(Exception):
+    """The API has failed too often lately to be worth calling"""
+
+
+def retry_after_seconds(value, now=None):
+    """A Retry-After header, seconds or an HTTP date, as seconds; None if neither"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, when.timestamp() - now)
+
+
+class TokenBucket(object):
+    """`rate` requests a second on average, in bursts of up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self):
+        """
+        Take a token, returning how many seconds to wait before using it,
+        0 if one is free now
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class CircuitBreaker(object):
+    """
+    Open after `failures` failed attempts in a row, for `reset` seconds,
+    then half open: one attempt is let through, closing it if it succeeds
+    """
+
+    def __init__(self, failures=5, reset=60.0):
+        self.failures = failures
+        self.reset = reset
+        self._count = 0
+        self._opened = None
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        if self._opened is None:
+            return "closed"
+        if time.monotonic() - self._opened < self.reset:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """Whether to make an attempt, letting one through when half open"""
+        with self._lock:
+            if self._opened is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened < self.reset:
+                return False
+            # the trial attempt; the others wait for another reset period
+            self._opened = now
+            return True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self._count >= self.failures:
+                self._opened = time.monotonic()
+
+
+class Transport(object):
+    """The timeouts, retry policy, token bucket and circuit breaker for one client"""
+
+    def __init__(
+        self,
+        connect_timeout=5.0,
+        read_timeout=30.0,
+        retries=3,
+        backoff=0.5,
+        backoff_cap=10.0,
+        bucket=None,
+        breaker=None,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.bucket = bucket
+        self.breaker = breaker
+
+    @classmethod
+    def from_config(cls, cfg):
+        octopus = cfg["octopus"]
+        rate = octopus.getfloat("API_RATE", 5)
+        failures = octopus.getint("CIRCUIT_FAILURES", 5)
+        return cls(
+            octopus.getfloat("HTTP_CONNECT_TIMEOUT", 5),
+            octopus.getfloat("HTTP_READ_TIMEOUT", 30),
+            octopus.getint("HTTP_RETRIES", 3),
+            octopus.getfloat("HTTP_BACKOFF", 0.5),
+            octopus.getfloat("HTTP_BACKOFF_CAP", 10),
+            TokenBucket(rate, octopus.getint("API_BURST", 10)) if rate > 0 else None,
+            (
+                CircuitBreaker(failures, octopus.getfloat("CIRCUIT_RESET", 60))
+                if failures > 0
+                else None
+            ),
+        )
+
+    def wait(self):
+        """
+        Seconds to wait before the next attempt, for the token bucket.
+        Raises CircuitOpen if the attempt shouldn't be made at all.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpen("The API has been failing, not calling it for now")
+        return 0.0 if self.bucket is None else self.bucket.reserve()
+
+    def succeeded(self):
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def retry_delay(self, attempt, status, retry_after=None):
+        """
+        After attempt number `attempt`, from 0, failed with `status`, a
+        status code or "error" for a network error: seconds to wait before
+        trying again, or None to give up
+        """
+        retryable = status == "error" or status in RETRY_STATUSES
+        if retryable and self.breaker is not None:
+            self.breaker.failure()
+        if not retryable or attempt >= self.retries:
+            return None
+        retry_after = retry_after_seconds(retry_after)
+        if retry_after is not None:
+            return None if retry_after > self.backoff_cap else retry_after
+        return random.uniform(0, min(self.backoff_cap, self.backoff * 2**attempt))